@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+baseline.py
+
+An earlier transcript of the same package, for --baseline.
+
+A new version of a package mostly installs the same files as the last one,
+with the same size, modification time, mode and owner. For those files the
+line of the earlier transcript still holds, so its checksum is used rather
+than the file being read again, and with the fsdiff tool the line is used
+as it is without running fsdiff at all. Lines are only taken from the
+baseline when it was made with a checksum if this run is, and without one
+if it is not.
+
+With --delta only what differs from the baseline is written out: lines
+that are new or have changed, the removals of this install, and a removal
+for each path in the baseline the new version no longer installs. Both
+transcripts are in lsort order, so they are compared in one pass as the
+sorted lines are written.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import sys
+import stat
+
+from radmind import decode_path
+from tsort import radmind_key
+
+class Baseline(object):
+    """the lines of an earlier transcript, by path"""
+
+    def __init__(self, path, case_insensitive=False, checksum=None):
+        self.path = path
+        self.case_insensitive = case_insensitive
+        self.checksum = checksum
+        self.lines = {}
+        self.reused = 0
+        for line in open(path):
+            if line[0] in ('#', '\n', '-'):
+                # earlier removals say nothing about what is installed
+                continue
+            line = line.rstrip('\n')
+            self.lines[self.key(decode_path(line.split(' ', 2)[1]))] = line
+
+    def key(self, path):
+        path = path.lstrip('.')
+        if self.case_insensitive:
+            path = path.lower()
+        return path
+
+    def lookup(self, path):
+        """the baseline line for path, given as it is in a transcript"""
+        return self.lines.get(self.key(path))
+
+    def cksum(self, path, fields):
+        """the checksum of the baseline line for path when the rest of its
+        fields, all but the path, are fields, otherwise None"""
+        line = self.lookup(path)
+        if line is None:
+            return None
+        old = line.split(' ')
+        if len(old) != len(fields) + 1 or old[0] != fields[0] or old[2:-1] != fields[2:]:
+            return None
+        if (old[-1] == '-') != (not self.checksum):
+            return None
+        self.reused += 1
+        return old[-1]
+
+    def unchanged(self, path, info):
+        """the baseline line for the file path, if it has not changed going
+        by its lstat info"""
+        if info is None or not stat.S_ISREG(info.st_mode):
+            return None
+        fields = ['f', None, '%.4o' % stat.S_IMODE(info.st_mode), str(info.st_uid),
+                  str(info.st_gid), str(int(info.st_mtime)), str(info.st_size)]
+        if self.cksum(path, fields) is None:
+            return None
+        return self.lookup(path)
+
+    def sorted_lines(self):
+        """the baseline lines in lsort order"""
+        key = lambda line: radmind_key(line, self.case_insensitive)
+        return sorted(self.lines.itervalues(), key=key)
+
+class DeltaWriter(object):
+    """Takes a transcript's lines in lsort order with write(), and passes on
+    only those that differ from a Baseline, followed by removals for what
+    is only in the baseline"""
+
+    def __init__(self, out, baseline):
+        self.out = out
+        self.case_insensitive = baseline.case_insensitive
+        self.old = iter(baseline.sorted_lines())
+        self.next_old = None
+        self.unchanged = 0
+        self.dropped = 0 # baseline paths the new transcript has not got
+        self._advance()
+
+    def _advance(self):
+        line = next(self.old, None)
+        if line is None:
+            self.next_old = None
+        else:
+            self.next_old = (radmind_key(line + '\n', self.case_insensitive), line)
+
+    def write(self, line):
+        key = radmind_key(line, self.case_insensitive)
+        # baseline paths sorting before this one are gone
+        while self.next_old is not None and self.next_old[0] < key:
+            self._removed(self.next_old[1])
+            self._advance()
+        if self.next_old is not None and self.next_old[0] == key:
+            old = self.next_old[1]
+            self._advance()
+            if line.rstrip('\n') == old:
+                self.unchanged += 1
+                return
+        self.out.write(line)
+
+    def _removed(self, line):
+        self.dropped += 1
+        self.out.write('- ' + line + '\n')
+
+    def close(self):
+        while self.next_old is not None:
+            self._removed(self.next_old[1])
+            self._advance()
+        if self.out not in (sys.stdout, sys.stderr):
+            self.out.close()
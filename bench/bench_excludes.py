@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_excludes.py
+
+Compares the combined exclude matcher with the old loop over one compiled
+regular expression per exclude, on a command file sized exclude set.
+
+usage: python bench/bench_excludes.py [number of excludes] [number of paths]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from excludes import ExcludeMatcher
+
+# excludes typical of a radmind client command file
+common = [
+    './private/var/vm/*',
+    './private/var/tmp/*',
+    './private/tmp/*',
+    './private/var/log/*',
+    './private/var/run/*',
+    './private/var/db/dyld/*',
+    './Library/Caches/*',
+    './System/Library/Caches/*',
+    './Users/*/Library/Caches/*',
+    './Users/*/Library/Preferences/ByHost/*',
+    './.Spotlight-V100',
+    './.fseventsd',
+    './.Trashes',
+    './Volumes/*',
+    './Network/*',
+    './dev/*',
+    '*.DS_Store',
+    './Library/Logs/*',
+]
+
+apps = ['Safari', 'Mail', 'iTunes', 'iPhoto', 'GarageBand', 'Xcode', 'Microsoft Word',
+        'Microsoft Excel', 'Adobe Photoshop', 'Firefox', 'Keynote', 'Pages']
+
+def exclude_set(count):
+    lines = list(common)
+    rng = random.Random(1)
+    while len(lines) < count:
+        app = rng.choice(apps) + str(len(lines))
+        lines.append(rng.choice([
+            './Library/Application Support/%s/Cache/*' % app,
+            './Library/Preferences/com.vendor.%s.plist' % app,
+            './Applications/%s.app/Contents/Resources/Updates/*' % app,
+            './Users/*/Library/Application Support/%s/*' % app,
+            './private/var/db/receipts/%s*' % app,
+        ]))
+    # the same conversion watchedinstall.py's parse_excludes makes
+    excludes = [l.lstrip('.').replace('.', '\\.').replace('*', '.*') for l in lines]
+    excludes.append('\\.\\.namedfork')
+    return excludes
+
+def path_set(count):
+    rng = random.Random(2)
+    roots = ['/Applications/%s.app/Contents/Resources', '/Library/Application Support/%s',
+             '/System/Library/Frameworks/%s.framework/Versions/A', '/Library/Caches/%s',
+             '/private/var/db/receipts', '/Users/admin/Library/Caches/%s',
+             '/Library/Fonts', '/usr/local/lib/%s']
+    langs = ['English', 'en', 'fr', 'de', 'ja', 'es', 'it', 'nl']
+    paths = []
+    for i in xrange(count):
+        base = rng.choice(roots)
+        if '%s' in base:
+            base = base % rng.choice(apps)
+        if rng.random() < 0.3:
+            base += '/%s.lproj' % rng.choice(langs)
+        paths.append('%s/file%d.%s' % (base, i, rng.choice(['plist', 'nib', 'dylib', 'png', 'strings'])))
+    return paths
+
+def old_path_ok(patterns, english_only):
+    def path_ok(path):
+        if english_only:
+            if re.search('.lproj',path):
+                if not (re.search('English.lproj',path) or re.search('en.lproj',path)):
+                    return False
+        for pattern in patterns:
+            if pattern.search(path):
+                return False
+        return True
+    return path_ok
+
+def timed(path_ok, paths):
+    start = time.time()
+    results = [path_ok(p) for p in paths]
+    return time.time() - start, results
+
+def main():
+    n_excludes = len(sys.argv) > 1 and int(sys.argv[1]) or 300
+    n_paths = len(sys.argv) > 2 and int(sys.argv[2]) or 100000
+    excludes = exclude_set(n_excludes)
+    paths = path_set(n_paths)
+    print "%d excludes, %d paths" % (len(excludes), len(paths))
+    for english_only in (False, True):
+        compiled = [re.compile(s, re.I) for s in excludes]
+        old_time, old_results = timed(old_path_ok(compiled, english_only), paths)
+        new_time, new_results = timed(ExcludeMatcher(excludes, english_only).path_ok, paths)
+        differ = sum([1 for a, b in zip(old_results, new_results) if a != b])
+        print "english only: %-5s  loop: %.3fs  matcher: %.3fs  speedup: %.1fx  differences: %d" % (
+            english_only, old_time, new_time, old_time / max(new_time, 1e-9), differ)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_parselog.py
+
+Times how watchedinstall.py turns an event log into a transcript, on a
+synthetic install written by genlog.py, with the radmind tools replaced by
+the stand ins in bench/stubs so it runs on Linux.
+
+watchedinstall.py --parse-only is run on the logs with a --stats report,
+which times each phase - pid resolution, the scan of the log, dispatching
+adds and removes, sorting, and writing the output - and counts events,
+paths and external commands. The report is printed as JSON, with the wall
+time, peak memory and events per second of the whole run added.
+
+usage: python bench/bench_parselog.py [genlog options] [-P] [-j N] [--json PATH]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+from subprocess import Popen, PIPE
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..'))
+import watchedinstall
+import genlog
+
+stubs = os.path.join(bench_dir, 'stubs')
+
+def make_parser():
+    parser = genlog.make_parser()
+    parser.usage = 'python bench/bench_parselog.py [options]'
+    parser.remove_option('--dir')
+    parser.add_option('-d', '--dir', help='work in DIR, generating the install there if it is empty, default: a temporary directory')
+    parser.add_option('-P', dest='pythondiff', action='store_true', default=False,
+                      help='use the pure python fsdiff')
+    parser.add_option('-j', '--jobs', type='int', default=4)
+    parser.add_option('--json', help='write the results to PATH as well', metavar='PATH')
+    parser.add_option('--profile', help='profile watchedinstall.py, saving the profile to PATH', metavar='PATH')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help='keep the install generated in a temporary directory')
+    return parser
+
+def run(work, meta, options):
+    """runs watchedinstall.py --parse-only with a --stats report, returns the
+    report with the wall time and peak memory of the whole process added"""
+    shutil.copy(os.path.join(work, 'events.log'), watchedinstall.logfile)
+    shutil.copy(os.path.join(work, 'pid_log.log'), watchedinstall.pidlog)
+    report_path = os.path.join(work, 'stats.json')
+    command = [sys.executable, os.path.join(bench_dir, '..', 'watchedinstall.py'),
+               '--parse-only', '-i', str(meta['installer_pid']), '-t', meta['target'],
+               '-K', os.path.join(work, 'command.K'), '-I', '-j', str(options.jobs),
+               '-o', os.path.join(work, 'out.T'), '--stats', report_path]
+    if options.pythondiff:
+        command.append('-P')
+    if options.profile:
+        command.extend(['--profile', options.profile])
+    start = time.time()
+    process = Popen(command, stdout=PIPE)
+    process.stdout.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    if status:
+        sys.exit('watchedinstall.py failed')
+    report = json.load(open(report_path))
+    report['wall_seconds'] = round(elapsed, 4)
+    report['peak_rss_kb'] = usage.ru_maxrss
+    report['events_per_sec'] = int(meta['events'] / elapsed)
+    scan = report['phases'].get('scan')
+    if scan:
+        report['scan_events_per_sec'] = int(report['counters'].get('events scanned', 0) / scan)
+    report['transcript_lines'] = len(open(os.path.join(work, 'out.T')).readlines())
+    return report
+
+def main():
+    parser = make_parser()
+    options, args = parser.parse_args()
+    os.environ['PATH'] = stubs + os.pathsep + os.environ.get('PATH', '')
+    temporary = not options.dir
+    work = os.path.abspath(options.dir or tempfile.mkdtemp(prefix='wibench'))
+    try:
+        if not os.path.exists(os.path.join(work, 'meta.json')):
+            options.dir = work
+            start = time.time()
+            genlog.generate(options)
+            generated = time.time() - start
+        else:
+            generated = None
+        meta = json.load(open(os.path.join(work, 'meta.json')))
+        results = run(work, meta, options)
+        results['install'] = meta
+        results['generate_seconds'] = generated
+        results['pythondiff'] = options.pythondiff
+        results['jobs'] = options.jobs
+        report = json.dumps(results, indent=2, sort_keys=True)
+        print report
+        if options.json:
+            out = open(options.json, 'w')
+            out.write(report + '\n')
+            out.close()
+    finally:
+        os.chdir('/')
+        if temporary and not options.keep:
+            shutil.rmtree(work, True)
+
+if __name__ == '__main__':
+    main()
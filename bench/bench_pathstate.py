@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_pathstate.py
+
+Peak memory of the event scanner's path state, kept the old way in
+dictionaries of path strings and in a PathStateStore, for a synthetic
+install touching millions of paths. Each is run in a process of its own so
+the peak resident size of one does not hide the other.
+
+usage: python bench/bench_pathstate.py [number of paths]
+"""
+
+import os
+import sys
+import time
+import random
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pathstate
+
+CREATED, OUTPUT, REMOVED = 1, 2, 4
+
+def install_paths(count):
+    """paths laid out like a large SDK install, generated rather than held
+    in memory so only the state being measured stays around"""
+    rng = random.Random(1)
+    roots = ['/Applications/Xcode.app/Contents/Developer/Platforms',
+             '/Library/Fonts', '/usr/local/include', '/Library/Frameworks']
+    made = 0
+    while made < count:
+        root = rng.choice(roots)
+        directory = '%s/Component%d.framework/Versions/A/Headers/sub%d' % (
+            root, rng.randint(0, count // 2000), rng.randint(0, 30))
+        for i in xrange(rng.randint(1, 40)):
+            yield '%s/file_%d_%d.h' % (directory, made, i)
+            made += 1
+
+def run_dicts(count):
+    installer_created = {}
+    items_already_output = {}
+    items_removed = {}
+    items_added = []
+    for i, path in enumerate(install_paths(count)):
+        if i % 3 == 0:
+            installer_created[path] = 1
+        if i % 7 == 0:
+            items_removed[path] = 1
+        else:
+            items_added.append(path)
+            items_already_output[path] = 1
+    return len(items_added) + len(items_removed)
+
+def run_store(count):
+    from array import array
+    store = pathstate.PathStateStore()
+    flags = store.flags
+    items_added = array('i')
+    for i, path in enumerate(install_paths(count)):
+        node = store.node(path, True)
+        if i % 3 == 0:
+            flags[node] |= CREATED
+        if i % 7 == 0:
+            flags[node] |= REMOVED
+        else:
+            flags[node] |= OUTPUT
+            items_added.append(node)
+    return len(items_added) + store.count(REMOVED)
+
+def measure(name, count):
+    """runs one variant in a child process, returns (peak KB, seconds, result)"""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        start = time.time()
+        result = globals()['run_' + name](count)
+        elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_end, '%d %f %d' % (peak, elapsed, result))
+        os._exit(0)
+    os.close(write_end)
+    data = os.read(read_end, 100)
+    os.waitpid(pid, 0)
+    peak, elapsed, result = data.split()
+    return int(peak), float(elapsed), int(result)
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 2000000
+    baseline = measure('nothing', 0)[0]
+    print '%d paths, interpreter alone %.1f MB' % (count, baseline / 1024.0)
+    results = []
+    for name in ('dicts', 'store'):
+        peak, elapsed, result = measure(name, count)
+        results.append(result)
+        print '%-6s peak %7.1f MB (%7.1f MB over baseline) %6.2fs' % (
+            name, peak / 1024.0, (peak - baseline) / 1024.0, elapsed)
+    print 'same paths: %s' % (results[0] == results[1])
+
+def run_nothing(count):
+    return 0
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+genlog.py
+
+Writes a synthetic install for the benchmarks: an fsewatcher event log, the
+execsnoop log of the installer's process tree, a radmind command file with
+a transcript and excludes, and the installed files themselves under a
+target directory, so a run of watchedinstall.py --parse-only has real
+paths to look at.
+
+The installer lays down application bundles, writing some files in place,
+some to a temporary name that is renamed into place, and some temporary
+files that are deleted again, and removes a few files an earlier transcript
+owns. Events from other processes are mixed in among the installer's.
+
+usage: python bench/genlog.py -d DIR [options]
+"""
+
+import os
+import sys
+import json
+import random
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import radmind
+
+INSTALLER_PID = 5000
+
+noise_processes = ['mds', 'fseventsd', 'syslogd', 'WindowServer', 'Finder', 'cfprefsd']
+noise_paths = ['/Library/Caches/com.apple.LaunchServices/cache%d',
+               '/private/var/log/system.log',
+               '/private/var/db/mds/store%d',
+               '/Users/admin/Library/Preferences/com.apple.finder.plist',
+               '/private/tmp/launchd-%d/sock',
+               '/System/Library/Caches/com.apple.kext.caches/file%d']
+localisations = ['English.lproj', 'French.lproj', 'German.lproj', 'Japanese.lproj']
+
+# excludes typical of a radmind client command file
+common_excludes = ['./private/var/vm/*', './private/var/tmp/*', './private/tmp/*',
+                   './private/var/log/*', './private/var/db/*', './Library/Caches/*',
+                   './System/Library/Caches/*', './Users/*/Library/Caches/*',
+                   './Volumes/*', './dev/*', '*.DS_Store', './Library/Logs/*']
+
+def make_parser():
+    parser = OptionParser(usage='python bench/genlog.py -d DIR [options]')
+    parser.add_option('-d', '--dir', help='directory to write the install to', metavar='DIR')
+    parser.add_option('--events', type='int', default=200000,
+                      help='number of events in the log, default: 200000')
+    parser.add_option('--descendants', type='int', default=20,
+                      help='processes the installer spawns, default: 20')
+    parser.add_option('--noise', type='float', default=0.8,
+                      help='share of the events made by other processes, default: 0.8')
+    parser.add_option('--renames', type='float', default=0.2,
+                      help='share of files written to a temporary name and renamed into place, default: 0.2')
+    parser.add_option('--temps', type='float', default=0.05,
+                      help='share of files that are temporary and deleted again, default: 0.05')
+    parser.add_option('--deletes', type='float', default=0.02,
+                      help='share of files that remove a file an earlier transcript owns, default: 0.02')
+    parser.add_option('--depth', type='int', default=4,
+                      help='directory depth inside each bundle, default: 4')
+    parser.add_option('--excludes', type='int', default=200,
+                      help='number of excludes in the command file, default: 200')
+    parser.add_option('--seed', type='int', default=1)
+    return parser
+
+class Generator(object):
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.dir = os.path.abspath(options.dir)
+        self.target = os.path.join(self.dir, 'root')
+        self.log = None
+        self.pids = [INSTALLER_PID]
+        self.events = 0
+        self.installer_events = 0
+        self.files = 0
+        self.removed = []
+        self.bundles = 0
+
+    def noise(self):
+        """events from other processes, on average noise / (1 - noise) of them
+        for each installer event"""
+        rng = self.rng
+        while rng.random() < self.options.noise and self.events < self.options.events:
+            pid = 100 + rng.randrange(len(noise_processes))
+            path = rng.choice(noise_paths)
+            if '%d' in path:
+                path = path % rng.randrange(1000)
+            event = rng.choice(['FSE_CONTENT_MODIFIED', 'FSE_STAT_CHANGED', 'FSE_CREATE_FILE', 'FSE_DELETE'])
+            self.log.write('%d\t%s\t%s\t%s\n' % (pid, noise_processes[pid - 100], event, self.target + path))
+            self.events += 1
+
+    def event(self, event, path, pid=None):
+        if pid is None:
+            pid = self.rng.choice(self.pids)
+        self.log.write('%d\tinstaller\t%s\t%s\n' % (pid, event, self.target + path))
+        self.events += 1
+        self.installer_events += 1
+        self.noise()
+
+    def spawn(self):
+        """the installer's process tree, in the order execsnoop would report it"""
+        out = open(os.path.join(self.dir, 'pid_log.log'), 'w')
+        out.write('  UID    PID   PPID ARGS\n')
+        for i in xrange(self.options.descendants):
+            pid = INSTALLER_PID + 1 + i
+            ppid = self.rng.choice(self.pids)
+            out.write('%5d %6d %6d %s\n' % (0, pid, ppid, self.rng.choice(['sh', 'cp', 'mv', 'pax', 'postinstall'])))
+            self.pids.append(pid)
+        # a process that is not part of the install
+        out.write('%5d %6d %6d %s\n' % (0, 4000, 1, 'mdworker'))
+        out.close()
+
+    def make_dir(self, path):
+        os.mkdir(self.target + path)
+        self.event('FSE_CREATE_DIR', path)
+
+    def make_file(self, path):
+        rng = self.rng
+        options = self.options
+        pid = rng.choice(self.pids)
+        r = rng.random()
+        if r < options.temps:
+            temp = path + '.tmp%d' % rng.randrange(10000)
+            self.event('FSE_CREATE_FILE', temp, pid)
+            self.event('FSE_CONTENT_MODIFIED', temp, pid)
+            self.event('FSE_DELETE', temp, pid)
+            return
+        if r < options.temps + options.renames:
+            temp = os.path.dirname(path) + '/.' + os.path.basename(path) + '.XXXX'
+            self.event('FSE_CREATE_FILE', temp, pid)
+            self.event('FSE_CONTENT_MODIFIED', temp, pid)
+            self.event('FSE_RENAME', temp, pid)
+            self.event('FSE_RENAME', path, pid)
+        else:
+            self.event('FSE_CREATE_FILE', path, pid)
+            for i in xrange(rng.randint(1, 3)):
+                self.event('FSE_CONTENT_MODIFIED', path, pid)
+            self.event('FSE_STAT_CHANGED', path, pid)
+        f = open(self.target + path, 'w')
+        f.write('x' * rng.randrange(2048))
+        f.close()
+        self.files += 1
+        if rng.random() < options.deletes:
+            old = '/Library/Receipts/Old%d/file%d' % (self.bundles, self.files)
+            self.removed.append(old)
+            self.event('FSE_DELETE', old)
+
+    def bundle(self):
+        """lays down one application bundle"""
+        rng = self.rng
+        root = '/Applications/Bench%d.app' % self.bundles
+        self.bundles += 1
+        self.make_dir(root)
+        self.make_dir(root + '/Contents')
+        self.make_file(root + '/Contents/Info.plist')
+        directories = [root + '/Contents']
+        for name in ['MacOS', 'Resources'] + [('Resources/' + l) for l in localisations]:
+            directories.append(root + '/Contents/' + name)
+            self.make_dir(directories[-1])
+        for level in xrange(self.options.depth):
+            parent = rng.choice(directories)
+            path = parent + '/Part%d' % level
+            self.make_dir(path)
+            directories.append(path)
+        for directory in directories:
+            for i in xrange(rng.randint(2, 20)):
+                if self.events >= self.options.events:
+                    return
+                self.make_file('%s/file%d' % (directory, i))
+
+    def command_file(self):
+        """a command file with the transcript the removed files come from,
+        and excludes"""
+        transcript = open(os.path.join(self.dir, 'base.T'), 'w')
+        entries = self.removed + ['/Library/Receipts/Unrelated/file%d' % i
+                                  for i in xrange(max(1000, len(self.removed) * 10))]
+        entries.sort(key=lambda p: p.lower().replace('/', '\0'))
+        for path in entries:
+            transcript.write('f %s 0644 0 0 1234567890 10 -\n' % radmind.encode_path('.' + path))
+        transcript.close()
+        out = open(os.path.join(self.dir, 'command.K'), 'w')
+        out.write('p base.T\n')
+        excludes = list(common_excludes)
+        while len(excludes) < self.options.excludes:
+            excludes.append('./Applications/Other%d.app/Contents/Caches/*' % len(excludes))
+        for pattern in excludes[:self.options.excludes]:
+            out.write('x %s\n' % pattern)
+        out.close()
+
+    def run(self):
+        os.makedirs(self.target + '/Applications')
+        self.log = open(os.path.join(self.dir, 'events.log'), 'w')
+        self.spawn()
+        self.noise()
+        while self.events < self.options.events:
+            self.bundle()
+        self.log.close()
+        self.command_file()
+        meta = {'installer_pid': INSTALLER_PID, 'target': self.target,
+                'events': self.events, 'installer_events': self.installer_events,
+                'files': self.files, 'removed': len(self.removed), 'bundles': self.bundles}
+        out = open(os.path.join(self.dir, 'meta.json'), 'w')
+        json.dump(meta, out)
+        out.close()
+        return meta
+
+def generate(options):
+    """writes the install described by options, returns a summary of it"""
+    return Generator(options).run()
+
+def main():
+    parser = make_parser()
+    options, args = parser.parse_args()
+    if not options.dir:
+        parser.error('a directory to write to is required')
+    if os.path.exists(options.dir) and os.listdir(options.dir):
+        parser.error('%s is not empty' % options.dir)
+    print generate(options)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+capture.py
+
+Backends that watch the file system during an install and hand each change
+to a sink as a (pid, event, path, inode) tuple, using the FSE_* event names
+of the fsewatcher tool whichever backend is in use.
+
+fsewatcher  the companion OS X tool, whose tab separated output is read
+            from a pipe
+fanotify    Linux, in process. Reports the pid behind every change. Needs
+            root and a 5.9 or later kernel.
+inotify     Linux, in process, for when fanotify is not available. The
+            kernel does not say which process made a change, so events come
+            with a pid of None and cannot be told apart from other activity
+            on the target.
+
+A backend is started and stopped for each install, except under the
+daemon, which keeps one watching between installs in a Shared and hands
+its events to each install in turn.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import sys
+import errno
+import select
+import struct
+import tempfile
+import threading
+from subprocess import Popen, PIPE
+
+import stats
+
+# fields of an fsewatcher log line
+PID = 0
+PROCESS = 1
+EVENT = 2
+PATH = 3
+INODE = 4
+
+# the order fsewatcher.c names them in, then those only the Linux backends use
+EVENT_NAMES = (
+    "FSE_CREATE_FILE",
+    "FSE_DELETE",
+    "FSE_STAT_CHANGED",
+    "FSE_RENAME",
+    "FSE_CONTENT_MODIFIED",
+    "FSE_EXCHANGE",
+    "FSE_FINDER_INFO_CHANGED",
+    "FSE_CREATE_DIR",
+    "FSE_CHOWN",
+    "FSE_XATTR_MODIFIED",
+    "FSE_XATTR_REMOVED",
+    "FSE_EVENTS_DROPPED",
+    # the two halves of a rename, which fsewatcher reports as a pair of
+    # FSE_RENAME events, source then destination
+    "FSE_RENAME_FROM",
+    "FSE_RENAME_TO",
+)
+
+# put in the event stream where the kernel dropped events, with the path
+# they were dropped under, or the target when that isn't known
+DROPPED = "FSE_EVENTS_DROPPED"
+
+class CaptureError(Exception):
+    pass
+
+def parse_event_line(line):
+    """turns a fsewatcher log line into a (pid, event, path, inode) tuple"""
+    if line in ('','\n'): return None # blank line at end
+    fields = line.split('\t')
+    if len(fields) <= PATH or not fields[PID].lstrip('-').isdigit():
+        # not an event, such as a message fsewatcher printed: passed over,
+        # a reader stopped here would miss every event after it
+        stats.count('malformed log lines')
+        return None
+    pid = int(fields[PID])
+    if pid < 0:
+        pid = None
+    return (pid, fields[EVENT], fields[PATH].strip(), None)
+
+def format_event_line(pid, event, path):
+    """a log line in the fsewatcher format, -1 standing for an unknown pid"""
+    if pid is None:
+        pid = -1
+    return '%s\t?\t%s\t%s\n' % (pid, event, path)
+
+class Backend(object):
+    """start() begins passing events to sink, from a thread of the backend's
+    own, stop() ends it once everything already seen has been passed on.
+    flush() returns once everything already seen has been passed on, and
+    leaves the backend running.
+    If log is given, every event is also written to it - see eventlog.py"""
+    name = None
+
+    def __init__(self, target='/', log=None):
+        self.target = target
+        self.log = log
+        self.thread = None
+        self.sink = None
+        self.flushed = threading.Event()
+        # paths we write to ourselves while watching
+        self.ignore = set()
+        if log:
+            self.ignore.add(os.path.abspath(log.name))
+
+    def start(self, sink):
+        self.sink = sink
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def emit(self, pid, event, path, inode=None):
+        if path in self.ignore:
+            return
+        if self.log:
+            self.log.write(pid, event, path, inode)
+        self.sink((pid, event, path, inode))
+
+    def run(self):
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def running(self):
+        return self.thread is not None and self.thread.isAlive()
+
+class FseWatcher(Backend):
+    """reads the output of the fsewatcher tool as it is produced"""
+    name = 'fsewatcher'
+
+    def start(self, sink):
+        try:
+            self.process = Popen(['fsewatcher'], stdout=PIPE, bufsize=-1, shell=True)
+        except OSError:
+            raise CaptureError("Unable to run fsewatcher tool, build it from fsewatcher.c and put it on your path, see the README")
+        self.marker = os.path.join(os.path.realpath(tempfile.gettempdir()),
+                                   '.watchedinstall-flush.%d' % os.getpid())
+        Backend.start(self, sink)
+
+    def run(self):
+        for line in iter(self.process.stdout.readline, ''):
+            event = parse_event_line(line)
+            if event:
+                if event[2] == self.marker:
+                    if event[1] == 'FSE_CREATE_FILE':
+                        self.flushed.set()
+                    continue
+                self.emit(*event)
+
+    def flush(self, timeout=10):
+        # fsewatcher is only read from, so a file is made, and the events
+        # before it have been read once its creation comes through. The
+        # removal is let go, fsewatcher may leave it out after the creation
+        self.flushed.clear()
+        open(self.marker, 'w').close()
+        caught_up = self.flushed.wait(timeout)
+        os.remove(self.marker)
+        if not caught_up:
+            # an fsewatcher that never reports its marker, or is far behind:
+            # what it has yet to pass on is treated as dropped, so the
+            # directories the installer worked in are looked at again
+            stats.count('flushes timed out')
+            sys.stderr.write('fsewatcher did not catch up within %d seconds, '
+                             'treating its events as dropped\n' % timeout)
+            self.emit(None, DROPPED, self.target)
+
+    def stop(self):
+        os.kill(self.process.pid, 15)
+        self.thread.join()
+
+class _Selector(Backend):
+    """a backend reading from a kernel file descriptor until told to stop"""
+
+    def start(self, sink):
+        self.stop_r, self.stop_w = os.pipe()
+        Backend.start(self, sink)
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        poller.register(self.stop_r, select.POLLIN)
+        stopping = False
+        timeout = None # once stopping, only what is already queued is waited for
+        while True:
+            try:
+                ready = [fd for fd, ev in poller.poll(timeout)]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.stop_r in ready:
+                request = os.read(self.stop_r, 64)
+                if 'f' in request:
+                    # pass on what the kernel already has queued, and carry on
+                    while self._read_ready():
+                        pass
+                    self.flushed.set()
+                if 'x' in request:
+                    # drain what the kernel already has queued, then finish
+                    stopping = True
+                    timeout = 0
+            # a flush may have read what was ready
+            if self.fd in ready and self._read_ready():
+                continue
+            if stopping:
+                break
+        os.close(self.fd)
+
+    def _read_ready(self):
+        """reads the kernel descriptor if it has anything, False if not"""
+        if not select.select([self.fd], [], [], 0)[0]:
+            return False
+        self.handle(os.read(self.fd, 65536))
+        return True
+
+    def flush(self):
+        self.flushed.clear()
+        os.write(self.stop_w, 'f')
+        self.flushed.wait()
+
+    def stop(self):
+        os.write(self.stop_w, 'x')
+        self.thread.join()
+        os.close(self.stop_r)
+        os.close(self.stop_w)
+
+def _libc():
+    import ctypes
+    return ctypes, ctypes.CDLL(None, use_errno=True)
+
+# fanotify
+FAN_CLOEXEC = 0x1
+FAN_CLASS_NOTIF = 0x0
+FAN_REPORT_DIR_FID = 0x400
+FAN_REPORT_NAME = 0x800
+FAN_MARK_ADD = 0x1
+FAN_MARK_FILESYSTEM = 0x100
+FAN_MODIFY = 0x2
+FAN_ATTRIB = 0x4
+FAN_CLOSE_WRITE = 0x8
+FAN_MOVED_FROM = 0x40
+FAN_MOVED_TO = 0x80
+FAN_CREATE = 0x100
+FAN_DELETE = 0x200
+FAN_Q_OVERFLOW = 0x4000
+FAN_ONDIR = 0x40000000
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+AT_FDCWD = -100
+O_PATH = 0o10000000
+EVENT_METADATA = struct.Struct('=IBBHQii')
+INFO_HEADER = struct.Struct('=BBH')
+FILE_HANDLE = struct.Struct('=Ii')
+
+class Fanotify(_Selector):
+    """Linux fanotify on the file system holding the target. Each event
+    names the directory it happened in by file handle, which is turned
+    back into a path with open_by_handle_at."""
+    name = 'fanotify'
+
+    def __init__(self, target='/', log=None):
+        _Selector.__init__(self, target, log)
+        self.ctypes, self.libc = _libc()
+        self.libc.fanotify_mark.argtypes = [self.ctypes.c_int, self.ctypes.c_uint,
+                                            self.ctypes.c_uint64, self.ctypes.c_int,
+                                            self.ctypes.c_char_p]
+        self.fd = self.libc.fanotify_init(FAN_CLOEXEC | FAN_CLASS_NOTIF |
+                                          FAN_REPORT_DIR_FID | FAN_REPORT_NAME, os.O_RDONLY)
+        if self.fd < 0:
+            raise CaptureError('fanotify unavailable: %s' % os.strerror(self.ctypes.get_errno()))
+        mask = (FAN_MODIFY | FAN_ATTRIB | FAN_CLOSE_WRITE | FAN_MOVED_FROM |
+                FAN_MOVED_TO | FAN_CREATE | FAN_DELETE | FAN_ONDIR)
+        if self.libc.fanotify_mark(self.fd, FAN_MARK_ADD | FAN_MARK_FILESYSTEM, mask,
+                                   AT_FDCWD, target) < 0:
+            err = self.ctypes.get_errno()
+            os.close(self.fd)
+            raise CaptureError('fanotify_mark failed on %s: %s' % (target, os.strerror(err)))
+        self.mount_fd = os.open(target, os.O_RDONLY)
+        self.prefix = target.rstrip('/')
+        self.dirs = {} # file handle -> directory path
+
+    def directory(self, handle):
+        path = self.dirs.get(handle)
+        if path is None:
+            buf = self.ctypes.create_string_buffer(handle, len(handle))
+            fd = self.libc.open_by_handle_at(self.mount_fd, buf, O_PATH)
+            if fd < 0:
+                return None # gone already
+            try:
+                path = os.readlink('/proc/self/fd/%d' % fd)
+            finally:
+                os.close(fd)
+            self.dirs[handle] = path
+        return path
+
+    def handle(self, data):
+        offset = 0
+        while offset + EVENT_METADATA.size <= len(data):
+            event_len, vers, reserved, metadata_len, mask, fd, pid = \
+                EVENT_METADATA.unpack_from(data, offset)
+            info = offset + metadata_len
+            end = offset + event_len
+            offset = end
+            if fd >= 0:
+                os.close(fd)
+            if mask & FAN_Q_OVERFLOW:
+                self.emit(None, DROPPED, self.target)
+                continue
+            path = None
+            unresolved = False
+            while info + INFO_HEADER.size <= end:
+                info_type, pad, info_len = INFO_HEADER.unpack_from(data, info)
+                if info_type == FAN_EVENT_INFO_TYPE_DFID_NAME:
+                    # header, fsid, then a struct file_handle and the name
+                    fh = info + INFO_HEADER.size + 8
+                    handle_bytes = FILE_HANDLE.unpack_from(data, fh)[0]
+                    handle_end = fh + FILE_HANDLE.size + handle_bytes
+                    directory = self.directory(data[fh:handle_end])
+                    name = data[handle_end:info + info_len].split('\0', 1)[0]
+                    if directory is not None:
+                        if name in ('', '.'):
+                            # an event on the directory itself
+                            path = directory
+                        else:
+                            path = os.path.join(directory, name)
+                    else:
+                        unresolved = True
+                info += info_len
+            if path is None and unresolved:
+                # the directory was gone before the event was read, where
+                # the change was made is lost
+                self.emit(pid, DROPPED, self.target)
+                continue
+            if path is None or not (path == self.prefix or path.startswith(self.prefix + '/')):
+                continue
+            if mask & FAN_ONDIR and mask & (FAN_DELETE | FAN_MOVED_FROM | FAN_MOVED_TO):
+                # directory handles may now lead somewhere else
+                self.dirs = {}
+            for event in fan_events(mask):
+                self.emit(pid, event, path)
+
+def fan_events(mask):
+    """the FSE_* events a (possibly merged) fanotify mask stands for, in the
+    order they would have happened"""
+    events = []
+    if mask & FAN_CREATE:
+        events.append(mask & FAN_ONDIR and 'FSE_CREATE_DIR' or 'FSE_CREATE_FILE')
+    if mask & (FAN_MODIFY | FAN_CLOSE_WRITE):
+        events.append('FSE_CONTENT_MODIFIED')
+    if mask & FAN_ATTRIB:
+        events.append('FSE_STAT_CHANGED')
+    if mask & FAN_MOVED_FROM:
+        events.append('FSE_RENAME_FROM')
+    if mask & FAN_MOVED_TO:
+        events.append('FSE_RENAME_TO')
+    if mask & FAN_DELETE:
+        events.append('FSE_DELETE')
+    return events
+
+# inotify
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('=iIII')
+IN_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+           IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+class Inotify(_Selector):
+    """Linux inotify, with a watch on every directory of the target's file
+    system below the target. Events carry no pid."""
+    name = 'inotify'
+
+    def __init__(self, target='/', log=None):
+        _Selector.__init__(self, target, log)
+        self.ctypes, self.libc = _libc()
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise CaptureError('inotify unavailable: %s' % os.strerror(self.ctypes.get_errno()))
+        self.device = os.lstat(target).st_dev
+        self.watches = {} # watch descriptor -> directory path
+        self.watch_tree(target)
+
+    def watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, IN_MASK)
+        if wd >= 0:
+            self.watches[wd] = path
+        return wd
+
+    def watch_tree(self, top, report=False):
+        """watches top and every directory under it on the same file system,
+        reporting what is already inside when a new directory turns up"""
+        for root, dirs, files in os.walk(top):
+            self.watch(root)
+            keep = []
+            for d in dirs:
+                try:
+                    if os.lstat(os.path.join(root, d)).st_dev == self.device:
+                        keep.append(d)
+                except OSError:
+                    pass
+            dirs[:] = keep
+            if report:
+                for d in dirs:
+                    self.emit(None, 'FSE_CREATE_DIR', os.path.join(root, d))
+                for f in files:
+                    self.emit(None, 'FSE_CREATE_FILE', os.path.join(root, f))
+
+    def handle(self, data):
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            start = offset + INOTIFY_EVENT.size
+            name = data[start:start + length].split('\0', 1)[0]
+            offset = start + length
+            if mask & IN_Q_OVERFLOW:
+                self.emit(None, DROPPED, self.target)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = name and os.path.join(directory, name) or directory
+            if mask & IN_CREATE:
+                if mask & IN_ISDIR:
+                    self.emit(None, 'FSE_CREATE_DIR', path)
+                    # anything made in it before the watch was added
+                    self.watch_tree(path, report=True)
+                else:
+                    self.emit(None, 'FSE_CREATE_FILE', path)
+            if mask & (IN_MODIFY | IN_CLOSE_WRITE):
+                self.emit(None, 'FSE_CONTENT_MODIFIED', path)
+            if mask & IN_ATTRIB:
+                self.emit(None, 'FSE_STAT_CHANGED', path)
+            if mask & IN_MOVED_FROM:
+                self.emit(None, 'FSE_RENAME_FROM', path)
+            if mask & IN_MOVED_TO:
+                self.emit(None, 'FSE_RENAME_TO', path)
+                if mask & IN_ISDIR:
+                    self.watch_tree(path)
+            if mask & IN_DELETE:
+                self.emit(None, 'FSE_DELETE', path)
+
+backends = {'fsewatcher': FseWatcher, 'fanotify': Fanotify, 'inotify': Inotify}
+
+class Shared(object):
+    """A backend left watching between installs. start() and stop() hand
+    its events to an install's sink and take them back, as they would start
+    and stop a backend of the install's own; close() stops the backend.
+    Events in between installs are let go."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.target = backend.target
+        self.sink = None
+        backend.start(self._emit)
+
+    def _emit(self, event):
+        sink = self.sink
+        if sink is not None:
+            sink(event)
+
+    def start(self, sink):
+        # what came in before the install is not its doing
+        self.backend.flush()
+        self.sink = sink
+
+    def stop(self):
+        self.backend.flush()
+        self.sink = None
+
+    def running(self):
+        return self.backend.running()
+
+    def close(self):
+        self.backend.stop()
+
+def default_backends():
+    if sys.platform.startswith('linux'):
+        return ['fanotify', 'inotify']
+    return ['fsewatcher']
+
+def backend(name='auto', target='/', log=None):
+    """the named capture backend for target, or with 'auto' the best one this
+    system has"""
+    if name != 'auto':
+        return backends[name](target, log)
+    errors = []
+    for name in default_backends():
+        try:
+            return backends[name](target, log)
+        except CaptureError, e:
+            errors.append(str(e))
+    raise CaptureError('; '.join(errors))
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+daemon.py
+
+Runs watchedinstall.py jobs in a process that stays up between them, and
+the client that hands it jobs.
+
+    python daemon.py --serve [--socket=PATH]
+    python daemon.py [--socket=PATH] [--] WATCHEDINSTALL-OPTIONS
+
+The daemon listens on a Unix socket, by default /var/run/watchedinstall.sock,
+that only its own user can connect to. A job is the options watchedinstall.py
+would be run with - the package, target, format and output, and any other -
+along with the working directory of the client, and is run as if
+watchedinstall.py had been run with them there. What the job writes to
+standard out and standard error is passed back to the client, and the
+client exits with the job's exit status. Jobs are run one at a time, in
+the order they come in.
+
+Between jobs the daemon keeps what would otherwise be made again by each
+run: the modules loaded, the exclude matcher and the transcripts of the
+command file, and the capture backend of a job that streams its events
+(-S, and always on Linux). The matcher and the transcripts are made again
+when the modification time or size of any of the files they were read
+from has changed. Spotlight is turned off once when the daemon starts,
+and back on when it exits, rather than around every install.
+
+The client imports none of watchedinstall.py, so it starts quickly.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+import struct
+import traceback
+from subprocess import call
+
+SOCKET = '/var/run/watchedinstall.sock'
+SPOTLIGHT = '/System/Library/LaunchDaemons/com.apple.metadata.mds.plist'
+
+# each message is a kind and a length, then that many bytes:
+#   j  a job, as JSON, from the client
+#   o  standard out of the job
+#   e  standard error of the job
+#   x  the exit status of the job, the last message
+HEADER = struct.Struct('>cI')
+
+# exit status sent for a job the daemon was stopped in the middle of
+TERMINATED = 128 + signal.SIGTERM
+
+class Shutdown(BaseException):
+    """raised by SIGTERM, a BaseException so that neither a job nor
+    run_job() takes it for an error of the job"""
+
+def send(sock, kind, data):
+    sock.sendall(HEADER.pack(kind, len(data)) + data)
+
+def _read(sock, size):
+    data = ''
+    while len(data) < size:
+        try:
+            chunk = sock.recv(size - len(data))
+        except socket.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def receive(sock):
+    """the next (kind, data) message, (None, None) once the other end is gone"""
+    header = _read(sock, HEADER.size)
+    if header is None:
+        return None, None
+    kind, size = HEADER.unpack(header)
+    data = _read(sock, size)
+    if data is None:
+        return None, None
+    return kind, data
+
+def _stamp(sources):
+    stamp = []
+    for path in sources:
+        try:
+            info = os.stat(path)
+            stamp.append((path, info.st_mtime, info.st_size))
+        except OSError:
+            stamp.append((path, None, None))
+    return tuple(stamp)
+
+class Resident(object):
+    """What the daemon keeps between jobs, given to watchedinstall.py as its
+    resident. get() is used through watchedinstall.warm()."""
+
+    def __init__(self):
+        self.values = {} # key -> (stamp of its sources, value)
+        self.watchers = {} # (capture backend, target) -> capture.Shared
+        self.spotlight = False
+
+    def get(self, key, sources, make):
+        """the value kept for key, made again with make() if any of the
+        files sources has changed since it was made"""
+        import stats
+        stamp = _stamp(sources)
+        kept = self.values.get(key)
+        if kept is not None and kept[0] == stamp:
+            stats.count('kept by the daemon')
+            return kept[1]
+        value = make()
+        self.values[key] = (stamp, value)
+        return value
+
+    def watcher(self, name, target):
+        """a capture backend watching target, started by an earlier job if
+        it is still running"""
+        import capture
+        shared = self.watchers.get((name, target))
+        if shared is None or not shared.running():
+            shared = self.watchers[(name, target)] = capture.Shared(capture.backend(name, target))
+        return shared
+
+    def hold_spotlight(self):
+        if os.geteuid() != 0:
+            return
+        try:
+            self.spotlight = call(['launchctl', 'unload', SPOTLIGHT],
+                                  stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w')) == 0
+        except OSError:
+            pass # not OS X
+
+    def close(self):
+        for shared in self.watchers.values():
+            shared.close()
+        self.watchers = {}
+        if self.spotlight:
+            call(['launchctl', 'load', SPOTLIGHT])
+            self.spotlight = False
+
+class Channel(object):
+    """stands in for sys.stdout or sys.stderr while a job runs, passing on
+    what is written to the client"""
+    softspace = 0
+
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+        self.closed = False
+
+    def write(self, data):
+        if not data or self.closed:
+            return
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        try:
+            send(self.sock, self.kind, data)
+        except socket.error:
+            # the client has gone, the job carries on to the end
+            self.closed = True
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+def run_job(conn, watchedinstall):
+    kind, data = receive(conn)
+    if kind != 'j':
+        return
+    job = json.loads(data)
+    argv = [arg.encode('latin-1') for arg in job['argv']]
+    stdout, stderr, cwd = sys.stdout, sys.stderr, os.getcwd()
+    sys.stdout = Channel(conn, 'o')
+    sys.stderr = Channel(conn, 'e')
+    status = 0
+    stopped = None
+    try:
+        try:
+            os.chdir(job['cwd'].encode('latin-1'))
+            watchedinstall.main(argv)
+        except Shutdown, e:
+            sys.stderr.write('the daemon was stopped before the job finished\n')
+            status = TERMINATED
+            stopped = e
+        except SystemExit, e:
+            status = e.code
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                sys.stderr.write('%s\n' % status)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        os.chdir(cwd)
+    try:
+        send(conn, 'x', str(status))
+    except socket.error:
+        pass
+    if stopped is not None:
+        # on out of serve(), through its clean up
+        raise stopped
+
+def _terminate(signum, frame):
+    raise Shutdown()
+
+def serve(path=SOCKET):
+    """runs jobs sent to the socket at path until killed"""
+    import watchedinstall
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            # left by a daemon that did not exit cleanly
+            os.remove(path)
+        else:
+            sys.exit('a daemon is already running on %s' % path)
+        finally:
+            probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(16)
+    signal.signal(signal.SIGTERM, _terminate)
+    resident = watchedinstall.resident = Resident()
+    resident.hold_spotlight()
+    try:
+        try:
+            while True:
+                try:
+                    conn, address = listener.accept()
+                except socket.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    run_job(conn, watchedinstall)
+                finally:
+                    conn.close()
+        except Shutdown:
+            # a second SIGTERM does not cut the clean up short
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    finally:
+        listener.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        resident.close()
+        watchedinstall.resident = None
+
+def submit(argv, path=SOCKET):
+    """runs a job in the daemon on path, returns its exit status"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error, e:
+        sys.exit('no daemon on %s: %s' % (path, e.args[-1]))
+    send(sock, 'j', json.dumps({'argv': argv, 'cwd': os.getcwd()}, encoding='latin-1'))
+    while True:
+        kind, data = receive(sock)
+        if kind is None:
+            sys.stderr.write('the daemon went away before the job finished\n')
+            return 1
+        if kind == 'o':
+            sys.stdout.write(data)
+        elif kind == 'e':
+            sys.stderr.write(data)
+        elif kind == 'x':
+            sock.close()
+            return int(data)
+
+def main():
+    args = sys.argv[1:]
+    path = SOCKET
+    serving = False
+    while args:
+        if args[0] == '--serve':
+            serving = True
+        elif args[0].startswith('--socket='):
+            path = os.path.abspath(args[0][len('--socket='):])
+        elif args[0] == '--':
+            args.pop(0)
+            break
+        else:
+            break
+        args.pop(0)
+    if serving:
+        if args:
+            sys.exit('usage: python daemon.py --serve [--socket=PATH]')
+        serve(path)
+    else:
+        sys.exit(submit(args, path))
+
+if __name__ == '__main__':
+    main()
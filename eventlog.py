@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+eventlog.py
+
+Writing and reading event logs, either in the tab separated text format of
+the fsewatcher tool or in a compact binary format.
+
+The binary format is an 8 byte header, fixed size records of pid, event
+code, flags, inode and path id, then a table with each path written once,
+and a footer giving where the table starts. The reader maps the file into
+memory, unpacks the records a few thousand at a time, and only turns a
+path id into a string for events whose pid it has been asked about.
+
+usage: python eventlog.py TEXTLOG BINARYLOG
+converts a fsewatcher text log to the binary format
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import sys
+import mmap
+import struct
+
+import stats
+from capture import EVENT_NAMES, parse_event_line, format_event_line
+
+MAGIC = 'WIEV'
+VERSION = 2
+HEADER = struct.Struct('<4sHH')
+RECORD = struct.Struct('<iHHQI')
+FIELDS = 5
+LENGTH = struct.Struct('<I')
+FOOTER = struct.Struct('<QI4s')
+BATCH = 4096
+NO_PID = -1
+
+event_codes = dict([(name, i) for i, name in enumerate(EVENT_NAMES)])
+
+class TextLog(object):
+    """writes events as fsewatcher log lines"""
+    def __init__(self, handle):
+        self.handle = handle
+        self.name = handle.name
+
+    def write(self, pid, event, path, inode=None):
+        self.handle.write(format_event_line(pid, event, path))
+
+    def close(self):
+        self.handle.close()
+
+class BinaryLog(object):
+    """writes events as binary records, the path table is written by close()"""
+    def __init__(self, handle):
+        self.handle = handle
+        self.name = handle.name
+        self.ids = {}
+        self.paths = []
+        handle.write(HEADER.pack(MAGIC, VERSION, 0))
+
+    def write(self, pid, event, path, inode=None):
+        path_id = self.ids.get(path)
+        if path_id is None:
+            path_id = self.ids[path] = len(self.paths)
+            self.paths.append(path)
+        if pid is None:
+            pid = NO_PID
+        self.handle.write(RECORD.pack(pid, event_codes[event], 0, inode or 0, path_id))
+
+    def close(self):
+        offset = self.handle.tell()
+        for path in self.paths:
+            self.handle.write(LENGTH.pack(len(path)) + path)
+        self.handle.write(FOOTER.pack(offset, len(self.paths), MAGIC))
+        self.handle.close()
+
+def open_log(path, format='text'):
+    if format == 'binary':
+        return BinaryLog(open(path, 'wb'))
+    return TextLog(open(path, 'w'))
+
+class BinaryLogReader(object):
+    """reads a binary log through mmap"""
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = size and mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) or ''
+        if self.map[:4] != MAGIC or self.map[-4:] != MAGIC:
+            raise ValueError('%s is not a complete binary event log' % path)
+        self.table, count, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        self.spans = [] # path id -> (offset, length)
+        offset = self.table
+        for i in xrange(count):
+            length = LENGTH.unpack_from(self.map, offset)[0]
+            offset += LENGTH.size
+            self.spans.append((offset, length))
+            offset += length
+        self.paths = {} # path id -> path, for the paths asked for
+
+    def batches(self):
+        """yields tuples of the fields of up to BATCH records at a time"""
+        data = self.map
+        offset = HEADER.size
+        end = self.table
+        batch = struct.Struct('<' + 'iHHQI' * BATCH)
+        while offset < end:
+            count = min(BATCH, (end - offset) // RECORD.size)
+            if count < BATCH:
+                batch = struct.Struct('<' + 'iHHQI' * count)
+            yield batch.unpack_from(data, offset)
+            offset += batch.size
+
+    def records(self, pids=None):
+        """yields (pid, code, inode, path id) for each event, only for pids
+        (and unknown pids) if given, without making any strings"""
+        for fields in self.batches():
+            stats.count('events scanned', len(fields) // FIELDS)
+            if pids is None:
+                matches = xrange(0, len(fields), FIELDS)
+            else:
+                matches = [i * FIELDS for i, pid in enumerate(fields[::FIELDS])
+                           if pid in pids or pid == NO_PID]
+            for i in matches:
+                yield fields[i], fields[i + 1], fields[i + 3], fields[i + 4]
+
+    def path(self, path_id):
+        path = self.paths.get(path_id)
+        if path is None:
+            offset, length = self.spans[path_id]
+            path = self.paths[path_id] = self.map[offset:offset + length]
+        return path
+
+    def events(self, pids=None):
+        """yields (pid, event, path, inode) tuples, only for pids if given"""
+        for pid, code, inode, path_id in self.records(pids):
+            if pid == NO_PID:
+                pid = None
+            yield pid, EVENT_NAMES[code], self.path(path_id), inode or None
+
+    def close(self):
+        if self.map:
+            self.map.close()
+        self.file.close()
+
+def is_binary(path):
+    f = open(path, 'rb')
+    magic = f.read(4)
+    f.close()
+    return magic == MAGIC
+
+def read_events(path, pids=None):
+    """yields (pid, event, path, inode) from a log in either format, only
+    for pids if given"""
+    if is_binary(path):
+        reader = BinaryLogReader(path)
+        try:
+            for event in reader.events(pids):
+                yield event
+        finally:
+            reader.close()
+    else:
+        for line in open(path):
+            event = parse_event_line(line)
+            if event and (pids is None or event[0] in pids or event[0] is None):
+                yield event
+
+def convert(text_path, binary_path):
+    """writes a binary copy of a fsewatcher text log"""
+    out = open_log(binary_path, 'binary')
+    for line in open(text_path):
+        event = parse_event_line(line)
+        if event:
+            out.write(*event)
+    out.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python eventlog.py TEXTLOG BINARYLOG')
+    convert(sys.argv[1], sys.argv[2])
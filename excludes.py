@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+excludes.py
+
+Matches paths against all of the radmind excludes at once.
+
+watchedinstall.py turns each radmind exclude into a regular expression
+that is searched for anywhere in the path. Most excludes start with a plain
+path, like x ./Library/Caches/* or x ./Users/*/Library/Caches/* - those
+are looked up a path component at a time in a tree of their plain parts,
+and only the few whose plain part matched are checked in full. Everything
+else is joined into a single regular expression, so a path costs one tree
+walk and one regex search however many excludes the command file brings in.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import re
+
+_special = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+def head(pattern):
+    """splits a pattern into the plain text it starts with and the rest,
+    the rest is empty for patterns that are just plain text"""
+    # searching for '.*abc.*' is the same as searching for 'abc'
+    while pattern.endswith('.*') and not pattern.endswith('\\.*'):
+        pattern = pattern[:-2]
+    while pattern.startswith('.*'):
+        pattern = pattern[2:]
+    text = pattern.replace('\\.', '\0')
+    m = _special.search(text)
+    if m:
+        end = m.start()
+        if m.group() in '?*+{':
+            # the last plain character is repeated or optional
+            end -= 1
+        return text[:end].replace('\0', '.'), pattern
+    return text.replace('\0', '.'), ''
+
+class ExcludeMatcher(object):
+    """Decides whether paths are left out of the output.
+
+    Once a path is excluded, everything below it is as well, so children of
+    an excluded directory are turned away with one set lookup."""
+
+    def __init__(self, patterns, english_only=False):
+        self.patterns = list(patterns)
+        self.english_only = english_only
+        self.tree = {}
+        others = []
+        for pattern in self.patterns:
+            text, rest = head(pattern)
+            if text.startswith('/'):
+                self._add_head(text.lower(), rest and re.compile(rest, re.I))
+            else:
+                others.append(pattern)
+        self.regex = None
+        if others:
+            self.regex = re.compile('|'.join(['(?:%s)' % p for p in others]), re.I)
+        self.lproj = re.compile(r'\.lproj')
+        self.english = re.compile(r'(English|en)\.lproj')
+        self.excluded_dirs = set() # paths excluded this run, see forget()
+
+    def forget(self):
+        """starts a new run, the daemon keeps a matcher for many and the
+        paths excluded by each would otherwise pile up"""
+        self.excluded_dirs = set()
+
+    def _add_head(self, text, regex):
+        # all but the last part must be whole path components,
+        # the last part only has to start a component
+        parts = text[1:].split('/')
+        node = self.tree
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        plain, regexes = node.get(None, ((), ()))
+        if regex:
+            regexes += ((parts[-1], regex),)
+        else:
+            plain += (parts[-1],)
+        node[None] = (plain, regexes)
+
+    def _in_tree(self, path):
+        components = path.lower().split('/')
+        starts = []
+        offset = 0
+        for component in components:
+            starts.append(offset)
+            offset += len(component) + 1
+        tree = self.tree
+        for start in xrange(1, len(components)):
+            node = tree
+            for component in components[start:]:
+                ends = node.get(None)
+                if ends:
+                    plain, regexes = ends
+                    if plain and component.startswith(plain):
+                        return True
+                    for prefix, regex in regexes:
+                        # the plain start matched, check the whole pattern from here
+                        if component.startswith(prefix) and regex.match(path, starts[start] - 1):
+                            return True
+                node = node.get(component)
+                if node is None:
+                    break
+        return False
+
+    def excluded(self, path):
+        """True if any radmind exclude matches path"""
+        if path.rpartition('/')[0] in self.excluded_dirs:
+            self.excluded_dirs.add(path)
+            return True
+        if (self.tree and self._in_tree(path)) or (self.regex and self.regex.search(path)):
+            self.excluded_dirs.add(path)
+            return True
+        return False
+
+    def path_ok(self, path):
+        if self.english_only:
+            if self.lproj.search(path) and not self.english.search(path):
+                return False
+        return not self.excluded(path)
+
+    def __len__(self):
+        return len(self.patterns)
@@ -16,10 +16,10 @@
  * Source released under the GNU GENERAL PUBLIC LICENSE (GPL) Version 2.0.
  * See http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt for details.
  *
- * Compile (Mac OS X 10.5.x only) as follows:
+ * Compile (Mac OS X) as follows, with the bsd directory of the xnu source
+ * for the running version, for sys/fsevents.h:
  *
- * gcc -I/path/to/xnu/bsd -Wall -o fslogger fslogger.c
- * gcc -I/Users/preston/UNIX/src/xnu-1228.7.58/bsd -o fsewatcher fsewatcher.c
+ * cc -I/path/to/xnu/bsd -Wall -o fsewatcher fsewatcher.c
  */
 
 #include <stdio.h>
@@ -141,6 +141,7 @@ main(int argc, char **argv)
     mode_t           va_mode;
     u_int32_t        va_type;
     u_int32_t        is_fse_arg_vnode = 0;
+    u_int32_t        dropped = 0; // the event stands in for some that were dropped
     char             fileModeString[11 + 1];
     int8_t           event_list[] = { // action to take for each event
                          FSE_REPORT,  // FSE_CREATE_FILE,
@@ -216,8 +217,12 @@ main(int argc, char **argv)
             off += sizeof(int32_t) + sizeof(pid_t); // type + pid
 
             if (kfse->type == FSE_EVENTS_DROPPED) { // special event
-                fprintf(stderr, "  %-14s = %s\n", "type", "EVENTS DROPPED");
-                exit(1);
+                // passed on as an event of its own, for the whole volume,
+                // so the paths changed meanwhile can be looked for again
+                printf("-1\tfsewatcher\tFSE_EVENTS_DROPPED\t/\n");
+                fflush(stdout);
+                off += sizeof(u_int16_t); // its FSE_ARG_DONE
+                continue;
             }
 
             int32_t atype = kfse->type & FSE_TYPE_MASK;
@@ -225,14 +230,10 @@ main(int argc, char **argv)
 
             if ((atype < FSE_MAX_EVENTS) && (atype >= -1)) {
 
-                if (aflags & FSE_COMBINED_EVENTS) {
-                    fprintf(stderr,"%s", ", combined events");
-                    exit(1);
-                }
-                if (aflags & FSE_CONTAINS_DROPPED_EVENTS) {
-                    fprintf(stderr,"%s", ", contains dropped events");
-                    exit(1);
-                }
+                // combined events are passed on as the event they are
+                // reported as; one that stands in for dropped events is
+                // followed by a marker with its path, below
+                dropped = aflags & FSE_CONTAINS_DROPPED_EVENTS;
             } else { // should never happen
                 printf("This may be a program bug (type = %d).\n", atype);
                 exit(1);
@@ -272,11 +273,19 @@ main(int argc, char **argv)
                         printf("%d\t%s\t%s\t%s\n", kfse->pid, get_proc_name(kfse->pid), kfseNames[atype], currentpath);
                     }
                     strcpy (lastpath,currentpath);
+                    if (dropped) {
+                        printf("-1\tfsewatcher\tFSE_EVENTS_DROPPED\t%s\n", currentpath);
+                        fflush(stdout);
+                        dropped = 0;
+                    }
                 }
 
                 kea = (kfs_event_arg_t *)((char *)kea + eoff); // next
             } // for each argument
         } // for each event
+        // what the kernel handed over is out before waiting on it again, so
+        // a reader of the pipe is not left behind by the buffer
+        fflush(stdout);
     } // forever
 
     close(clonefd);
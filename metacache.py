@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+metacache.py
+
+What is on disk at the paths an install touched, looked up once per path
+and shared by everything that dispatches or stages them.
+
+Each path gets a single lstat. Whether it exists, its file type, where a
+symbolic link points and which extended attributes it has are all worked
+out from that and cached, rather than asked of the file system again by
+each caller.
+
+When the paths to look up are known ahead, prime() takes them all, and
+directories that hold several of them are listed once, with scandir where
+the scandir module is installed, so paths that are gone - temporary files,
+things renamed away - are known missing without a failed lstat each.
+walk() goes through a whole directory tree the same way, listing each
+directory once, for directories that are new in their entirety.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import stat
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        # directories are listed with os.listdir
+        scandir = None
+
+# the xattr module, imported the first time extended attributes are asked
+# for, False when it is not installed
+xattr = None
+
+def _xattr():
+    global xattr
+    if xattr is None:
+        try:
+            import xattr as module
+        except ImportError:
+            module = False
+        xattr = module
+    return xattr
+
+# paths wanted in a directory before it is listed rather than each path
+# looked up on its own. A listing costs more than an lstat on a local disk,
+# so it only pays where many of a directory's entries are wanted
+BATCH = 32
+
+MISSING = None
+UNKNOWN = object()
+
+class MetadataCache(object):
+    def __init__(self):
+        self.info = {}     # path -> lstat result, or MISSING
+        self.followed = {} # path of a symbolic link -> stat of what it points to, or MISSING
+        self.links = {}    # path of a symbolic link -> its target
+        self.attrs = {}    # path -> names of its extended attributes
+        self.listed = 0    # directories listed
+        self.lookups = 0   # paths looked up one at a time
+
+    def prime(self, paths):
+        """looks up paths ahead, a directory at a time where several of them
+        are in one directory"""
+        directories = {}
+        info = self.info
+        for path in paths:
+            if path not in info:
+                directory, slash, name = path.rpartition('/')
+                names = directories.get(directory)
+                if names is None:
+                    names = directories[directory] = set()
+                names.add(name)
+        for directory, names in directories.iteritems():
+            if len(names) >= BATCH:
+                self._list(directory or '/', names)
+
+    def _list(self, directory, names):
+        entries = {}
+        try:
+            if scandir is not None:
+                present = []
+                for entry in scandir(directory):
+                    present.append(entry.name)
+                    if entry.name in names:
+                        entries[entry.name] = entry
+            else:
+                present = os.listdir(directory)
+        except OSError:
+            return # looked up one path at a time instead
+        self.listed += 1
+        present = set(present)
+        folded = None
+        for name in names:
+            path = directory.rstrip('/') + '/' + name
+            if name in entries:
+                try:
+                    self.info[path] = entries[name].stat(follow_symlinks=False)
+                except OSError:
+                    self.info[path] = MISSING
+            elif name not in present:
+                # on a case insensitive volume the name can be there in
+                # another case, it is only known missing when no case matches
+                if folded is None:
+                    folded = set([n.lower() for n in present])
+                if name.lower() not in folded:
+                    self.info[path] = MISSING
+
+    def walk(self, root, descend=None):
+        """the paths under the directory root, top down, with each directory
+        listed once and the lstat of everything in it kept. Directories
+        descend turns down are not gone into"""
+        stack = [root.rstrip('/') or '/']
+        while stack:
+            directory = stack.pop()
+            prefix = directory.rstrip('/') + '/'
+            try:
+                if scandir is not None:
+                    entries = [(entry.name, entry) for entry in scandir(directory)]
+                else:
+                    entries = [(name, None) for name in os.listdir(directory)]
+            except OSError:
+                continue # gone, or not a directory
+            self.listed += 1
+            subdirectories = []
+            for name, entry in sorted(entries):
+                path = prefix + name
+                try:
+                    if entry is not None:
+                        info = entry.stat(follow_symlinks=False)
+                    else:
+                        info = os.lstat(path)
+                except OSError:
+                    continue # gone since it was listed
+                self.info[path] = info
+                yield path
+                if stat.S_ISDIR(info.st_mode) and (descend is None or descend(path)):
+                    subdirectories.append(path)
+            # popped in name order
+            stack.extend(reversed(subdirectories))
+
+    def lstat(self, path):
+        """the lstat of path, or None when nothing is there"""
+        info = self.info.get(path, UNKNOWN)
+        if info is not UNKNOWN:
+            return info
+        self.lookups += 1
+        try:
+            info = os.lstat(path)
+        except OSError:
+            info = MISSING
+        self.info[path] = info
+        return info
+
+    def stat(self, path):
+        """the stat of path, following a symbolic link, or None"""
+        info = self.lstat(path)
+        if info is MISSING or not stat.S_ISLNK(info.st_mode):
+            return info
+        target = self.followed.get(path, UNKNOWN)
+        if target is not UNKNOWN:
+            return target
+        self.lookups += 1
+        try:
+            target = os.stat(path)
+        except OSError:
+            target = MISSING
+        self.followed[path] = target
+        return target
+
+    def lexists(self, path):
+        return self.lstat(path) is not MISSING
+
+    def exists(self, path):
+        return self.stat(path) is not MISSING
+
+    def isfile(self, path):
+        info = self.stat(path)
+        return info is not MISSING and stat.S_ISREG(info.st_mode)
+
+    def isdir(self, path):
+        """True for a directory, not for a link to one"""
+        info = self.lstat(path)
+        return info is not MISSING and stat.S_ISDIR(info.st_mode)
+
+    def readlink(self, path):
+        try:
+            return self.links[path]
+        except KeyError:
+            target = self.links[path] = os.readlink(path)
+            return target
+
+    def xattrs(self, path):
+        """the names of the extended attributes of path, none without the
+        xattr module or when they can't be read"""
+        try:
+            return self.attrs[path]
+        except KeyError:
+            pass
+        names = []
+        if _xattr():
+            try:
+                names = xattr.xattr(path).list()
+            except (IOError, OSError):
+                pass
+        self.attrs[path] = names
+        return names
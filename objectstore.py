@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+objectstore.py
+
+A store of the files staged for packages, kept between runs, so that a
+file staged for one package - a framework, a font, a localisation - is not
+copied again for the next package, or the next version of the same one.
+
+Each file is kept once, named by the sha1 of its data together with its
+mode, owner, group, modification time and extended attributes. A hard link
+shares all of those, so a file is staged by linking its object into the
+package root; files with the same data and different metadata are separate
+objects. The sha1 of an installed file is looked up in the -P checksum
+cache by its device, inode, size and modification time before it is read.
+
+Objects are made by copying into a temporary file in the store, which is
+then renamed into place, so runs sharing a store do not see half copied
+objects. Linking an object changes its ctime, which is when it was last
+used. When the store is over its size cap at close(), the objects used
+longest ago are removed until it is under; objects still linked into a
+package root only go from the store, not from the root.
+
+Objects keep the owners and modes of installed files, set user id ones
+among them, and are linked into packages as they are, so the store is
+only used when it is a directory of the user running watchedinstall.py
+that no one else can get into, mode 0700.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import stat
+import errno
+import base64
+import hashlib
+import binascii
+import threading
+try:
+    import xattr
+except ImportError:
+    # objects are told apart by data and stat fields only
+    xattr = None
+
+from pyfsdiff import ChecksumCache, hash_file, radmind_cksum
+
+class StoreError(Exception):
+    pass
+
+def private_directory(path):
+    """makes the directory path, mode 0700, or checks that the one there
+    is a directory of ours no one else can get into"""
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent, 0700)
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise StoreError('can not make the store %s: %s' % (path, e.strerror))
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise StoreError('the store %s is not a directory' % path)
+    if info.st_uid != os.geteuid() or stat.S_IMODE(info.st_mode) & 077:
+        raise StoreError('the store %s must belong to user %d with mode 0700' % (path, os.geteuid()))
+
+class ObjectStore(object):
+    """The objects under root, at most size bytes of them after close()
+    when size is given. cache_file is the -P checksum cache to look up
+    and keep the sha1 of installed files in."""
+
+    def __init__(self, root, size=None, cache_file=None):
+        self.root = root
+        self.size = size
+        self.objects = os.path.join(root, 'objects')
+        self.tmp = os.path.join(root, 'tmp')
+        for directory in (root, self.objects, self.tmp):
+            private_directory(directory)
+        self.cache = ChecksumCache(cache_file)
+        self.used = set() # names of objects linked this run
+        self.hits = 0 # files staged from an object already there
+        self.stored = 0 # objects added
+        self.evicted = 0
+        self.bytes_hashed = 0
+        self.lock = threading.Lock()
+        self.count = 0 # temporary files made
+
+    def name(self, path, info):
+        """the name of the object for the file at path, with lstat info"""
+        key = self.cache.key('f', info)
+        cksum = self.cache.get(key)
+        if not cksum:
+            cksum = radmind_cksum(hash_file(path))
+            self.lock.acquire()
+            try:
+                self.cache.put(key, cksum)
+                self.bytes_hashed += info.st_size
+            finally:
+                self.lock.release()
+        name = '%s-%o-%d-%d-%r' % (binascii.hexlify(base64.b64decode(cksum)), info.st_mode,
+                                   info.st_uid, info.st_gid, info.st_mtime)
+        attrs = self.attrs(path)
+        if attrs:
+            name += '-' + attrs
+        return name
+
+    def attrs(self, path):
+        """a sha1 of the extended attributes of path, '' without any"""
+        if xattr is None:
+            return ''
+        try:
+            attrs = xattr.xattr(path)
+            names = sorted(attrs.list())
+            if not names:
+                return ''
+            digest = hashlib.sha1()
+            for name in names:
+                value = attrs.get(name)
+                digest.update('%s\0%d\0%s' % (name, len(value), value))
+        except (IOError, OSError, KeyError):
+            return ''
+        return digest.hexdigest()
+
+    def path(self, name):
+        return os.path.join(self.objects, name[:2], name)
+
+    def link(self, name, target):
+        """links the object name to target, False when it is not stored"""
+        try:
+            os.link(self.path(name), target)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        self.lock.acquire()
+        try:
+            self.used.add(name)
+        finally:
+            self.lock.release()
+        return True
+
+    def temporary(self):
+        """a path in the store to copy a new object to before put()"""
+        self.lock.acquire()
+        try:
+            self.count += 1
+            return os.path.join(self.tmp, '%d.%d' % (os.getpid(), self.count))
+        finally:
+            self.lock.release()
+
+    def put(self, name, temporary):
+        """makes the copied file temporary the object name"""
+        directory = os.path.dirname(self.path(name))
+        try:
+            os.mkdir(directory, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        # another run may have stored the same object meanwhile, the rename
+        # replaces it with a copy that is the same
+        os.rename(temporary, self.path(name))
+        self.lock.acquire()
+        try:
+            self.stored += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.cache.save()
+        if self.size is not None:
+            self.evict(self.size)
+
+    def evict(self, size):
+        """removes the objects used longest ago until the store holds at
+        most size bytes"""
+        objects = []
+        total = 0
+        for directory in os.listdir(self.objects):
+            directory = os.path.join(self.objects, directory)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                try:
+                    info = os.lstat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                total += info.st_size
+                objects.append((info.st_ctime, name, info.st_size))
+        if total <= size:
+            return
+        objects.sort()
+        for ctime, name, object_size in objects:
+            if total <= size:
+                break
+            if name in self.used:
+                continue
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                continue
+            total -= object_size
+            self.evicted += 1
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+pathstate.py
+
+Keeps a few flags for every path an install touches, in far less memory
+than dictionaries of path strings.
+
+Each distinct path component is stored once, as bytes in one big buffer,
+and a path is a node of a tree: the id of its parent node and the id of its
+last component, kept in arrays, with its flags in a bytearray. Both are
+found through open addressing hash tables that are arrays of ids, so there
+is no python object per path at all. Paths in the same directory tend to
+come one after another, so a small cache of recent directories saves
+walking down the tree for most lookups.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+from array import array
+
+EMPTY = -1
+DIR_CACHE_SIZE = 1024
+
+class StringTable(object):
+    """Interns strings, each is given an id and stored once"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('I')
+        self.lengths = array('I')
+        self.hashes = array('l')
+        self.slots = array('i', [EMPTY]) * 8
+        self.mask = 7
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        offset = self.offsets[i]
+        return str(self.data[offset:offset + self.lengths[i]])
+
+    def find(self, s, add=False):
+        """the id of s, or EMPTY if it is not stored and add is not set"""
+        slots = self.slots
+        hashes = self.hashes
+        mask = self.mask
+        hs = hash(s)
+        h = hs & mask
+        while True:
+            i = slots[h]
+            if i == EMPTY:
+                break
+            if hashes[i] == hs and self.lengths[i] == len(s):
+                offset = self.offsets[i]
+                if self.data[offset:offset + len(s)] == s:
+                    return i
+            h = (h + 1) & mask
+        if not add:
+            return EMPTY
+        i = len(self.offsets)
+        self.offsets.append(len(self.data))
+        self.lengths.append(len(s))
+        hashes.append(hs)
+        self.data.extend(s)
+        slots[h] = i
+        if len(hashes) * 2 > mask:
+            self._grow()
+        return i
+
+    def _grow(self):
+        mask = self.mask * 2 + 1
+        slots = array('i', [EMPTY]) * (mask + 1)
+        for i, hs in enumerate(self.hashes):
+            h = hs & mask
+            while slots[h] != EMPTY:
+                h = (h + 1) & mask
+            slots[h] = i
+        self.slots = slots
+        self.mask = mask
+
+class PathStateStore(object):
+    """Flags for paths, set with set() and read with get().
+
+    Every lookup is a few hash probes, however many paths are stored."""
+
+    def __init__(self):
+        self.names = StringTable()
+        self.parent = array('i')
+        self.name = array('i')
+        self.flags = bytearray()
+        self.slots = array('i', [EMPTY]) * 8
+        self.mask = 7
+        self.dirs = {} # recently used directory -> node
+        # the scanner looks at the same path several times running
+        self.last_path = None
+        self.last_node = EMPTY
+
+    def __len__(self):
+        return len(self.parent)
+
+    def _child(self, parent, name_id, add):
+        slots = self.slots
+        names = self.name
+        parents = self.parent
+        mask = self.mask
+        h = hash((parent, name_id)) & mask
+        while True:
+            node = slots[h]
+            if node == EMPTY:
+                break
+            if names[node] == name_id and parents[node] == parent:
+                return node
+            h = (h + 1) & mask
+        if not add:
+            return EMPTY
+        node = len(self.parent)
+        self.parent.append(parent)
+        self.name.append(name_id)
+        self.flags.append(0)
+        slots[h] = node
+        if len(self.parent) * 2 > mask:
+            self._grow()
+        return node
+
+    def _grow(self):
+        mask = self.mask * 2 + 1
+        slots = array('i', [EMPTY]) * (mask + 1)
+        parent = self.parent
+        name = self.name
+        for node in xrange(len(parent)):
+            h = hash((parent[node], name[node])) & mask
+            while slots[h] != EMPTY:
+                h = (h + 1) & mask
+            slots[h] = node
+        self.slots = slots
+        self.mask = mask
+
+    def node(self, path, add=False):
+        """the node for path, or EMPTY if it is not stored and add is not set.
+        Flags of a node can be read and set in self.flags directly"""
+        if path == self.last_path:
+            return self.last_node
+        node = self._node(path, add)
+        if node != EMPTY:
+            self.last_path = path
+            self.last_node = node
+        return node
+
+    def _node(self, path, add=False):
+        directory, sep, base = path.rpartition('/')
+        if not sep:
+            parent = EMPTY
+        else:
+            parent = self.dirs.get(directory)
+            if parent is None:
+                parent = self._node(directory, add)
+                if parent == EMPTY:
+                    return EMPTY
+                if len(self.dirs) >= DIR_CACHE_SIZE:
+                    self.dirs.clear()
+                self.dirs[directory] = parent
+        name_id = self.names.find(base, add)
+        if name_id == EMPTY:
+            return EMPTY
+        return self._child(parent, name_id, add)
+
+    def get(self, path):
+        """the flags set for path, 0 for paths never seen"""
+        node = self.node(path)
+        if node == EMPTY:
+            return 0
+        return self.flags[node]
+
+    def set(self, path, flag):
+        node = self.node(path, True)
+        self.flags[node] |= flag
+        return node
+
+    def clear(self, path, flag):
+        node = self.node(path)
+        if node != EMPTY:
+            self.flags[node] &= ~flag & 0xff
+
+    def path(self, node):
+        """the path a node stands for"""
+        parts = []
+        while node != EMPTY:
+            parts.append(self.names[self.name[node]])
+            node = self.parent[node]
+        parts.reverse()
+        return '/'.join(parts)
+
+    def nodes(self, flag):
+        """nodes that have flag set, in the order they were first seen"""
+        flags = self.flags
+        for node in xrange(len(flags)):
+            if flags[node] & flag:
+                yield node
+
+    def paths(self, flag):
+        """paths that have flag set, in the order they were first seen"""
+        for node in self.nodes(flag):
+            yield self.path(node)
+
+    def count(self, flag):
+        return sum(1 for node in self.nodes(flag))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+prefilter.py
+
+Picks the installer's events out of a large fsewatcher text log on several
+processes at once.
+
+The log is cut into chunks of a few megabytes, ending at line boundaries,
+and each chunk is filtered by pid in a pool of worker processes. Only the
+surviving lines come back, in the order of the log, so the scanner sees the
+same sequence of events it would have seen reading the log itself.
+
+Events are not dropped for matching a radmind exclude here: the scanner
+takes the two halves of a rename from events that come one after the
+other, so taking away the event of an excluded source or destination
+would pair the other half with something else, or leave it unpaired.
+Excludes are applied as paths are dispatched, as before.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import itertools
+from multiprocessing import Pool
+
+import stats
+from capture import parse_event_line
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+def chunk_ranges(path, chunk_size=CHUNK_SIZE):
+    """(start, end) byte ranges of path, each ending just after a newline"""
+    size = os.path.getsize(path)
+    f = open(path, 'rb')
+    try:
+        start = 0
+        while start < size:
+            end = start + chunk_size
+            if end >= size:
+                end = size
+            else:
+                f.seek(end)
+                f.readline() # run on to the end of the line
+                end = f.tell()
+            yield start, end
+            start = end
+    finally:
+        f.close()
+
+# set up in each worker by _init
+_pids = None
+
+def _init(pids):
+    global _pids
+    # pids are compared as the text at the start of each line,
+    # -1 is written for events whose pid is not known
+    _pids = frozenset([str(pid) for pid in pids] + ['-1'])
+
+def _filter(args):
+    """the number of lines in one chunk, and the lines made by the pids
+    joined back together"""
+    path, start, end = args
+    f = open(path, 'rb')
+    try:
+        f.seek(start)
+        data = f.read(end - start)
+    finally:
+        f.close()
+    pids = _pids
+    lines = data.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    total = len(lines)
+    lines = [line for line in lines if line.partition('\t')[0] in pids]
+    return total, '\n'.join(lines)
+
+def filter_log(path, pids, jobs=1, progress=None, chunk_size=CHUNK_SIZE):
+    """yields (pid, event, path, inode) for the events of pids, in log order.
+
+    progress, if given, is called with the number of bytes done after
+    each chunk."""
+    ranges = [(path, start, end) for start, end in chunk_ranges(path, chunk_size)]
+    pool = None
+    if jobs > 1 and len(ranges) > 1:
+        pool = Pool(min(jobs, len(ranges)), _init, (list(pids),))
+        results = pool.imap(_filter, ranges)
+    else:
+        _init(list(pids))
+        results = itertools.imap(_filter, ranges)
+    try:
+        for (p, start, end), (total, lines) in itertools.izip(ranges, results):
+            stats.count('events scanned', total)
+            for line in lines.split('\n'):
+                event = parse_event_line(line)
+                if event:
+                    yield event
+            if progress:
+                progress(end)
+    finally:
+        if pool:
+            pool.terminate()
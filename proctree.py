@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+proctree.py
+
+Keeps track of the installer and every process descended from it while the
+install runs.
+
+Processes are reported as (pid, parent pid) pairs by whichever backend is
+watching: the execsnoop log on OS X, or the kernel's process events
+connector on Linux, with a scan of /proc for anything already running.
+A process whose parent is not known yet is remembered, and is counted in as
+soon as its parent turns out to be part of the install, so the order
+processes are reported in does not matter.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import socket
+import struct
+import threading
+
+class ProcessTree(object):
+    """The parent -> child graph of processes seen, and which of them descend
+    from an install root. pid in tree is a dictionary lookup."""
+
+    def __init__(self):
+        self.parent = {}   # pid -> parent pid
+        self.children = {} # pid -> set of child pids
+        self.roots = {}    # pid of the install or one of its descendants -> root pid
+        self.exited = set()
+        self.lock = threading.RLock()
+
+    def add_root(self, pid):
+        """starts tracking pid and everything it spawns"""
+        self.lock.acquire()
+        try:
+            self._track(pid, pid)
+        finally:
+            self.lock.release()
+
+    def add(self, pid, ppid):
+        """records that ppid spawned pid"""
+        self.lock.acquire()
+        try:
+            old = self.parent.get(pid)
+            if old is not None and old != ppid and pid in self.exited:
+                # the pid has been reused by an unrelated process
+                self._forget(pid)
+            self.parent[pid] = ppid
+            self.children.setdefault(ppid, set()).add(pid)
+            root = self.roots.get(ppid)
+            if root is not None and pid not in self.roots:
+                self._track(pid, root)
+        finally:
+            self.lock.release()
+
+    def exit(self, pid):
+        """records that pid exited, its events so far still count"""
+        self.exited.add(pid)
+
+    def _track(self, pid, root):
+        stack = [pid]
+        while stack:
+            pid = stack.pop()
+            if pid in self.roots:
+                continue
+            self.roots[pid] = root
+            stack.extend(self.children.get(pid, ()))
+
+    def _forget(self, pid):
+        self.exited.discard(pid)
+        if self.roots.get(pid) != pid:
+            self.roots.pop(pid, None)
+        old = self.parent.pop(pid, None)
+        if old in self.children:
+            self.children[old].discard(pid)
+        self.children.pop(pid, None)
+
+    def root(self, pid):
+        """the install root pid descends from, or None"""
+        return self.roots.get(pid)
+
+    def pids(self):
+        return sorted(self.roots)
+
+    def __contains__(self, pid):
+        return pid in self.roots
+
+    def __len__(self):
+        return len(self.roots)
+
+def feed_execsnoop(tree, lines):
+    """reads execsnoop output, 'UID PID PPID ARGS' after a header line"""
+    for i, line in enumerate(lines):
+        if i == 0:
+            continue # skip the header line
+        data = line.split()
+        if len(data) > 2 and data[1].isdigit() and data[2].isdigit():
+            tree.add(int(data[1]), int(data[2]))
+
+def scan_proc(tree):
+    """adds every process currently running, from /proc on Linux"""
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % name).read()
+        except IOError:
+            continue # already gone
+        # the command name can hold spaces and brackets, the fields after it can't
+        fields = stat[stat.rindex(')') + 2:].split()
+        tree.add(int(name), int(fields[1]))
+
+# the Linux process events connector
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+NLMSG_DONE = 3
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXIT = 0x80000000
+NLMSG_HEADER = struct.Struct('=IHHII')
+CN_HEADER = struct.Struct('=IIIIHH')
+EVENT_HEADER = struct.Struct('=IIQ')
+FORK_EVENT = struct.Struct('=IIII')
+EXIT_EVENT = struct.Struct('=II')
+
+class NetlinkWatcher(object):
+    """Feeds fork and exit events from the kernel into a ProcessTree, on a
+    thread of its own. Needs root."""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        # the kernel picks the port, one bound to the pid would still be held
+        # by an earlier watcher whose thread has not seen its close, under
+        # the daemon
+        self.sock.bind((0, CN_IDX_PROC))
+        self.port = self.sock.getsockname()[0]
+        self.thread = None
+        self.running = False
+
+    def _control(self, op):
+        payload = struct.pack('=I', op)
+        cn = CN_HEADER.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(payload), 0)
+        msg = cn + payload
+        self.sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(msg), NLMSG_DONE, 0, 0, self.port) + msg)
+
+    def start(self):
+        self._control(PROC_CN_MCAST_LISTEN)
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        offset = NLMSG_HEADER.size + CN_HEADER.size
+        while self.running:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] == errno.ENOBUFS:
+                    # events were lost, catch up from /proc
+                    scan_proc(self.tree)
+                    continue
+                break
+            if len(data) < offset + EVENT_HEADER.size:
+                continue
+            what = EVENT_HEADER.unpack_from(data, offset)[0]
+            body = offset + EVENT_HEADER.size
+            if what == PROC_EVENT_FORK:
+                parent_pid, parent_tgid, child_pid, child_tgid = FORK_EVENT.unpack_from(data, body)
+                if child_pid == child_tgid:
+                    # a new process rather than a new thread
+                    self.tree.add(child_tgid, parent_tgid)
+            elif what == PROC_EVENT_EXIT:
+                pid, tgid = EXIT_EVENT.unpack_from(data, body)
+                if pid == tgid:
+                    self.tree.exit(tgid)
+
+    def stop(self):
+        self.running = False
+        try:
+            self._control(PROC_CN_MCAST_IGNORE)
+        except socket.error:
+            pass
+        self.sock.close()
+
+def pidfd_open(pid):
+    """a Linux pidfd for pid, or None where there is no such thing"""
+    if not sys.platform.startswith('linux'):
+        return None
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.syscall(434, pid, 0) # pidfd_open
+    if fd < 0:
+        if ctypes.get_errno() == errno.ESRCH:
+            raise OSError(errno.ESRCH, os.strerror(errno.ESRCH))
+        return None
+    return fd
+
+def wait_exit(pid, timeout=None):
+    """waits for a process that is not our child to exit, by pidfd on Linux
+    or kqueue on OS X. Returns False if the timeout ran out first."""
+    try:
+        fd = pidfd_open(pid)
+    except OSError:
+        return True # already gone
+    if fd is not None:
+        try:
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+            if timeout is not None:
+                timeout = int(timeout * 1000)
+            return bool(poller.poll(timeout))
+        finally:
+            os.close(fd)
+    if hasattr(select, 'kqueue'):
+        kq = select.kqueue()
+        try:
+            try:
+                ev = select.kevent(pid, filter=select.KQ_FILTER_PROC,
+                                   flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                                   fflags=select.KQ_NOTE_EXIT)
+                return bool(kq.control([ev], 1, timeout))
+            except OSError, e:
+                if e.errno == errno.ESRCH:
+                    return True
+                raise
+        finally:
+            kq.close()
+    # nothing to be notified with, check on it now and then
+    deadline = timeout is not None and time.time() + timeout
+    while True:
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                return True
+        if deadline and time.time() > deadline:
+            return False
+        time.sleep(0.1)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+pyfsdiff.py
+
+A pure python version of the transcript lines radmind's fsdiff -1 writes,
+used by watchedinstall.py for the -P option.
+
+Checksums are worked out on a pool of threads and can be kept in a cache
+file between runs, keyed on the device, inode, size and modification time
+of the file, so capturing the same package again does not read every file
+a second time. Given a baseline.Baseline, the checksums of an earlier
+transcript are used for files whose other fields have not changed.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import sys
+import stat
+import mmap
+import errno
+import tempfile
+import hashlib
+import struct
+import base64
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    import xattr
+except ImportError:
+    # no Finder info or resource forks to look for
+    xattr = None
+
+from radmind import encode_path
+from metacache import MetadataCache
+
+READ_SIZE = 1024 * 1024
+MMAP_SIZE = 64 * 1024 * 1024 # files this big are hashed through mmap
+
+FINDERINFO = 'com.apple.FinderInfo'
+RESOURCEFORK = 'com.apple.ResourceFork'
+EMPTY_FINDERINFO = '\0' * 32
+
+# AppleSingle layout radmind checksums 'a' files with:
+# header, then Finder info, resource fork and data fork entries
+AS_MAGIC = 0x00051600
+AS_VERSION = 0x00020000
+AS_HEADERLEN = 26 + 3 * 12
+AS_FINFO, AS_RFORK, AS_DFORK = 9, 2, 1
+
+def as_header(rsrc_len, data_len):
+    """the AppleSingle header and entry table for a file"""
+    header = struct.pack('>II16sH', AS_MAGIC, AS_VERSION, '\0' * 16, 3)
+    offset = AS_HEADERLEN
+    for entry, length in ((AS_FINFO, 32), (AS_RFORK, rsrc_len), (AS_DFORK, data_len)):
+        header += struct.pack('>III', entry, offset, length)
+        offset += length
+    return header
+
+def hash_file(path, digest=None):
+    """sha1 of a file's data, read in large blocks"""
+    if digest is None:
+        digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_SIZE:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest.update(m)
+            finally:
+                m.close()
+        else:
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+    finally:
+        f.close()
+    return digest
+
+def radmind_cksum(digest):
+    """radmind writes checksums base64 encoded"""
+    return base64.b64encode(digest.digest())
+
+class ChecksumCache(object):
+    """Checksums from earlier runs, one 'key<tab>checksum' line each.
+
+    The file is only read when it belongs to the user running and no one
+    else can write to it, and not through a symbolic link. save() writes
+    it out again whole, through a temporary file renamed over it, keeping
+    only the latest checksum of each file."""
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.files = {} # device and inode of each file -> its latest key
+        self.new = {}
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                sys.stderr.write('not using the checksum cache %s: %s\n' % (self.path, e.strerror))
+            return
+        f = os.fdopen(fd)
+        try:
+            info = os.fstat(fd)
+            if (not stat.S_ISREG(info.st_mode) or info.st_uid != os.geteuid()
+                    or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+                sys.stderr.write('not using the checksum cache %s, it must be a file of user %d '
+                                 'only it can write to\n' % (self.path, os.geteuid()))
+                return
+            for line in f:
+                fields = line.split('\t')
+                if len(fields) == 2:
+                    self.entries[fields[0]] = fields[1].rstrip('\n')
+                    self.files[self.file(fields[0])] = fields[0]
+        finally:
+            f.close()
+
+    def key(self, kind, info):
+        return '%s:%d:%d:%d:%r' % (kind, info.st_dev, info.st_ino, info.st_size, info.st_mtime)
+
+    def file(self, key):
+        """the kind, device and inode part of a key"""
+        return key.rsplit(':', 2)[0]
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, cksum):
+        self.entries[key] = cksum
+        self.files[self.file(key)] = key
+        self.new[key] = cksum
+
+    def save(self):
+        if not self.path or not self.new:
+            return
+        d = os.path.dirname(self.path)
+        if d and not os.path.exists(d):
+            os.makedirs(d, 0700)
+        fd, temporary = tempfile.mkstemp(prefix='.%s.' % os.path.basename(self.path), dir=d or '.')
+        try:
+            out = os.fdopen(fd, 'w')
+            for key in self.files.itervalues():
+                out.write('%s\t%s\n' % (key, self.entries[key]))
+            out.close()
+            os.rename(temporary, self.path)
+        except (IOError, OSError), e:
+            sys.stderr.write('could not save the checksum cache %s: %s\n' % (self.path, e))
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+        self.new = {}
+
+class Fsdiff(object):
+    """Writes one radmind transcript line per path given to add().
+
+    Lines that need a checksum are held back until their hash is done, and
+    everything is written out in the order it was added by close()."""
+
+    def __init__(self, out, checksum=None, jobs=4, cache_file=None, meta=None, baseline=None):
+        if checksum not in (None, 'sha1'):
+            raise ValueError('only sha1 checksums are supported')
+        self.out = out
+        self.checksum = checksum
+        self.pool = None
+        if checksum:
+            self.pool = ThreadPool(max(1, jobs))
+        self.cache = ChecksumCache(cache_file)
+        # what is known of each path, shared with whoever else looks at them
+        self.meta = meta or MetadataCache()
+        self.baseline = baseline
+        self.linked = {} # (dev, inode) of hard linked files -> first path seen
+        self.pending = []
+        self.bytes_hashed = 0
+        self.lock = threading.Lock()
+
+    def add(self, path, transcript_path):
+        """transcript_path is how path should appear in the transcript"""
+        info = self.meta.lstat(path)
+        if info is None:
+            return # gone since the install
+        name = encode_path(transcript_path)
+        mode = stat.S_IFMT(info.st_mode)
+        perms = '%.4o' % stat.S_IMODE(info.st_mode)
+        owner = [perms, str(info.st_uid), str(info.st_gid)]
+        if mode == stat.S_IFREG:
+            if info.st_nlink > 1:
+                inode = (info.st_dev, info.st_ino)
+                if inode in self.linked:
+                    self.pending.append('h %s %s' % (name, self.linked[inode]))
+                    return
+                self.linked[inode] = name
+            finfo, rsrc_len = self.apple_info(path)
+            if finfo is not None:
+                kind = 'a'
+                size = AS_HEADERLEN + 32 + rsrc_len + info.st_size
+            else:
+                kind = 'f'
+                size = info.st_size
+            fields = [kind, name] + owner + [str(int(info.st_mtime)), str(size)]
+            cksum = None
+            if self.baseline is not None:
+                cksum = self.baseline.cksum(transcript_path, fields)
+            self.pending.append((fields, cksum or self.cksum(kind, path, info)))
+        elif mode == stat.S_IFDIR:
+            fields = ['d', name] + owner
+            finfo = self.finder_info(path)
+            if finfo and finfo != EMPTY_FINDERINFO:
+                fields.append(base64.b64encode(finfo))
+            self.pending.append(' '.join(fields))
+        elif mode == stat.S_IFLNK:
+            self.pending.append('l %s %s' % (name, encode_path(self.meta.readlink(path))))
+        elif mode in (stat.S_IFCHR, stat.S_IFBLK):
+            kind = mode == stat.S_IFCHR and 'c' or 'b'
+            fields = [kind, name] + owner + [str(os.major(info.st_rdev)), str(os.minor(info.st_rdev))]
+            self.pending.append(' '.join(fields))
+        elif mode == stat.S_IFIFO:
+            self.pending.append(' '.join(['p', name] + owner))
+        elif mode == stat.S_IFSOCK:
+            self.pending.append(' '.join(['s', name] + owner))
+
+    def finder_info(self, path):
+        if FINDERINFO not in self.meta.xattrs(path):
+            return None
+        try:
+            return xattr.xattr(path).get(FINDERINFO)
+        except (IOError, KeyError):
+            return None
+
+    def apple_info(self, path):
+        """(finder info, resource fork length) for files radmind writes as
+        applefiles, (None, 0) for plain files"""
+        names = self.meta.xattrs(path)
+        if FINDERINFO not in names and RESOURCEFORK not in names:
+            return None, 0
+        attrs = xattr.xattr(path)
+        finfo = None
+        rsrc_len = 0
+        if FINDERINFO in names:
+            finfo = attrs.get(FINDERINFO)
+        if RESOURCEFORK in names:
+            rsrc_len = len(attrs.get(RESOURCEFORK))
+        if (finfo is None or finfo == EMPTY_FINDERINFO) and not rsrc_len:
+            return None, 0
+        return finfo or EMPTY_FINDERINFO, rsrc_len
+
+    def cksum(self, kind, path, info):
+        """a checksum, or something that will produce one from get()"""
+        if not self.checksum:
+            return '-'
+        key = self.cache.key(kind, info)
+        cached = self.cache.get(key)
+        if cached:
+            return cached
+        return self.pool.apply_async(self._hash, (kind, path, info, key))
+
+    def _hash(self, kind, path, info, key):
+        try:
+            digest = self._digest(kind, path, info)
+        except (IOError, OSError):
+            # gone since it was looked at, left out of the transcript
+            return None
+        cksum = radmind_cksum(digest)
+        self.cache.put(key, cksum)
+        self.lock.acquire()
+        self.bytes_hashed += info.st_size
+        self.lock.release()
+        return cksum
+
+    def _digest(self, kind, path, info):
+        if kind == 'a':
+            attrs = xattr.xattr(path)
+            finfo = attrs.get(FINDERINFO) if FINDERINFO in attrs.list() else EMPTY_FINDERINFO
+            rsrc = attrs.get(RESOURCEFORK) if RESOURCEFORK in attrs.list() else ''
+            digest = hashlib.sha1(as_header(len(rsrc), info.st_size))
+            digest.update(finfo)
+            digest.update(rsrc)
+            hash_file(path, digest)
+        else:
+            digest = hash_file(path)
+        return digest
+
+    def close(self):
+        """writes out all lines, waiting on any checksums still being worked out"""
+        for item in self.pending:
+            if isinstance(item, tuple):
+                fields, cksum = item
+                if not isinstance(cksum, str):
+                    cksum = cksum.get()
+                    if cksum is None:
+                        continue
+                item = ' '.join(fields + [cksum])
+            self.out.write(item + '\n')
+        self.pending = []
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        self.cache.save()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+radmind.py
+
+Helpers for reading radmind command files and transcripts in process, so that
+watchedinstall.py does not have to run a radmind tool once for every path.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import re
+import threading
+from bisect import bisect_left
+from multiprocessing.pool import ThreadPool
+
+import stats
+
+_decodings = {'b': ' ', 't': '\t', 'n': '\n', 'r': '\r', '\\': '\\'}
+_escape_re = re.compile(r'\\(.)')
+
+def decode_path(path):
+    """undoes the radmind escaping of a transcript path"""
+    if '\\' not in path:
+        return path
+    return _escape_re.sub(lambda m: _decodings.get(m.group(1), m.group(1)), path)
+
+def encode_path(path):
+    """escapes a path the way radmind writes it in a transcript"""
+    return path.replace('\\','\\\\')\
+        .replace(' ','\\b')\
+        .replace('\t','\\t')\
+        .replace('\n','\\n')\
+        .replace('\r','\\r')
+
+def walk_command_file(path):
+    """yields (command file, fields) for every line of a command file,
+    descending into any k lines - comments and blank lines are skipped"""
+    for line in open(path):
+        fields = line.split()
+        if not fields or fields[0][0] == '#':
+            continue
+        yield path, fields
+        if fields[0] == 'k':
+            sub = os.path.join(os.path.dirname(path), fields[1])
+            for item in walk_command_file(sub):
+                yield item
+
+def command_files(path, transcripts=False):
+    """the command file path and those it takes in with k lines, and with
+    transcripts the transcripts they name too - the files whatever is read
+    from the command file was read from"""
+    files = [path]
+    for cf, fields in walk_command_file(path):
+        if fields[0] == 'k':
+            files.append(os.path.join(os.path.dirname(cf), fields[1]))
+        elif transcripts and fields[0] in ('p','n') and len(fields) > 1:
+            files.append(os.path.join(os.path.dirname(cf), fields[1]))
+    return files
+
+class TranscriptIndex(object):
+    """The transcripts of a command file tree, loaded once into a sorted list
+    of paths that can be bisected.
+
+    lookup() answers the question twhich is asked for each removed path: which
+    transcript line, if any, owns this path. Transcripts later in the command
+    file take precedence over earlier ones, as they do for twhich."""
+
+    def __init__(self, command_file, case_insensitive=False):
+        self.case_insensitive = case_insensitive
+        self.paths = []
+        self.lines = []
+        self.specials = set()
+        self.load(command_file)
+
+    def key(self, path):
+        path = path.lstrip('.')
+        if self.case_insensitive:
+            path = path.lower()
+        return path
+
+    def load(self, command_file):
+        transcripts = []
+        removed = set()
+        removed_specials = set()
+        for cf, fields in walk_command_file(command_file):
+            if fields[0] == '-':
+                # minus lines take an earlier transcript or special back out
+                if len(fields) < 3:
+                    continue
+                if fields[1] == 's':
+                    removed_specials.add(self.key(decode_path(fields[2])))
+                elif fields[1] in ('p','n'):
+                    removed.add(os.path.join(os.path.dirname(cf), fields[2]))
+            elif fields[0] in ('p','n'):
+                transcripts.append(os.path.join(os.path.dirname(cf), fields[1]))
+            elif fields[0] == 's':
+                self.specials.add(self.key(decode_path(fields[1])))
+        entries = {}
+        for t in transcripts:
+            if t in removed:
+                continue
+            for line in open(t):
+                if line[0] in ('#','\n'):
+                    continue
+                line = line.rstrip('\n')
+                if line[0] == '-':
+                    # a later transcript removing the path, no longer owned
+                    entries.pop(self.key(decode_path(line.split()[2])), None)
+                else:
+                    entries[self.key(decode_path(line.split()[1]))] = line
+        self.specials -= removed_specials
+        self.paths = sorted(entries)
+        self.lines = [entries[p] for p in self.paths]
+
+    def lookup(self, path):
+        """returns the owning transcript line for path, or None"""
+        key = self.key(path)
+        i = bisect_left(self.paths, key)
+        if i < len(self.paths) and self.paths[i] == key:
+            return self.lines[i]
+        return None
+
+    def children(self, path):
+        """the keys of the paths owned directly in the directory path, what
+        the transcripts say it holds"""
+        prefix = self.key(path).rstrip('/') + '/'
+        paths = self.paths
+        i = bisect_left(paths, prefix)
+        while i < len(paths) and paths[i].startswith(prefix):
+            child = paths[i]
+            if '/' in child[len(prefix):]:
+                # in a subdirectory, skip past the rest of it
+                child = prefix + child[len(prefix):].split('/', 1)[0]
+                i = bisect_left(paths, child + '0', i)
+                continue
+            yield child
+            i += 1
+
+    def is_special(self, path):
+        return self.key(path) in self.specials
+
+    def __contains__(self, path):
+        return self.lookup(path) is not None
+
+    def __len__(self):
+        return len(self.paths)
+
+class FsdiffPool(object):
+    """Runs radmind's own fsdiff -1 for many paths at once.
+
+    fsdiff -1 takes a single path, so there is still one fsdiff process per
+    path; what is saved is the waiting, as a fixed number of them run side
+    by side. Paths are grouped into batches to cut the hand offs to the
+    workers, each batch is run one path after another by one worker, and
+    the output of the batches is written out in the order the paths were
+    added, so the unsorted transcript comes out the same however many
+    workers there are.
+
+    A whole directory tree is given with add_tree(), and is run through a
+    single recursive fsdiff -C, the only case where one process covers
+    many paths."""
+
+    def __init__(self, out, command, jobs=4, batch_size=64):
+        self.out = out
+        self.command = command
+        # the same options, for a transcript of everything under a path
+        self.tree_command = [arg == '-1' and '-C' or arg for arg in command]
+        self.batch_size = max(1, batch_size)
+        self.pool = ThreadPool(max(1, jobs))
+        self.batch = []
+        self.running = []
+        self.runs = 0
+        self.lock = threading.Lock()
+
+    def add(self, path):
+        self.batch.append(path)
+        if len(self.batch) >= self.batch_size:
+            self._submit()
+
+    def add_tree(self, path, accept=None):
+        """adds path and everything under it, keeping only the transcript
+        lines accept() is true of, when given"""
+        self._submit()
+        self.running.append((self.pool.apply_async(self._run_tree, (path,)), accept))
+        self._write_ready()
+
+    def _submit(self):
+        if self.batch:
+            self.running.append((self.pool.apply_async(self._run, (self.batch,)), None))
+            self.batch = []
+        self._write_ready()
+
+    def _write_ready(self):
+        # write out whatever has finished, keeping the order
+        while self.running and self.running[0][0].ready():
+            self._write(*self.running.pop(0))
+
+    def _write(self, result, accept):
+        output = result.get()
+        if accept is not None:
+            # lines are checked here rather than in the workers, accept can
+            # count what it turns down
+            output = ''.join([line for line in output.splitlines(True) if accept(line)])
+        self.out.write(output)
+
+    def _run_tree(self, path):
+        output = stats.output(self.tree_command + [path])
+        self.lock.acquire()
+        self.runs += 1
+        self.lock.release()
+        return output
+
+    def _run(self, paths):
+        output = []
+        for path in paths:
+            output.append(stats.output(self.command + [path]))
+        self.lock.acquire()
+        self.runs += len(paths)
+        self.lock.release()
+        return ''.join(output)
+
+    def close(self):
+        self._submit()
+        for result, accept in self.running:
+            self._write(result, accept)
+        self.running = []
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+session.py
+
+Capture sessions: everything an install left behind that the transcript
+is made from, kept in a directory so the transcript can be made again
+later with --replay, without running the installer again.
+
+A session directory holds
+
+session.json    the target, the packages installed, the installers' process
+                tree and the options the install was run with
+events.log      the event log, or events.bin for a binary log
+pid_log.log     the execsnoop log, when there is one
+snapshot.bin    the directories of the target before the install, with
+                --snapshot, for finding changes where events were dropped
+filtered.bin    the installer's events alone, in the binary log format,
+                written the first time the event log is scanned
+
+Which events belong to the installer only depends on the process tree, so
+once filtered.bin is there a replay reads it instead of the whole event
+log. Excludes, --english-only and the output format are only applied after
+the scan, and can be changed from one replay to the next.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import json
+import time
+import shutil
+
+import eventlog
+
+VERSION = 1
+INFO = 'session.json'
+FILTERED = 'filtered.bin'
+SNAPSHOT = 'snapshot.bin'
+
+# options saved with a session, used by --replay unless given again
+SAVED_OPTIONS = ['format', 'english_only', 'command_file', 'case_insensitive',
+                 'comparison_path', 'checksum', 'pythondiff', 'installer_target', 'pid']
+
+class SessionError(Exception):
+    pass
+
+class Session(object):
+    def __init__(self, path, info):
+        self.path = path
+        self.info = info
+        self.log_path = self.file(info['log'])
+        self.options = info['options']
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def load_tree(self, tree):
+        """adds the saved process tree to a proctree.ProcessTree"""
+        for root in self.info['roots']:
+            tree.add_root(root)
+        for pid, ppid in self.info['parents']:
+            tree.add(pid, ppid)
+
+    def filtered(self, tree):
+        """the path of the installer's events, if they were saved for the
+        same processes as are in tree"""
+        if self.info.get('filtered_pids') == tree.pids() and os.path.exists(self.file(FILTERED)):
+            return self.file(FILTERED)
+        return None
+
+    def record_filtered(self):
+        """a binary log to write the installer's events to, kept with
+        save_filtered() once they are all written"""
+        return eventlog.open_log(self.file(FILTERED + '.part'), 'binary')
+
+    def save_filtered(self, log, tree):
+        log.close()
+        os.rename(self.file(FILTERED + '.part'), self.file(FILTERED))
+        self.info['filtered_pids'] = tree.pids()
+        self._write_info()
+
+    def _write_info(self):
+        out = open(self.file(INFO + '.part'), 'w')
+        json.dump(self.info, out, indent=2, sort_keys=True)
+        out.write('\n')
+        out.close()
+        os.rename(self.file(INFO + '.part'), self.file(INFO))
+
+def save(path, options, tree, installs, event_log, pid_log=None, snapshot=None, started=None):
+    """makes a session in the directory path from the logs of an install,
+    installs is a list of (root pid, package or None), started the time the
+    installers were started"""
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if not os.path.exists(event_log):
+        raise SessionError('no event log at %s to save' % event_log)
+    log = eventlog.is_binary(event_log) and 'events.bin' or 'events.log'
+    for name in ('events.bin', 'events.log', 'pid_log.log', FILTERED, SNAPSHOT):
+        if os.path.exists(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
+    # copied, not linked, as the next install writes over the logs in place
+    shutil.copyfile(event_log, os.path.join(path, log))
+    if pid_log and os.path.exists(pid_log):
+        shutil.copyfile(pid_log, os.path.join(path, 'pid_log.log'))
+    if snapshot and os.path.exists(snapshot):
+        shutil.copyfile(snapshot, os.path.join(path, SNAPSHOT))
+    saved = {}
+    for name in SAVED_OPTIONS:
+        saved[name] = getattr(options, name)
+    tree.lock.acquire()
+    try:
+        roots = sorted(set(tree.roots.values()))
+        parents = sorted([(pid, tree.parent[pid]) for pid in tree.roots if pid in tree.parent])
+    finally:
+        tree.lock.release()
+    info = {'version': VERSION,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'target': options.installer_target,
+            'log': log,
+            'roots': roots,
+            'installs': installs,
+            'parents': parents,
+            'pids': tree.pids(),
+            'started': started,
+            'options': saved}
+    session = Session(path, info)
+    session._write_info()
+    return session
+
+def load(path):
+    """the session saved in the directory path"""
+    path = os.path.abspath(path)
+    try:
+        info = json.load(open(os.path.join(path, INFO)))
+    except (IOError, ValueError), e:
+        raise SessionError('%s is not a capture session: %s' % (path, e))
+    if info.get('version') != VERSION:
+        raise SessionError('%s is a version %s session, only version %s can be read' % (path, info.get('version'), VERSION))
+    for name, value in info['options'].items():
+        if isinstance(value, unicode):
+            info['options'][name] = value.encode('utf-8')
+    info['target'] = info['target'].encode('utf-8')
+    info['log'] = info['log'].encode('utf-8')
+    info['installs'] = [(root, package and package.encode('utf-8')) for root, package in info['installs']]
+    session = Session(path, info)
+    if not os.path.exists(session.log_path):
+        raise SessionError('%s has no event log' % path)
+    return session
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+snapshot.py
+
+A record of the directories on the target volume taken just before the
+install, and the targeted rescans that use it to make up for events the
+kernel dropped.
+
+When the file system is busier than the watcher can keep up with, the
+kernel drops events and says so: fsewatcher and the Linux backends put an
+FSE_EVENTS_DROPPED marker into the event stream in their place. The scanner
+notes which directories the installer was working in around each marker,
+and once the install is done only those directories are looked at again.
+
+The snapshot holds the inode, size and modification time of every
+directory, nothing about files, written as fixed size records and a
+relative path each, in path order. A directory that is not in it was made
+during the install; one whose inode, size or mtime changed had entries
+added or removed. A rescan reports every entry changed since the snapshot
+(by its ctime), goes down into subdirectories that are new or changed, and
+lists the directories whose entries changed, so entries that went away can
+be looked for in the radmind transcripts.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import stat
+import time
+import struct
+try:
+    from scandir import walk
+except ImportError:
+    walk = os.walk
+
+MAGIC = 'WISN'
+VERSION = 1
+HEADER = struct.Struct('<4sHd') # magic, version, time taken
+RECORD = struct.Struct('<QQdH') # inode, size, mtime, length of the path that follows
+
+def relative(target, path):
+    """path as it is kept in a snapshot of target, '' for the target itself"""
+    if target == '/':
+        return path.lstrip('/')
+    return path[len(target):].lstrip('/')
+
+def take(target, path):
+    """writes a snapshot of the directories under target to path, staying
+    on the target's volume, returns the number of directories"""
+    out = open(path, 'wb')
+    out.write(HEADER.pack(MAGIC, VERSION, time.time()))
+    device = os.lstat(target).st_dev
+    count = 0
+    for dirpath, dirnames, filenames in walk(target):
+        try:
+            info = os.lstat(dirpath)
+        except OSError:
+            del dirnames[:]
+            continue
+        if info.st_dev != device:
+            del dirnames[:]
+            continue
+        # sorted so the snapshot comes out in path order
+        dirnames.sort()
+        name = relative(target, dirpath)
+        out.write(RECORD.pack(info.st_ino, info.st_size, info.st_mtime, len(name)) + name)
+        count += 1
+    out.close()
+    return count
+
+class Snapshot(object):
+    """reads a snapshot, keeping only the directories under some paths"""
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        magic, version, self.time = HEADER.unpack(f.read(HEADER.size))
+        f.close()
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a directory snapshot' % path)
+        self.dirs = {}
+
+    def load(self, prefixes):
+        """reads in the directories at or under the relative paths prefixes"""
+        prefixes = tuple([p and p + '/' or '' for p in prefixes])
+        exact = set([p.rstrip('/') for p in prefixes])
+        f = open(self.path, 'rb')
+        try:
+            f.seek(HEADER.size)
+            read = f.read
+            size = RECORD.size
+            while True:
+                record = read(size)
+                if len(record) < size:
+                    break
+                inode, dir_size, mtime, length = RECORD.unpack(record)
+                name = read(length)
+                if name in exact or name.startswith(prefixes):
+                    self.dirs[name] = (inode, dir_size, mtime)
+        finally:
+            f.close()
+
+    def get(self, name):
+        """(inode, size, mtime) of a directory when the snapshot was taken,
+        None if it was not there"""
+        return self.dirs.get(name)
+
+def rescan(target, directories, since, snapshot=None):
+    """looks again at directories, absolute paths under target, after events
+    were dropped. Returns the paths changed since the time since, and the
+    directories whose entries were added to or removed from.
+
+    Without a snapshot only subdirectories changed since the time since are
+    gone down into, and no directory is known to have lost entries."""
+    # timestamps on some volumes only go to the second
+    since = int(since)
+    roots = []
+    for directory in sorted(set(directories)):
+        if roots and directory.startswith(roots[-1].rstrip('/') + '/'):
+            continue # under one already being looked at
+        roots.append(directory)
+    if snapshot is not None:
+        snapshot.load([relative(target, root) for root in roots])
+    changed = []
+    changed_dirs = []
+    stack = list(roots)
+    seen = set()
+    while stack:
+        directory = stack.pop()
+        if directory in seen:
+            continue
+        seen.add(directory)
+        try:
+            info = os.lstat(directory)
+            names = os.listdir(directory)
+        except OSError:
+            continue # gone, its removal was not dropped or its parent shows it
+        new = info.st_ctime >= since
+        if snapshot is not None:
+            known = snapshot.get(relative(target, directory))
+            if known is None:
+                new = True # made during the install
+            elif known != (info.st_ino, info.st_size, info.st_mtime):
+                changed_dirs.append(directory)
+        if new:
+            changed.append(directory)
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                entry = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(entry.st_mode) and entry.st_dev == info.st_dev:
+                # reported when it is listed, if it changed
+                if entry.st_ctime >= since:
+                    stack.append(path)
+                elif snapshot is not None:
+                    known = snapshot.get(relative(target, path))
+                    if known != (entry.st_ino, entry.st_size, entry.st_mtime):
+                        stack.append(path)
+            elif entry.st_ctime >= since:
+                changed.append(path)
+    return changed, changed_dirs
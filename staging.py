@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+staging.py
+
+Copies the files an install made into a package root for PackageMaker,
+in place of running ditto once for every file.
+
+The directories the files live in are made once, up front, and the files
+are then copied on a pool of threads. Each file is copied the cheapest way
+the file systems allow, falling back to the next way when one is not
+supported:
+
+clone       copyfile(3) with COPYFILE_CLONE on OS X, which clones on APFS
+            and copies data, permissions, times and extended attributes
+            otherwise; the FICLONE ioctl (a reflink) on Linux
+link        a hard link to the installed file, only when asked for, as the
+            staged file is then the installed file
+kernel      copy_file_range(2), then sendfile(2), on Linux, which copy in
+            the kernel without the data passing through this process
+read        plain reads and writes in large blocks
+
+Staged files and directories get the mode, owner, times and, where the
+xattr module is installed, extended attributes of the originals. Symbolic
+links are staged as links, as ditto does.
+
+Given an objectstore.ObjectStore, files are hard linked from it instead,
+and only copied, into the store, the first time it is given them. Where
+the store can't be linked from, on another volume, files are copied as
+above.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import sys
+import stat
+import errno
+import fcntl
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    import xattr
+except ImportError:
+    # extended attributes are not copied, except by copyfile(3) on OS X
+    xattr = None
+
+import stats
+from metacache import MetadataCache
+
+COPY_SIZE = 1024 * 1024 # bytes read and written at a time by the read fallback
+KERNEL_CHUNK = 1024 * 1024 * 1024 # bytes asked of copy_file_range or sendfile at a time
+
+FICLONE = 0x40049409
+
+# copyfile(3) flags
+COPYFILE_ALL = 0xf # acl, stat, xattr and data
+COPYFILE_CLONE = 1 << 24
+
+# errors that mean a way of copying is not supported here, rather than
+# that the copy went wrong
+UNSUPPORTED = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EPERM,
+                   errno.EOPNOTSUPP, errno.ENOTTY])
+
+def _libc():
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    for name in ('copy_file_range', 'sendfile'):
+        function = getattr(libc, name, None)
+        if function is not None:
+            function.restype = ctypes.c_ssize_t
+    if hasattr(libc, 'copy_file_range'):
+        libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                         ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    if sys.platform.startswith('linux') and hasattr(libc, 'sendfile'):
+        libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    if hasattr(libc, 'copyfile'):
+        libc.copyfile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_uint32]
+    return ctypes, libc
+
+class Stager(object):
+    """Stages files under root, at the same path they have from /.
+
+    Paths are given with add() and copied with close(). With link, files
+    are hard linked rather than copied where root is on the same file
+    system; the installed files must then be left alone until the package
+    is built. meta is a metacache.MetadataCache the paths may already have
+    been looked up in. Files are staged from store, when given, unless they
+    are linked."""
+
+    def __init__(self, root, jobs=4, link=False, meta=None, store=None):
+        self.root = root
+        self.jobs = max(1, jobs)
+        self.link = link
+        self.meta = meta or MetadataCache()
+        self.store = store
+        self.files = [] # (path, lstat)
+        self.directories = set()
+        self.bytes_copied = 0
+        self.methods = {} # way of copying -> files copied that way
+        self.lock = threading.Lock()
+        self.ctypes, self.libc = _libc()
+        # ways of copying found not to work here, not tried again
+        self.unsupported = set()
+        if sys.platform == 'darwin':
+            self.unsupported.update(['reflink', 'copy_file_range', 'sendfile'])
+        else:
+            self.unsupported.add('copyfile')
+        if not link:
+            self.unsupported.add('link')
+        if link or store is None:
+            self.unsupported.add('store')
+
+    def target(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def add(self, path):
+        """stages path if it is a file, or a link to a file"""
+        path = os.path.abspath(path)
+        info = self.meta.lstat(path)
+        if info is None:
+            return
+        if stat.S_ISLNK(info.st_mode) and not self.meta.isfile(path):
+            return
+        if not stat.S_ISREG(info.st_mode) and not stat.S_ISLNK(info.st_mode):
+            return
+        self.files.append((path, info))
+        directory = os.path.dirname(path)
+        while directory not in self.directories and directory != '/':
+            self.directories.add(directory)
+            directory = os.path.dirname(directory)
+
+    def close(self):
+        """makes the directories, then copies the files and sets the
+        directories' metadata once they are full"""
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        directories = sorted(self.directories)
+        for directory in directories:
+            # sorted, a directory comes before the ones in it
+            target = self.target(directory)
+            if not os.path.isdir(target):
+                os.mkdir(target)
+        if self.jobs > 1 and len(self.files) > 1:
+            pool = ThreadPool(min(self.jobs, len(self.files)))
+            try:
+                for n in pool.imap_unordered(self._stage, self.files, 64):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for item in self.files:
+                self._stage(item)
+        for directory in reversed(directories):
+            try:
+                info = os.stat(directory)
+            except OSError:
+                continue
+            self._set_metadata(directory, self.target(directory), info)
+        stats.count('bytes copied', self.bytes_copied)
+        for method, n in self.methods.items():
+            stats.count('files staged by ' + method, n)
+        self.files = []
+        self.directories = set()
+
+    def _stage(self, item):
+        path, info = item
+        target = self.target(path)
+        if stat.S_ISLNK(info.st_mode):
+            try:
+                os.symlink(os.readlink(path), target)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    return
+                raise
+            try:
+                os.lchown(target, info.st_uid, info.st_gid)
+            except OSError:
+                pass
+            self._done('symlink', 0)
+            return
+        try:
+            method = None
+            if 'store' not in self.unsupported:
+                method = self._from_store(path, target, info)
+            if method is None:
+                method = self._copy(path, target, info)
+        except (IOError, OSError), e:
+            if e.errno == errno.ENOENT:
+                # gone since the install, left out of the package
+                return
+            raise
+        if method == 'store':
+            self._done(method, 0)
+        elif method == 'stored':
+            # copied once, into the store
+            self._done(method, info.st_size)
+        elif method == 'link':
+            self._done(method, 0)
+        else:
+            self._set_metadata(path, target, info)
+            self._done(method, info.st_size)
+
+    def _done(self, method, size):
+        self.lock.acquire()
+        try:
+            self.methods[method] = self.methods.get(method, 0) + 1
+            self.bytes_copied += size
+        finally:
+            self.lock.release()
+
+    def _unsupported(self, method, error):
+        if error in UNSUPPORTED:
+            self.unsupported.add(method)
+            return True
+        return False
+
+    def _from_store(self, path, target, info):
+        """links target to the object for path, copying path into the
+        store first if it is not there. None when the store can't be used
+        for it"""
+        name = self.store.name(path, info)
+        try:
+            if self.store.link(name, target):
+                return 'store'
+            temporary = self.store.temporary()
+            try:
+                self._copy(path, temporary, info)
+                self._set_metadata(path, temporary, info)
+                self.store.put(name, temporary)
+            except:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+            if self.store.link(name, target):
+                return 'stored'
+        except OSError, e:
+            if e.errno == errno.EMLINK:
+                # as many links as the object can have, copied instead
+                return None
+            if not self._unsupported('store', e.errno):
+                raise
+        return None
+
+    def _copy(self, path, target, info):
+        """copies path to target, returns the way it was copied"""
+        if 'link' not in self.unsupported:
+            try:
+                os.link(path, target)
+                return 'link'
+            except OSError, e:
+                if not self._unsupported('link', e.errno):
+                    raise
+        if 'copyfile' not in self.unsupported:
+            if self.libc.copyfile(path, target, None, COPYFILE_ALL | COPYFILE_CLONE) == 0:
+                return 'clone'
+            if not self._unsupported('copyfile', self.ctypes.get_errno()):
+                raise OSError(self.ctypes.get_errno(), os.strerror(self.ctypes.get_errno()), path)
+        src = os.open(path, os.O_RDONLY)
+        try:
+            dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            try:
+                if 'reflink' not in self.unsupported and info.st_size:
+                    try:
+                        fcntl.ioctl(dst, FICLONE, src)
+                        return 'clone'
+                    except IOError, e:
+                        if not self._unsupported('reflink', e.errno):
+                            raise
+                # each way of copying carries on from the file offsets
+                # the last one left off at
+                for method in ('copy_file_range', 'sendfile'):
+                    if method not in self.unsupported and self._kernel_copy(method, src, dst):
+                        return 'kernel'
+                while True:
+                    data = os.read(src, COPY_SIZE)
+                    if not data:
+                        break
+                    while data:
+                        data = data[os.write(dst, data):]
+                return 'read'
+            finally:
+                os.close(dst)
+        finally:
+            os.close(src)
+
+    def _kernel_copy(self, method, src, dst):
+        """copies the rest of src to dst in the kernel, False if method is not
+        supported here"""
+        if not hasattr(self.libc, method):
+            self.unsupported.add(method)
+            return False
+        while True:
+            if method == 'copy_file_range':
+                n = self.libc.copy_file_range(src, None, dst, None, KERNEL_CHUNK, 0)
+            else:
+                n = self.libc.sendfile(dst, src, None, KERNEL_CHUNK)
+            if n == 0:
+                return True
+            if n < 0:
+                error = self.ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if self._unsupported(method, error):
+                    return False
+                raise OSError(error, os.strerror(error))
+
+    def _set_metadata(self, path, target, info):
+        try:
+            os.chown(target, info.st_uid, info.st_gid)
+        except OSError, e:
+            if e.errno != errno.EPERM:
+                raise
+        # after chown, which clears the setuid and setgid bits
+        os.chmod(target, stat.S_IMODE(info.st_mode))
+        if xattr is not None:
+            try:
+                attrs = xattr.xattr(path)
+                staged = xattr.xattr(target)
+                for name in attrs.list():
+                    staged.set(name, attrs.get(name))
+            except (IOError, OSError, KeyError):
+                pass
+        os.utime(target, (info.st_atime, info.st_mtime))
+
+def stage(paths, root, jobs=4, link=False, meta=None, store=None):
+    """stages paths under root, see Stager"""
+    stager = Stager(root, jobs, link, meta, store)
+    for path in paths:
+        stager.add(path)
+    stager.close()
+    return stager
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+stats.py
+
+Timers and counters for a run of watchedinstall.py, written out as a JSON
+report with the --stats option.
+
+Phases are timed with
+
+    with stats.phase('scan'):
+        ...
+
+or between stats.start('scan') and stats.stop('scan') where a with block
+would not fit around the code. Counters are added to with stats.count(),
+and external commands are run through stats.call() and stats.output() so
+the number of runs and the wall time of each command are recorded. Everything is kept in one Stats object
+for the run, and can be recorded into from any thread.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import time
+import json
+import resource
+import threading
+from subprocess import Popen, PIPE
+
+class Phase(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, time.time() - self.start)
+        return False
+
+class Stats(object):
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.phase_order = []
+        self.counters = {}
+        self.commands = {} # command name -> [runs, seconds]
+        self.running = {} # phase name -> start time
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def start(self, name):
+        self.running[name] = time.time()
+
+    def stop(self, name):
+        started = self.running.pop(name, None)
+        if started is not None:
+            self.add_time(name, time.time() - started)
+
+    def add_time(self, name, seconds):
+        self.lock.acquire()
+        try:
+            if name not in self.phases:
+                self.phases[name] = 0.0
+                self.phase_order.append(name)
+            self.phases[name] += seconds
+        finally:
+            self.lock.release()
+
+    def count(self, name, n=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + n
+        finally:
+            self.lock.release()
+
+    def command(self, args, seconds):
+        name = os.path.basename(args[0])
+        self.lock.acquire()
+        try:
+            record = self.commands.setdefault(name, [0, 0.0])
+            record[0] += 1
+            record[1] += seconds
+        finally:
+            self.lock.release()
+
+    def call(self, args, **kwargs):
+        """subprocess.call, timed"""
+        start = time.time()
+        try:
+            return Popen(args, **kwargs).wait()
+        finally:
+            self.command(args, time.time() - start)
+
+    def output(self, args, **kwargs):
+        """the standard output of a command, timed"""
+        start = time.time()
+        try:
+            return Popen(args, stdout=PIPE, **kwargs).communicate()[0]
+        finally:
+            self.command(args, time.time() - start)
+
+    def report(self):
+        commands = {}
+        for name, (runs, seconds) in self.commands.items():
+            commands[name] = {'runs': runs, 'seconds': round(seconds, 4)}
+        phases = {}
+        for name, seconds in self.phases.items():
+            phases[name] = round(seconds, 4)
+        return {'phases': phases,
+                'phase_order': self.phase_order,
+                'counters': self.counters,
+                'commands': commands,
+                'subprocesses': sum([runs for runs, seconds in self.commands.values()]),
+                'subprocess_seconds': round(sum([seconds for runs, seconds in self.commands.values()]), 4),
+                'total_seconds': round(time.time() - self.started, 4),
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+    def write(self, path):
+        out = open(path, 'w')
+        json.dump(self.report(), out, indent=2, sort_keys=True)
+        out.write('\n')
+        out.close()
+
+# the run being recorded, the functions below record into it
+current = Stats()
+
+def reset():
+    global current
+    current = Stats()
+    return current
+
+def phase(name):
+    return current.phase(name)
+
+def start(name):
+    current.start(name)
+
+def stop(name):
+    current.stop(name)
+
+def count(name, n=1):
+    current.count(name, n)
+
+def call(args, **kwargs):
+    return current.call(args, **kwargs)
+
+def output(args, **kwargs):
+    return current.output(args, **kwargs)
+
+def profile(path, function, *args):
+    """runs function under cProfile, saving the profile to path for pstats,
+    only the calling thread is profiled"""
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(path)
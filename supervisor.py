@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+supervisor.py
+
+Runs the installers and waits on them, their output and the loggers in
+one select() loop, rather than checking on them once a second.
+
+A SIGCHLD handler wakes the loop through a pipe (signal.set_wakeup_fd), so
+an installer that exits is seen straight away. Installer output is read
+from its pipe as it arrives, so a chatty installer never fills the pipe
+and stalls. It is kept in a temporary file for the failure report and,
+when asked, copied out as it comes, each line prefixed with the package
+when several installers run at once.
+
+Loggers that should run for as long as the install are watched too, and
+it is reported if one of them exits early. They are stopped with a signal
+sent from here, rather than by running kill.
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import sys
+import errno
+import fcntl
+import select
+import signal
+import tempfile
+from subprocess import Popen, PIPE, STDOUT
+
+READ_SIZE = 64 * 1024
+
+def _nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def _wake(signum, frame):
+    # the wakeup fd does the work, the handler only has to exist
+    pass
+
+def stop(process, signum=signal.SIGTERM):
+    """signals a logger process to stop, and waits for it"""
+    try:
+        os.kill(process.pid, signum)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+    return process.wait()
+
+class Job(object):
+    """a process run by the supervisor, and its output"""
+    def __init__(self, process, name, tee=None, prefix=''):
+        self.process = process
+        self.name = name
+        self.tee = tee
+        self.prefix = prefix
+        self.fd = process.stdout.fileno()
+        self.output = tempfile.TemporaryFile()
+        self.partial = ''
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def read(self):
+        """reads what is waiting in the pipe, False at its end"""
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            raise
+        if not data:
+            return False
+        self.output.write(data)
+        if self.tee is not None:
+            self._tee(data)
+        return True
+
+    def _tee(self, data):
+        if not self.prefix:
+            self.tee.write(data)
+        else:
+            lines = (self.partial + data).split('\n')
+            self.partial = lines.pop()
+            for line in lines:
+                self.tee.write(self.prefix + line + '\n')
+        self.tee.flush()
+
+    def close(self):
+        if self.tee is not None and self.partial:
+            self.tee.write(self.prefix + self.partial + '\n')
+            self.tee.flush()
+            self.partial = ''
+        self.process.stdout.close()
+
+    def text(self):
+        """everything the process wrote"""
+        self.output.seek(0)
+        return self.output.read()
+
+class Supervisor(object):
+    """Starts jobs with start(), and hands them back with wait() as they exit.
+
+    Output of jobs is copied to tee if given. open() must be called from the
+    main thread, where signal handlers can be set; from another thread the
+    loop falls back to looking for exited jobs every poll_interval seconds."""
+
+    def __init__(self, tee=None, poll_interval=0.1):
+        self.tee = tee
+        self.poll_interval = poll_interval
+        self.timeout = None
+        self.pipes = {} # fd -> Job, while its pipe is open
+        self.running = [] # jobs that have not exited
+        self.watched = [] # (process, name) of loggers
+        self.wake_read = self.wake_write = None
+        self.previous = None
+        self.previous_fd = None
+
+    def open(self):
+        self.wake_read, self.wake_write = os.pipe()
+        _nonblocking(self.wake_read)
+        _nonblocking(self.wake_write)
+        try:
+            self.previous_fd = signal.set_wakeup_fd(self.wake_write)
+        except ValueError:
+            # not the main thread
+            self.timeout = self.poll_interval
+            return
+        self.previous = signal.signal(signal.SIGCHLD, _wake)
+        # other reads and writes carry on through the signal
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def close(self):
+        if self.previous is not None:
+            signal.signal(signal.SIGCHLD, self.previous)
+            signal.set_wakeup_fd(self.previous_fd)
+            self.previous = None
+        for job in self.pipes.values():
+            job.close()
+        self.pipes = {}
+        for fd in (self.wake_read, self.wake_write):
+            if fd is not None:
+                os.close(fd)
+        self.wake_read = self.wake_write = None
+
+    def start(self, command, name, prefix=False):
+        """runs command, its output going to a pipe read by the supervisor"""
+        process = Popen(command, stdout=PIPE, stderr=STDOUT, close_fds=True)
+        _nonblocking(process.stdout.fileno())
+        job = Job(process, name, self.tee, prefix and '[%s] ' % os.path.basename(name) or '')
+        self.pipes[job.fd] = job
+        self.running.append(job)
+        return job
+
+    def watch(self, process, name):
+        """a logger that should run until stopped, reported if it exits"""
+        self.watched.append((process, name))
+
+    def wait(self):
+        """waits until at least one job has exited, and returns those that
+        have, with their output read"""
+        while True:
+            finished = self._reap()
+            if finished or not self.running:
+                return finished
+            fds = self.pipes.keys() + [self.wake_read]
+            try:
+                ready = select.select(fds, [], [], self.timeout)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                if fd == self.wake_read:
+                    self._clear_wake()
+                elif not self.pipes[fd].read():
+                    self.pipes.pop(fd).close()
+
+    def _clear_wake(self):
+        try:
+            while os.read(self.wake_read, 512):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def _reap(self):
+        finished = []
+        for job in list(self.running):
+            if job.process.poll() is not None:
+                self.running.remove(job)
+                self._drain(job)
+                finished.append(job)
+        for process, name in list(self.watched):
+            if process.poll() is not None:
+                self.watched.remove((process, name))
+                sys.stderr.write('%s exited with %s while the install was running, '
+                                 'changes made since are not captured\n' % (name, process.returncode))
+        return finished
+
+    def _drain(self, job):
+        """reads the rest of the output of a job that exited. A process it
+        left running can hold the pipe open, so only what is already there
+        is read"""
+        if job.fd not in self.pipes:
+            return
+        while select.select([job.fd], [], [], 0)[0] and job.read():
+            pass
+        self.pipes.pop(job.fd).close()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_watchedinstall.py
+
+Tests of the event scanner, the capture backends and the transcript
+handling, fed events and lines directly rather than from an install.
+
+    python test_watchedinstall.py
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import re
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+import capture
+import radmind
+import tsort
+import baseline
+from excludes import ExcludeMatcher
+from watchedinstall import EventScanner
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench'))
+import bench_excludes
+
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make(self, *paths):
+        for path in paths:
+            path = os.path.join(self.root, path)
+            if path.endswith('/'):
+                os.makedirs(path)
+            else:
+                open(path, 'w').close()
+
+    def feed(self, scanner, events):
+        for event, path in events:
+            scanner.feed(os.path.join(self.root, path), event)
+
+    def test_bundle_replaced_by_rename(self):
+        """rm -rf App.app; mv App.app.tmp App.app over a bundle that was
+        there before: what is in the new bundle is not removed"""
+        # the bundle as it is after the install
+        self.make('App.app/', 'App.app/Contents/', 'App.app/Contents/keep', 'App.app/Contents/new')
+        scanner = EventScanner()
+        self.feed(scanner, [
+            ('FSE_CREATE_DIR', 'App.app.tmp'),
+            ('FSE_CREATE_DIR', 'App.app.tmp/Contents'),
+            ('FSE_CREATE_FILE', 'App.app.tmp/Contents/keep'),
+            ('FSE_CREATE_FILE', 'App.app.tmp/Contents/new'),
+            ('FSE_DELETE', 'App.app/Contents/keep'),
+            ('FSE_DELETE', 'App.app/Contents/old'),
+            ('FSE_DELETE', 'App.app/Contents'),
+            ('FSE_DELETE', 'App.app'),
+            ('FSE_RENAME', 'App.app.tmp'),
+            ('FSE_RENAME', 'App.app'),
+        ])
+        scanner.finish()
+        roots, others = scanner.rollup(os.path.isdir)
+        self.assert_(os.path.join(self.root, 'App.app') in roots)
+        self.assertEqual(list(scanner.removed()), [os.path.join(self.root, 'App.app/Contents/old')])
+
+    def test_renames_split_in_two(self):
+        """the destinations of renames whose sources were lost are looked
+        for on disk, not paired with each other"""
+        self.make('dest/', 'dest/a', 'dest/b')
+        scanner = EventScanner()
+        self.feed(scanner, [
+            ('FSE_RENAME_TO', 'dest/a'),
+            ('FSE_RENAME_TO', 'dest/b'),
+        ])
+        scanner.finish()
+        self.assertEqual(sorted(scanner.added()), [os.path.join(self.root, 'dest/a'),
+                                                   os.path.join(self.root, 'dest/b')])
+        self.assertEqual(list(scanner.removed()), [])
+
+class TranscriptIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write('command.K', 'p base.T\np app.T\ns ./etc/special\ns ./etc/taken\n- s ./etc/taken\n')
+        self.write('base.T', 'd ./Applications 0755 0 80\n'
+                             'd ./Applications/App.app 0755 0 80\n'
+                             'd ./Applications/App.app/Contents 0755 0 80\n'
+                             'f ./Applications/App.app/Contents/a 0644 0 80 100 1 -\n'
+                             'f ./Applications/App.app/Info.plist 0644 0 80 100 1 -\n'
+                             'f ./Applications/App.b 0644 0 80 100 1 -\n'
+                             'f ./Applications/Old 0644 0 80 100 1 -\n')
+        # a later transcript takes precedence
+        self.write('app.T', 'f ./Applications/App.app/Info.plist 0644 0 80 200 2 -\n'
+                            'f ./Applications/App\\bX.app 0644 0 80 200 2 -\n'
+                            '- f ./Applications/Old 0644 0 80 100 1 -\n')
+        self.index = radmind.TranscriptIndex(os.path.join(self.root, 'command.K'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, text):
+        f = open(os.path.join(self.root, name), 'w')
+        f.write(text)
+        f.close()
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup('./Applications/App.app/Info.plist'),
+                         'f ./Applications/App.app/Info.plist 0644 0 80 200 2 -')
+        self.assertEqual(self.index.lookup('/Applications/App.app/Contents/a'),
+                         'f ./Applications/App.app/Contents/a 0644 0 80 100 1 -')
+        self.assertEqual(self.index.lookup('/Applications/App X.app'),
+                         'f ./Applications/App\\bX.app 0644 0 80 200 2 -')
+        self.assertEqual(self.index.lookup('/Applications/Old'), None)
+        self.assertEqual(self.index.lookup('/Applications/App.ap'), None)
+        self.assertEqual(self.index.lookup('/applications/app.b'), None)
+        index = radmind.TranscriptIndex(os.path.join(self.root, 'command.K'), True)
+        self.assert_('/applications/app.b' in index)
+
+    def test_children(self):
+        """what is directly in a directory, not what is further down"""
+        self.assertEqual(list(self.index.children('/Applications')),
+                         ['/Applications/App X.app', '/Applications/App.app', '/Applications/App.b'])
+        self.assertEqual(list(self.index.children('./Applications/App.app/')),
+                         ['/Applications/App.app/Contents', '/Applications/App.app/Info.plist'])
+        self.assertEqual(list(self.index.children('/Applications/App.b')), [])
+
+    def test_specials(self):
+        self.assert_(self.index.is_special('./etc/special'))
+        self.failIf(self.index.is_special('/etc/taken'))
+
+class DeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_delta(self):
+        """only lines added or changed since the baseline are written, with
+        the install's removals and removals for what the baseline had"""
+        previous = os.path.join(self.root, 'old.T')
+        f = open(previous, 'w')
+        f.write('d ./Applications/App.app 0755 0 80\n'
+                'f ./Applications/App.app/gone 0644 0 80 100 1 -\n'
+                'f ./Applications/App.app/same 0644 0 80 100 1 -\n'
+                'f ./Applications/App.app/changed 0644 0 80 100 1 -\n')
+        f.close()
+        path = os.path.join(self.root, 'new.T')
+        delta = baseline.DeltaWriter(open(path, 'w'), baseline.Baseline(previous))
+        sorter = tsort.transcript_sorter(delta)
+        for line in ['f ./Applications/App.app/same 0644 0 80 100 1 -\n',
+                     '- f ./Library/Old 0644 0 80 100 1 -\n',
+                     'f ./Applications/App.app/new 0644 0 80 200 1 -\n',
+                     'f ./Applications/App.app/changed 0644 0 80 200 1 -\n',
+                     'd ./Applications/App.app 0755 0 80\n']:
+            sorter.write(line)
+        sorter.close()
+        self.assertEqual(open(path).readlines(),
+                         ['f ./Applications/App.app/changed 0644 0 80 200 1 -\n',
+                          '- f ./Applications/App.app/gone 0644 0 80 100 1 -\n',
+                          'f ./Applications/App.app/new 0644 0 80 200 1 -\n',
+                          '- f ./Library/Old 0644 0 80 100 1 -\n'])
+        self.assertEqual((delta.unchanged, delta.dropped), (2, 1))
+
+class ExcludeMatcherTest(unittest.TestCase):
+
+    def old_path_ok(self, excludes, english_only, path):
+        """the check the matcher replaced, one regex search per exclude"""
+        return bench_excludes.old_path_ok([re.compile(e, re.I) for e in excludes], english_only)(path)
+
+    def test_same_as_regex_per_exclude(self):
+        """a command file sized set of excludes decides every path as the
+        old loop did, with and without --english-only"""
+        excludes = bench_excludes.exclude_set(300)
+        paths = bench_excludes.path_set(5000)
+        paths += [os.path.dirname(p) + '/sub/dir/file' for p in paths[:500]]
+        compiled = [re.compile(e, re.I) for e in excludes]
+        for english_only in (False, True):
+            old = bench_excludes.old_path_ok(compiled, english_only)
+            matcher = ExcludeMatcher(excludes, english_only)
+            self.assertEqual([matcher.path_ok(p) for p in paths], [old(p) for p in paths])
+
+    def test_plain_heads_and_regexes(self):
+        excludes = ['/Library/Caches/.*', '/Users/.*/Library/Caches/.*', '.*\\.DS_Store',
+                    '/private/var/db/receipts/Safari.*', '\\.\\.namedfork']
+        matcher = ExcludeMatcher(excludes)
+        for path, ok in [('/Library/Caches/com.apple.x', False),
+                         ('/library/caches/lower', False),
+                         ('/Library/Caches', True),
+                         ('/Users/bob/Library/Caches/x', False),
+                         ('/Users/bob/Library/Preferences/x', True),
+                         ('/Applications/A.app/.DS_Store', False),
+                         ('/private/var/db/receipts/Safari5.bom', False),
+                         ('/private/var/db/receipts/Mail.bom', True),
+                         ('/Applications/A.app/Icon/..namedfork/rsrc', False),
+                         ('/Applications/A.app/Contents/Info.plist', True)]:
+            self.assertEqual(matcher.path_ok(path), ok, path)
+            self.assertEqual(self.old_path_ok(excludes, False, path), ok, path)
+
+    def test_children_of_excluded_directories(self):
+        """what is under an excluded path is excluded, whether or not the
+        exclude matches it too, until forget() starts a new run"""
+        matcher = ExcludeMatcher(['/opt/skip$'])
+        self.failIf(matcher.path_ok('/opt/skip'))
+        self.failIf(matcher.path_ok('/opt/skip/child'))
+        self.failIf(matcher.path_ok('/opt/skip/child/grandchild'))
+        self.assert_(matcher.path_ok('/opt/skipped'))
+        matcher.forget()
+        self.assertEqual(matcher.excluded_dirs, set())
+        self.assert_(matcher.path_ok('/opt/skip/child'))
+
+class SorterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def sort(self, lines, memory=tsort.MEMORY):
+        path = os.path.join(self.root, 'out.T')
+        sorter = tsort.transcript_sorter(open(path, 'w'), memory=memory, tmpdir=self.root)
+        for line in lines:
+            sorter.write(line)
+        spilled = len(sorter.runs)
+        sorter.close()
+        return open(path).readlines(), spilled
+
+    def test_radmind_order(self):
+        """'/' sorts before any other character, so a directory comes
+        directly before what is in it"""
+        lines = ['f ./a.b 0644 0 0 1 1 -\n', 'f ./a-b 0644 0 0 1 1 -\n',
+                 '- f ./a/b 0644 0 0 1 1 -\n', 'f ./a\\bc 0644 0 0 1 1 -\n',
+                 'd ./a 0755 0 0\n']
+        self.assertEqual(self.sort(lines)[0], [lines[4], lines[2], lines[3], lines[1], lines[0]])
+
+    def test_spilled_runs(self):
+        """lines spilled to disk in runs come out merged as if sorted in
+        memory, lines with the same path in the order they were written"""
+        generator = random.Random(1)
+        lines = []
+        for i in xrange(2000):
+            name = ''.join([generator.choice('ab./-') for n in xrange(generator.randint(1, 6))])
+            lines.append('f ./%s 0644 0 0 %d 1 -\n' % (name, i))
+        output, spilled = self.sort(lines, memory=4096)
+        self.assert_(spilled > 1)
+        self.assertEqual(output, sorted(lines, key=tsort.radmind_key))
+        self.assertEqual(os.listdir(self.root), ['out.T'])
+
+class ParseEventLineTest(unittest.TestCase):
+
+    def test_event(self):
+        self.assertEqual(capture.parse_event_line('12\tinstaller\tFSE_CREATE_FILE\t/a b\n'),
+                         (12, 'FSE_CREATE_FILE', '/a b', None))
+        self.assertEqual(capture.parse_event_line('-1\t?\tFSE_EVENTS_DROPPED\t/\n'),
+                         (None, 'FSE_EVENTS_DROPPED', '/', None))
+
+    def test_not_an_event(self):
+        """lines fsewatcher prints that are not events are passed over"""
+        self.assertEqual(capture.parse_event_line('This may be a program bug (type = 99).\n'), None)
+        self.assertEqual(capture.parse_event_line('12\tinstaller\n'), None)
+
+class FanotifyTest(unittest.TestCase):
+    """events as the kernel reports them, with the directory they happened
+    in already known by its file handle"""
+
+    handle = capture.FILE_HANDLE.pack(8, 1) + 'dirhandl'
+
+    def setUp(self):
+        # none of the kernel side is set up, handle() only needs these
+        self.fanotify = capture.Fanotify.__new__(capture.Fanotify)
+        self.fanotify.target = self.fanotify.prefix = '/watched'
+        self.fanotify.dirs = {self.handle: '/watched/sub'}
+        self.fanotify.ignore = set()
+        self.fanotify.log = None
+        self.events = []
+        self.fanotify.sink = self.events.append
+
+    def event(self, mask, name, pid=100):
+        name += '\0'
+        name += '\0' * (-(capture.INFO_HEADER.size + 8 + len(self.handle) + len(name)) % 4)
+        info_len = capture.INFO_HEADER.size + 8 + len(self.handle) + len(name)
+        info = (capture.INFO_HEADER.pack(capture.FAN_EVENT_INFO_TYPE_DFID_NAME, 0, info_len) +
+                '\0' * 8 + self.handle + name)
+        size = capture.EVENT_METADATA.size
+        return capture.EVENT_METADATA.pack(size + len(info), 3, 0, size, mask, -1, pid) + info
+
+    def test_event_on_the_directory_itself(self):
+        """a chmod of a watched directory is reported with the name '.'"""
+        self.fanotify.handle(self.event(capture.FAN_ATTRIB | capture.FAN_ONDIR, '.') +
+                             self.event(capture.FAN_CREATE, 'file'))
+        self.assertEqual(self.events, [(100, 'FSE_STAT_CHANGED', '/watched/sub', None),
+                                       (100, 'FSE_CREATE_FILE', '/watched/sub/file', None)])
+
+if __name__ == '__main__':
+    unittest.main()
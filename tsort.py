@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+tsort.py
+
+Sorts transcript lines into the order radmind's lsort puts them in, without
+running lsort or going through temporary files when the lines fit in
+memory.
+
+radmind compares paths a byte at a time with '/' counting as lower than
+any other character, so a directory sorts directly before what is in it,
+and -I compares them lower cased. Lines are collected with write() like a
+file; once more than a set amount of memory is used the lines so far are
+sorted and spilled to a temporary file, and close() merges the spilled runs
+with what is still in memory, writing the result out as it goes.
+
+usage: python tsort.py [-I] [-o OUTPUT] [TRANSCRIPT ...]
+sorts transcripts like lsort, standard input if none are given
+
+Copyright (c) 2009 Preston Holmes
+See watchedinstall.py for license terms.
+"""
+
+import os
+import sys
+import heapq
+import getopt
+import tempfile
+
+from radmind import decode_path
+
+MEMORY = 64 * 1024 * 1024 # bytes of lines held before a run is spilled
+
+def radmind_key(line, case_insensitive=False):
+    """the radmind sort key of a transcript line"""
+    fields = line.split(' ', 3)
+    if fields[0] == '-':
+        path = fields[2]
+    else:
+        path = fields[1]
+    path = decode_path(path.rstrip('\n'))
+    if case_insensitive:
+        path = path.lower()
+    return path.replace('/', '\1')
+
+def line_key(line):
+    """sorts lines as they are, byte by byte"""
+    return line
+
+class Sorter(object):
+    """Takes lines with write() and writes them out in order with close().
+
+    key is a function of a line, memory the number of bytes of lines kept in
+    memory before they are sorted and spilled to a run file in tmpdir."""
+
+    def __init__(self, out, key=line_key, memory=MEMORY, tmpdir=None):
+        self.out = out
+        self.key = key
+        self.memory = memory
+        self.tmpdir = tmpdir
+        self.lines = []
+        self.size = 0
+        self.partial = ''
+        self.runs = []
+        self.count = 0
+
+    def write(self, data):
+        """adds lines, data need not end at the end of a line"""
+        if self.partial:
+            data = self.partial + data
+        lines = data.split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            if line:
+                self.lines.append(line + '\n')
+        self.size += len(data) - len(self.partial)
+        if self.size > self.memory:
+            self._spill()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _sorted(self):
+        key = self.key
+        decorated = [(key(line), i, line) for i, line in enumerate(self.lines)]
+        self.lines = []
+        self.size = 0
+        decorated.sort()
+        return decorated
+
+    def _spill(self):
+        fd, path = tempfile.mkstemp(prefix='tsort', dir=self.tmpdir)
+        run = os.fdopen(fd, 'w')
+        for key, i, line in self._sorted():
+            run.write(line)
+        run.close()
+        self.runs.append(path)
+
+    def _read_run(self, number, path):
+        key = self.key
+        i = 0
+        for line in open(path):
+            # the run number keeps lines with the same key in the order
+            # they were written in
+            yield key(line), (number, i), line
+            i += 1
+
+    def close(self):
+        """writes all the lines out in order, then closes the output"""
+        if self.partial:
+            self.lines.append(self.partial + '\n')
+            self.partial = ''
+        try:
+            if not self.runs:
+                for key, i, line in self._sorted():
+                    self.out.write(line)
+                    self.count += 1
+            else:
+                last = [(key, (len(self.runs), i), line) for key, i, line in self._sorted()]
+                sources = [self._read_run(n, path) for n, path in enumerate(self.runs)]
+                sources.append(iter(last))
+                for key, i, line in heapq.merge(*sources):
+                    self.out.write(line)
+                    self.count += 1
+        finally:
+            for path in self.runs:
+                os.remove(path)
+            self.runs = []
+        if self.out not in (sys.stdout, sys.stderr):
+            self.out.close()
+
+def transcript_sorter(out, case_insensitive=False, memory=MEMORY, tmpdir=None):
+    """a Sorter for transcript lines in radmind's order"""
+    if case_insensitive:
+        key = lambda line: radmind_key(line, True)
+    else:
+        key = radmind_key
+    return Sorter(out, key, memory, tmpdir)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'Io:')
+    except getopt.GetoptError, e:
+        sys.exit('usage: python tsort.py [-I] [-o OUTPUT] [TRANSCRIPT ...]')
+    opts = dict(opts)
+    out = sys.stdout
+    if '-o' in opts:
+        out = open(opts['-o'], 'w')
+    sorter = transcript_sorter(out, '-I' in opts)
+    for name in args or ['-']:
+        source = name == '-' and sys.stdin or open(name)
+        for line in source:
+            sorter.write(line)
+    sorter.close()
+
+if __name__ == '__main__':
+    main()
@@ -51,25 +51,68 @@ scan for positive items that are in negative space - right now negative space is
 
 import sys
 import os
-from subprocess import Popen, call, STDOUT, PIPE
+from subprocess import Popen, PIPE
 import time
 import re
+import tempfile
+import threading
+from collections import deque
+from array import array
 from optparse import OptionParser,OptionGroup
-# the following imports only needed for python fsdiff
-import xattr
-import hashlib
-import shutil
-import pdb
+from multiprocessing import cpu_count
+
+import radmind
+import proctree
+import capture
+import eventlog
+import pathstate
+import prefilter
+import stats
+import tsort
+import session
+import metacache
+from excludes import ExcludeMatcher
+from supervisor import Supervisor, stop
 
-excludes = []
 logfile = '/tmp/events.log'
 pidlog = '/tmp/pid_log.log'
 unsorted_file = '/tmp/unsorted'
+snapshotfile = '/tmp/snapshot.bin'
 pkg_maker_cmd = '/Developer/Applications/Utilities/PackageMaker.app/Contents/MacOS/PackageMaker'
+cksum_cache_file = '/var/db/watchedinstall/cksum.cache'
+store_dir = '/var/db/watchedinstall/store'
 
 debug = True
 
-pids = set() # maintains collection of unique values
+# what the event scanner knows about a path
+INSTALLER_CREATED = 1 # first seen being made, it was not there before the install
+ALREADY_OUTPUT = 2    # to be diffed
+REMOVED = 4           # was there before the install and is gone
+SEEN = 8              # an event has been seen for it
+PRESENT = 16          # there, going by the last event seen for it
+UNPAIRED = 32         # renamed without the other half of the rename being seen
+MOVED_IN = 64         # the destination of a rename
+DIRECTORY = 128       # made as a directory
+
+# paths first seen either side of a dropped events marker whose directories are
+# looked at again once the install is done
+DROP_WINDOW = 256
+
+# the installer and its descendant processes, pid in pids is a dictionary lookup
+pids = proctree.ProcessTree()
+
+# what the daemon keeps between jobs, see daemon.py - None for a run of its own
+resident = None
+
+# output files being written, renamed into place once they are complete
+partial_outputs = []
+
+def warm(key, sources, make):
+    """make(), or under the daemon what it made for an earlier job, as long
+    as none of the files sources it was made from has changed since"""
+    if resident is None:
+        return make()
+    return resident.get(key, sources, make)
 
 def sh(cmd):
     return Popen(cmd,shell=True,stdout=PIPE,stderr=PIPE).communicate()[0]
@@ -77,65 +120,357 @@ def sh(cmd):
 def parse_pidlog(parentPID):
     global pids
     global pidlog
-    for i,line in enumerate(open(pidlog)):
-        if i == 0: 
-            continue # skip the header line
-        data = line.split()
-        if data[2] in pids:
-            pids.add(data[1])
-    
+    proctree.feed_execsnoop(pids, open(pidlog))
+
+def stream_pidlog(source, pidlog_handle):
+    """reads execsnoop output as it arrives so descendant PIDs are known
+    while the install is still running"""
+    global pids
+    def lines():
+        for line in iter(source.readline, ''):
+            pidlog_handle.write(line)
+            yield line
+    proctree.feed_execsnoop(pids, lines())
+
+class EventScanner(object):
+    """The net effect of an install on each path it touched, fed one installer
+    event at a time so it can run while the events are still being logged.
+
+    Every path has a small state machine of its own: whether it was there
+    before the install, going by the first event seen for it, and whether it
+    is there now, going by the last. The events of one path need not come
+    together, installer helpers running side by side interleave theirs. A
+    rename comes as two events, the source then the destination - a pair
+    of FSE_RENAME from fsewatcher, FSE_RENAME_FROM then FSE_RENAME_TO on
+    Linux - and moves the one path's state to the other. A half without
+    the other is looked for on disk once all the events are in.
+
+    Once all the events are in, finish() works out what became of each path:
+    made or changed paths are diffed, paths that were there before and are
+    gone are removed, and paths made and gone again, temporary files, are
+    left out altogether. Nothing is diffed here - paths to add and remove are
+    collected and dispatched once the installer has exited"""
+    def __init__(self):
+        # what is known about each path is kept as flags in a compact store,
+        # installs can touch millions of paths
+        self.paths = pathstate.PathStateStore()
+        self.flags = self.paths.flags
+        self.items_added = array('i') # nodes of paths to diff, in order
+        self.rename_from = pathstate.EMPTY # source of a rename, until its destination comes
+        self.transient = 0 # paths made and gone again
+        # dropped events markers, as (path, number of paths stored before it)
+        self.drops = []
+
+    def _add(self, node):
+        self.items_added.append(node)
+        # delete from the list of things to remove
+        self.flags[node] = (self.flags[node] | ALREADY_OUTPUT) & ~REMOVED
+
+    def feed(self, logged_path, event):
+        """takes the next event made by the installer or its descendants"""
+        if event == capture.DROPPED:
+            self.drops.append((logged_path, len(self.flags)))
+            return
+        node = self.paths.node(logged_path, True)
+        flags = self.flags
+        source = self.rename_from
+        if event == 'FSE_RENAME' and source == pathstate.EMPTY or event == 'FSE_RENAME_FROM':
+            if source != pathstate.EMPTY:
+                # a source whose destination was outside what is watched
+                flags[source] |= SEEN | UNPAIRED
+            # its destination is the next event
+            self.rename_from = node
+            return
+        if event in ('FSE_RENAME', 'FSE_RENAME_TO'):
+            self.rename_from = pathstate.EMPTY
+            state = flags[node]
+            if not state & SEEN:
+                # only there since the rename, as far as we know
+                state |= SEEN | INSTALLER_CREATED
+            if source == pathstate.EMPTY:
+                # renamed in from outside what is watched, or from a
+                # directory gone before its events were read
+                state |= UNPAIRED
+            elif source != node:
+                source_state = flags[source]
+                if not source_state & SEEN:
+                    source_state |= SEEN
+                flags[source] = source_state & ~PRESENT
+            flags[node] = state | PRESENT | MOVED_IN
+            return
+        if source != pathstate.EMPTY:
+            # the other half was outside what is watched
+            flags[source] |= SEEN | UNPAIRED
+            self.rename_from = pathstate.EMPTY
+        state = flags[node]
+        if not state & SEEN:
+            state |= SEEN
+            if event == "FSE_CREATE_FILE":
+                state |= INSTALLER_CREATED
+            elif event == "FSE_CREATE_DIR":
+                state |= INSTALLER_CREATED | DIRECTORY
+        if event == 'FSE_DELETE':
+            flags[node] = state & ~PRESENT
+        else:
+            flags[node] = state | PRESENT
+
+    def finish(self):
+        """works out the net effect on every path once all events are in"""
+        flags = self.flags
+        if self.rename_from != pathstate.EMPTY:
+            flags[self.rename_from] |= SEEN | UNPAIRED
+            self.rename_from = pathstate.EMPTY
+        for node in xrange(len(flags)):
+            state = flags[node]
+            if not state & SEEN or state & (ALREADY_OUTPUT | REMOVED):
+                continue
+            if state & UNPAIRED:
+                # renamed in from, or out to, somewhere not watched, whether
+                # it is there now says which
+                if os.path.lexists(self.paths.path(node)):
+                    state |= PRESENT
+                else:
+                    state &= ~PRESENT
+                flags[node] = state
+            if state & PRESENT:
+                self._add(node)
+            elif not state & INSTALLER_CREATED:
+                flags[node] = state | REMOVED
+            else:
+                self.transient += 1
+
+    def drop_directories(self, target):
+        """directories to look at again for events that were dropped, those
+        of the paths first seen just before and after each marker show where
+        the installer was working"""
+        directories = set()
+        flags = self.flags
+        for path, mark in self.drops:
+            # a marker for the whole volume says nothing about where
+            if path.rstrip('/') != target.rstrip('/'):
+                directories.add(os.path.dirname(path))
+            for node in xrange(max(0, mark - DROP_WINDOW), min(len(flags), mark + DROP_WINDOW)):
+                if flags[node] & SEEN:
+                    directories.add(os.path.dirname(self.paths.path(node)))
+        return directories
+
+    def recover(self, path):
+        """adds a path found changed by a rescan"""
+        node = self.paths.node(path, True)
+        if not self.flags[node] & ALREADY_OUTPUT:
+            self._add(node)
+            return True
+        return False
+
+    def recover_removed(self, path):
+        """notes a path found gone by a rescan"""
+        node = self.paths.node(path, True)
+        if not self.flags[node] & (INSTALLER_CREATED | ALREADY_OUTPUT | REMOVED):
+            self.flags[node] |= REMOVED
+            return True
+        return False
+
+    def added(self):
+        """paths to diff, in the order they were found"""
+        for node in self.items_added:
+            yield self.paths.path(node)
+
+    def rollup(self, isdir):
+        """splits the paths to diff into the directories the install made
+        whole, or renamed into place, and the paths that are not in one of
+        them. Everything in such a directory is new, it is looked at with one
+        walk of the directory rather than a path at a time, and the events
+        seen in it are not needed. isdir tells if a path renamed into place
+        is a directory. Paths removed under a root that are there again, as
+        when a bundle is replaced by renaming a new one over it, are no
+        longer removed, the walk finds them"""
+        flags = self.flags
+        parent = self.paths.parent
+        candidates = set()
+        made = INSTALLER_CREATED | DIRECTORY
+        for node in self.items_added:
+            state = flags[node]
+            if state & made == made or (state & MOVED_IN and isdir(self.paths.path(node))):
+                candidates.add(node)
+        # a node's parent always comes before it, one pass marks what is
+        # under a root: 2 for the topmost roots, 1 for everything under them
+        under = bytearray(len(flags))
+        if candidates:
+            for node in xrange(len(flags)):
+                up = parent[node]
+                if up != pathstate.EMPTY and under[up]:
+                    under[node] = 1
+                elif node in candidates:
+                    under[node] = 2
+                if under[node] and flags[node] & REMOVED and os.path.lexists(self.paths.path(node)):
+                    flags[node] &= ~REMOVED
+        roots = []
+        others = []
+        for node in self.items_added:
+            if under[node] == 2:
+                roots.append(self.paths.path(node))
+            elif not under[node]:
+                others.append(self.paths.path(node))
+        return roots, others
+
+    def removed(self):
+        """paths the installer removed or renamed away"""
+        return self.paths.paths(REMOVED)
+
+class InstallScanners(object):
+    """An EventScanner for each install being watched, events are handed to
+    the scanner of the install whose process tree made them"""
+    def __init__(self, tree):
+        self.tree = tree
+        self.scanners = {} # root pid -> EventScanner
+        self.installs = [] # (root pid, package or None), in the order started
+        # for dropped events: a snapshot taken before the install, and when
+        # the installers were started
+        self.snapshot = None
+        self.started = None
+
+    def add(self, root, package=None):
+        self.scanners[root] = EventScanner()
+        self.installs.append((root, package))
+
+    def feed(self, pid, path, event):
+        if pid is None:
+            # backends that can't tell pids only watch a single install
+            for scanner in self.scanners.values():
+                scanner.feed(path, event)
+            return
+        scanner = self.scanners.get(self.tree.root(pid))
+        if scanner is not None:
+            scanner.feed(path, event)
+
+    def drop(self, root):
+        """forgets an install, for one that failed"""
+        del self.scanners[root]
+        self.installs = [(pid, package) for pid, package in self.installs if pid != root]
+
+    def finish(self):
+        for scanner in self.scanners.values():
+            scanner.finish()
+
+class EventWindow(object):
+    """Streamed events are held back for a short delay before their PID is
+    checked, giving the process tracker time to learn of the child processes
+    that made them.
+    Order is preserved, as the scanners depend on it."""
+    def __init__(self, scanners, delay=2.0):
+        self.scanners = scanners
+        self.delay = delay
+        self.pending = deque()
+        self.pushed = 0
+        self.matched = 0
+
+    def push(self, event):
+        now = time.time()
+        self.pushed += 1
+        self.pending.append((now, event))
+        self.release(now - self.delay)
+
+    def release(self, cutoff=None):
+        pending = self.pending
+        while pending and (cutoff is None or pending[0][0] <= cutoff):
+            pid, event, path, inode = pending.popleft()[1]
+            if pid in pids or pid is None:
+                # events without a pid come from backends that can't tell
+                self.matched += 1
+                self.scanners.feed(pid, path, event)
+
+    def flush(self):
+        self.release()
+
 def parse_excludes (path):
-    global excludes
-    for line in open(path):
-        if line[0] == 'x':
-            p = line.split()[1]\
+    excludes = []
+    for command_file, fields in radmind.walk_command_file(path):
+        if fields[0] == 'x':
+            p = fields[1]\
                 .lstrip('.')\
                 .replace('.','\\.')\
                 .replace('*','.*')
             excludes.append(p)
-        elif line[0] == 'k':
-            f = os.path.join(os.path.dirname(path), line.split()[1])
-            parse_excludes (f)
+    return excludes
 
 def get_excludes(options):
-    global excludes
+    def make():
+        excludes = []
+        if options.format == 'radmind':
+            excludes = parse_excludes(options.command_file)
+        # default excludes
+        excludes.append('\.\.namedfork')
+        return ExcludeMatcher(excludes, options.english_only)
+    sources = []
     if options.format == 'radmind':
-        parse_excludes(options.command_file)
-    # default excludes
-    excludes.append('\.\.namedfork')
-    return [re.compile(s,re.I) for s in excludes]
+        sources = radmind.command_files(options.command_file)
+    matcher = warm(('excludes', options.format == 'radmind' and options.command_file, options.english_only),
+                   sources, make)
+    matcher.forget()
+    return matcher
 
     
+def open_output(path):
+    """a file to write the output for path to, a temporary one beside it
+    until finish_output(), so a run that fails leaves what was there"""
+    directory, name = os.path.split(path)
+    fd, temporary = tempfile.mkstemp(prefix='.%s.' % name, dir=directory or '.')
+    umask = os.umask(0)
+    os.umask(umask)
+    os.fchmod(fd, 0666 & ~umask)
+    partial_outputs.append((temporary, path))
+    return os.fdopen(fd, 'w')
+
+def finish_output():
+    """puts the output files written since open_output() in place"""
+    while partial_outputs:
+        temporary, path = partial_outputs.pop()
+        os.rename(temporary, path)
+
 def cleanup():
+    while partial_outputs:
+        try:
+            os.remove(partial_outputs.pop()[0])
+        except OSError:
+            pass
     if debug: return
     try:
         os.remove(logfile)
         os.remove(unsorted_file)
     except:
         pass
+    if resident is not None:
+        # spotlight stays off until the daemon exits
+        return
     try:
-        call(['launchctl','load','/System/Library/LaunchDaemons/com.apple.metadata.mds.plist'],stdout=PIPE,stderr=PIPE)
+        stats.call(['launchctl','load','/System/Library/LaunchDaemons/com.apple.metadata.mds.plist'],stdout=PIPE,stderr=PIPE)
     except:
         pass
 
-def pkg_from_transcript(transcript):
+def pkg_from_transcript(transcript, store=None):
+    import shutil
+    import staging
     pkg_root = '/tmp/package_root'
     pkg_maker_cmd = '/Developer/Applications/Utilities/PackageMaker.app/Contents/MacOS/PackageMaker'
-    if not os.path.exists(pkg_root): os.makedirs(pkg_root)
     os.chdir('/')
+    stager = staging.Stager(pkg_root, cpu_count(), store=store)
     for line in open(transcript):
         fields = line.split()
-        abs_path = os.path.abspath(fields[1])
-        if os.path.isfile(abs_path):
-            dest = os.path.join (pkg_root,os.path.dirname(abs_path)[1:] + '/')
-            call(['ditto',abs_path,dest])
+        stager.add(radmind.decode_path(fields[1]))
+    stager.close()
+    if store is not None:
+        store.close()
     pkg_id = os.path.basename(transcript)
-    call([pkg_maker_cmd,'--root',pkg_root,'--id',pkg_id,'--title',pkg_id,'--target','10.4','--out',pkg_id + '.pkg'])
+    stats.call([pkg_maker_cmd,'--root',pkg_root,'--id',pkg_id,'--title',pkg_id,'--target','10.4','--out',pkg_id + '.pkg'])
     shutil.rmtree(pkg_root)
 
-def main():
+def main(argv=None):
+    global pids
+    # fresh for each job the daemon runs
+    pids = proctree.ProcessTree()
+    stats.reset()
 
-    parser = OptionParser()
+    parser = OptionParser(prog="watchedinstall.py")
     parser.add_option ("-v", "--verbose", action="store_true",
                       help="display all verbose installer output",default=False)
     parser.add_option ('-e','--english-only',action="store_true",default=False,
@@ -144,14 +479,44 @@ def main():
                         help='file to save results in, if not specified use standard out',metavar='PATH')
     parser.add_option ('-f','--format',
                         help='format for output file, default: radmind', default='radmind',metavar='[radmind | standard | package]')
-    parser.add_option ('-i','--pid', help="Manually specify the PID of the parent installer process", metavar="PID")
+    parser.add_option ('-i','--pid', type='int', help="Manually specify the PID of the parent installer process", metavar="PID")
+    parser.add_option ('-S','--stream',action="store_true",default=False,
+                        help='scan file system events while the installer runs instead of logging them for afterwards')
+    parser.add_option ('--capture',default='auto',metavar='[auto | fsewatcher | fanotify | inotify]',
+                        help='how file system changes are watched for, default: fsewatcher on OS X, fanotify or else inotify on Linux')
+    parser.add_option ('-j','--jobs',type='int',default=cpu_count(),
+                        help='number of files to checksum or fsdiff, and log chunks to scan, at once, default: number of cores')
+    parser.add_option ('--keep-log',action="store_true",default=False,
+                        help='with --stream, still write the raw event log to %s for debugging' % logfile)
+    parser.add_option ('--log-format',default='text',metavar='[text | binary]',
+                        help='format of the event log, default: text')
+    parser.add_option ('--stats',metavar='PATH',
+                        help='write a JSON report of how long each phase took, counts of events and paths, and each external command run to PATH')
+    parser.add_option ('--profile',metavar='PATH',
+                        help='profile the run with cProfile, saving the profile to PATH for pstats')
+    parser.add_option ('--parse-only',action="store_true",default=False,
+                        help='skip the install and scan the logs an earlier run left in %s and %s, with -i giving the installer PID' % (logfile, pidlog))
+    parser.add_option ('--session',metavar='DIR',
+                        help='save the event log, process tree, target and options of the install in DIR, to be replayed later')
+    parser.add_option ('--replay',metavar='DIR',
+                        help='skip the install and make the output again from the session saved in DIR, with the options it was saved with unless given again')
+    parser.add_option ('--snapshot',action="store_true",default=False,
+                        help='record the directories of the target in %s before the install, so changes are still found where the kernel drops events' % snapshotfile)
     
     installer_group = OptionGroup(parser,"Installer Options",
                                 "These options apply if you are choosing to invoke Apple's installer with a package")
-    installer_group.add_option('-p','--package',dest='installer_package',
-                        help='package to install',metavar='PATH')
+    installer_group.add_option('-p','--package',dest='installer_package',action='append',
+                        help='package to install, can be given several times to install several packages under one watch with an output for each',metavar='PATH')
+    installer_group.add_option('--concurrency',type='int',default=1,metavar='N',
+                        help='number of packages installed at once, default: 1, one after the other')
     installer_group.add_option('-t','--target',dest='installer_target',
                         help='target of package install, defaults to /', default='/',metavar='PATH')
+    installer_group.add_option('--stage-links',action="store_true",default=False,
+                        help='for the package format, hard link installed files into the package root instead of copying them where they are on the same volume')
+    installer_group.add_option('--store',default=store_dir,metavar='PATH',
+                        help='for the package format, directory files are kept in between runs and staged from, so a file already staged for a package is not copied again, default: %s - set to "" to disable' % store_dir)
+    installer_group.add_option('--store-size',type='int',default=10240,metavar='MB',
+                        help='size the store is kept under, the files used longest ago are removed, default: 10240')
     
     rad_group = OptionGroup(parser, "Radmind Options",
                                 "These options only apply if the radmind format is used")
@@ -162,7 +527,15 @@ def main():
     rad_group.add_option('-C','--comparison-path',dest='comparison_path',
                         help='comparison path to use, default is relative', default='.',metavar='[ . | / ]')
     rad_group.add_option('-c',dest='checksum',help='checksum if any, only sha1 supported for -P option',metavar='[ only sha1 supported ]')
-    rad_group.add_option('-P',dest='pythondiff',help='enable experimental pure python fsdiff output (faster)',action="store_true",default=False)
+    rad_group.add_option('-P',dest='pythondiff',help='enable pure python fsdiff output (faster)',action="store_true",default=False)
+    rad_group.add_option('--batch-size',dest='batch_size',type='int',default=64,metavar='N',
+                        help='paths given to each fsdiff worker at a time, each still run through fsdiff -1 on its own, the number of workers is set by --jobs, default: 64')
+    rad_group.add_option('--cksum-cache',dest='cksum_cache',default=cksum_cache_file,metavar='PATH',
+                        help='file checksums made with -P are kept in, so unchanged files are not read again, default: %s - set to "" to disable' % cksum_cache_file)
+    rad_group.add_option('--baseline',dest='baseline',metavar='PATH',
+                        help='transcript of an earlier version of the package, or a directory of them named as -o names them - lines of files that have not changed are taken from it rather than made again')
+    rad_group.add_option('--delta',dest='delta',action='store_true',default=False,
+                        help='with --baseline, only write what differs from the baseline, with removals for the paths this version no longer installs')
     parser.usage = """
                         watchedinstall.py [options]
 
@@ -181,13 +554,41 @@ def main():
     parser.add_option_group(installer_group)
     parser.add_option_group(rad_group)
     
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv)
+    replay = None
+    if options.replay:
+        try:
+            replay = session.load(options.replay)
+        except session.SessionError, e:
+            parser.error(str(e))
+        # options given again win over the ones saved with the session
+        parser.set_defaults(**replay.options)
+        (options, args) = parser.parse_args(argv)
+        if options.installer_target != replay.info['target'] or options.pid not in (replay.options['pid'], None):
+            parser.error('a replay is of the target and installer the session was saved with')
+        if options.session:
+            parser.error('--session and --replay can not be used together')
+        if len(replay.info['installs']) > 1 and (not options.out_file or not os.path.isdir(options.out_file)):
+            parser.error('the session has several installs, -o must be a directory to write an output for each to')
+    # the output is written from inside the target, which is made the
+    # working directory
+    for name in ('out_file', 'stats', 'profile', 'session', 'replay', 'baseline', 'store'):
+        if getattr(options, name):
+            setattr(options, name, os.path.abspath(getattr(options, name)))
     
     # check for options errors
-    if not options.installer_package and not options.pid:
+    if not options.installer_package and not options.pid and not replay:
         parser.error("either a source package, or a PID is a required argument")
-    if options.installer_package and not os.path.exists(options.installer_package):
-        parser.error("specified Package could not be found")
+    for package in options.installer_package or []:
+        if not os.path.exists(package) and not replay:
+            parser.error("specified Package %s could not be found" % package)
+    if options.installer_package and len(options.installer_package) > 1:
+        if not options.out_file or not os.path.isdir(options.out_file):
+            parser.error('with several packages, -o must be a directory to write an output for each to')
+        if options.capture == 'inotify':
+            parser.error('inotify can not tell several installs apart')
+    if options.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
     if options.installer_package and  options.pid:
         parser.error("Both an installer package and PID were specified, but the program requires one or the other - not both")
     if options.verbose and not options.out_file:
@@ -197,7 +598,9 @@ def main():
         parser.error("specified command file could not be found")
     if options.installer_target != '/':
         options.installer_target = options.installer_target.rstrip('/') # strip trailing /
-    if os.geteuid() != 0:
+    if options.parse_only and not options.pid:
+        parser.error ('--parse-only needs the PID of the installer that made the logs')
+    if os.geteuid() != 0 and not (options.parse_only or replay):
         parser.error ('must be run as root')
     # if call(['which',''])
     if options.format == 'package':
@@ -208,393 +611,595 @@ def main():
             sh('ln -s /Developer/usr/bin/otool /usr/bin/otool')
     if options.format == 'package' and options.installer_target != '/' and options.installer_package:
         parser.error ('package output currently only available for installs on boot volume')
+    if options.capture not in ['auto'] + capture.backends.keys():
+        parser.error ('unknown capture backend %s' % options.capture)
+    if options.parse_only or replay:
+        # the logs are already written, there is nothing to stream
+        options.stream = False
+    elif options.capture not in ('auto', 'fsewatcher') or capture.default_backends() != ['fsewatcher']:
+        # the in process backends hand events straight to the scanner
+        options.stream = True
+    if options.session and options.stream:
+        # the raw log is what a session is replayed from
+        options.keep_log = True
+    if options.log_format not in ('text', 'binary'):
+        parser.error ('log format must be text or binary')
+    if options.pythondiff and options.checksum not in (None, 'sha1'):
+        parser.error ('only sha1 checksums are supported with -P')
+    if options.baseline:
+        if options.format != 'radmind':
+            parser.error ('--baseline is only for radmind transcripts')
+        if not os.path.exists(options.baseline):
+            parser.error ('baseline %s could not be found' % options.baseline)
+        if os.path.isdir(options.baseline) and not (options.installer_package or replay):
+            parser.error ('a baseline directory is looked in by package name, give the transcript to use with a PID')
+    if options.store_size < 0:
+        parser.error('--store-size can not be negative')
+    if options.delta and not options.baseline:
+        parser.error ('--delta needs a --baseline to compare with')
     if options.format == 'radmind' and sh('which fsdiff') == '':
         parser.error ('radmind tools not found') 
     cleanup()
 
     # the install and parselog steps were made into functions so that 
     # just the parsing step could be debugged and optimised
+    scanners = InstallScanners(pids)
     def install():
         """Starts a fsevents watching tool that logs all changes, then runs 
-        the osx installer, while looping over 
-        a PS command to keep track of any descendent PIDs spawned by the installer"""
+        the osx installer, while a process tracker keeps track of any
+        descendent PIDs spawned by the installer"""
         global pids
-        log_handle = open(logfile,'w')
+        stats.start('start watchers')
         pidlog_handle = open(pidlog,'w')
-        
-        try:
-            fs_logger = Popen(['fsewatcher'], stdout=log_handle,shell=True)
-        except OSError:
-            sys.exit("Unable to run fsewatcher tool, make sure it was properly installed")
-        pid_logger = Popen(['execsnoop'],stdout=pidlog_handle,shell=True)
+        readers = []
+        fs_logger = None
+        if options.stream:
+            # events are scanned as they arrive, the log is only kept for debugging
+            event_log = None
+            if options.keep_log:
+                event_log = eventlog.open_log(logfile, options.log_format)
+            window = EventWindow(scanners)
+            try:
+                if resident is not None and not event_log:
+                    # already watching, from an earlier job
+                    watcher = resident.watcher(options.capture, options.installer_target)
+                else:
+                    watcher = capture.backend(options.capture, options.installer_target, event_log)
+                watcher.start(window.push)
+            except capture.CaptureError, e:
+                sys.exit(str(e))
+            if watcher.name == 'inotify' and options.installer_package and len(options.installer_package) > 1:
+                watcher.stop()
+                sys.exit('inotify can not tell several installs apart, fanotify is needed')
+            if options.verbose:
+                print "capturing with %s" % watcher.name
+        elif options.log_format == 'binary':
+            # events are only written down, and scanned once the installer is done
+            event_log = eventlog.open_log(logfile, 'binary')
+            try:
+                watcher = capture.backend('fsewatcher', options.installer_target, event_log)
+                watcher.start(lambda event: None)
+            except capture.CaptureError, e:
+                sys.exit(str(e))
+        else:
+            event_log = None
+            log_handle = open(logfile,'w')
+            try:
+                fs_logger = Popen(['fsewatcher'], stdout=log_handle,shell=True)
+            except OSError:
+                sys.exit("Unable to run fsewatcher tool, build it from fsewatcher.c and put it on your path, see the README")
+        pid_logger = None
+        pid_watcher = None
+        if sys.platform.startswith('linux'):
+            # the kernel reports every fork as it happens, there is no execsnoop log
+            pid_watcher = proctree.NetlinkWatcher(pids)
+            pid_watcher.start()
+            proctree.scan_proc(pids)
+        elif options.stream:
+            pid_logger = Popen(['execsnoop'], stdout=PIPE, bufsize=-1, shell=True)
+            readers.append(threading.Thread(target=stream_pidlog, args=(pid_logger.stdout, pidlog_handle)))
+        else:
+            pid_logger = Popen(['execsnoop'],stdout=pidlog_handle,shell=True)
+        for reader in readers:
+            reader.setDaemon(True)
+            reader.start()
+        stats.stop('start watchers')
+        if options.snapshot:
+            import snapshot
+            with stats.phase('snapshot'):
+                count = snapshot.take(options.installer_target, snapshotfile)
+            stats.count('directories in snapshot', count)
+            scanners.snapshot = snapshotfile
+        elif os.path.exists(snapshotfile):
+            # from an earlier install, not one for --parse-only to use
+            os.remove(snapshotfile)
+        scanners.started = time.time()
+        stats.start('installer')
         if options.installer_package:
-            installer_command = ['installer','-verbose','-pkg', options.installer_package,'-target', options.installer_target]
             # these environment variable can help convince installer to install on non-boot drive
             os.environ['CM_BUILD'] = 'CM_BUILD'
             os.environ['COMMAND_LINE_INSTALL'] = '1'
-            
-            
-            if options.verbose:
-                installer_out = sys.stdout
-            else:
-                installer_out = PIPE
             if options.verbose:
                 print "fsewatcher running - starting installer"
-            
-            installer = Popen(installer_command, stdout=installer_out, stderr=STDOUT, bufsize=1)
-            parentPID = str(installer.pid)
-            pids.add(parentPID)
-            # disable spotlight
-            call(['launchctl','unload','/System/Library/LaunchDaemons/com.apple.metadata.mds.plist'])
-            while installer.poll() != 0:
-                
-                # second implementation - now post process log
-                # process_list = Popen("ps -ax -o ppid=,pid=,command=", shell=True, stdout=PIPE,stderr=PIPE).communicate()[0].split('\n')[:-1]
-                # for p in process_list:
-                #     data = p.split()
-                #     if data[0] in pids:
-                #         pids.add(data[1])
-                
-                # first implemenation
-                # if loop % 10 == 0:
-                #     if options.verbose:
-                #         print '\n'.join(installer.stdout.readlines(1024))
-                #     # todo check on logger process
-                # loop += 1
-                time.sleep(1)
-            if options.verbose:
-                print "installer exited"
-            if  installer.returncode:
-                errstr = "Installer Failed with return code: %s\n%s" % (installer.returncode,installer.communicate()[0])
-                sys.exit(errstr)
+            queue = list(options.installer_package)
+            failed = []
+            # disable spotlight, the daemon has already
+            if resident is None:
+                stats.call(['launchctl','unload','/System/Library/LaunchDaemons/com.apple.metadata.mds.plist'])
+            # installer output is read as it comes, and shown with -v
+            supervisor = Supervisor(options.verbose and sys.stdout or None)
+            for logger, name in ((fs_logger, 'fsewatcher'), (pid_logger, 'execsnoop')):
+                if logger:
+                    supervisor.watch(logger, name)
+            supervisor.open()
+            try:
+                while queue or supervisor.running:
+                    while queue and len(supervisor.running) < options.concurrency:
+                        package = queue.pop(0)
+                        installer_command = ['installer','-verbose','-pkg', package,'-target', options.installer_target]
+                        installer = supervisor.start(installer_command, package, len(options.installer_package) > 1)
+                        pids.add_root(installer.process.pid)
+                        scanners.add(installer.process.pid, package)
+                    for installer in supervisor.wait():
+                        if options.verbose:
+                            print "installer exited: %s" % installer.name
+                        if installer.returncode:
+                            output = ''
+                            if not options.verbose:
+                                output = installer.text()
+                            failed.append("Installer Failed with return code: %s\n%s" % (installer.returncode, output))
+                            scanners.drop(installer.process.pid)
+            finally:
+                supervisor.close()
+            if failed and len(options.installer_package) == 1:
+                sys.exit(failed[0])
+            for errstr in failed:
+                sys.stderr.write(errstr + '\n')
         else:
             # using manual PID setting
             parentPID = options.pid
-            pids.add(parentPID)
-            parent_found = True
-            # todo: add execsnoop feature to this part
-            while parent_found:
-                process_list = Popen("ps -ax -o ppid=,pid=,command=", shell=True, stdout=PIPE,stderr=PIPE).communicate()[0].split('\n')[:-1]
-                parent_found = False
-                for p in process_list:
-                    data = p.split()
-                    if data[1] == parentPID:
-                        parent_found = True
-                        break # for loop
-                if not parent_found:
-                    break # while loop
-                time.sleep(1)
+            pids.add_root(parentPID)
+            scanners.add(parentPID)
+            if sys.platform.startswith('linux'):
+                # pick up children spawned before we started watching
+                proctree.scan_proc(pids)
+            # the kernel tells us when the installer exits
+            proctree.wait_exit(parentPID)
                 
+        stats.stop('installer')
         # stop the logger
+        stats.start('stop watchers')
         if options.verbose:
             print "killing logger processes"
-        call(['kill',str (fs_logger.pid)])
-        call(['kill',str (pid_logger.pid)])
-        log_handle.close()
+        if options.stream or event_log:
+            watcher.stop()
+        else:
+            stop(fs_logger)
+        if pid_logger:
+            stop(pid_logger)
+        if pid_watcher:
+            pid_watcher.stop()
+        for reader in readers:
+            reader.join()
         pidlog_handle.close()
-        parse_pidlog(parentPID)
+        stats.stop('stop watchers')
+        if options.stream:
+            with stats.phase('scan'):
+                window.flush()
+                scanners.finish()
+            stats.count('events scanned', window.pushed)
+            stats.count('events matched', window.matched)
+            if event_log:
+                event_log.close()
+        else:
+            if event_log:
+                event_log.close()
+            else:
+                log_handle.close()
+            if pid_logger:
+                with stats.phase('pid resolution'):
+                    parse_pidlog(options.pid)
+
+    def recover_dropped(scanner, transcript_index=None):
+        """looks again at the directories the installer was working in when
+        the kernel dropped events, and adds what changed there to the
+        scanner's paths, see snapshot.py"""
+        import snapshot
+        target = options.installer_target
+        stats.count('events dropped', len(scanner.drops))
+        taken = None
+        if scanners.snapshot and os.path.exists(scanners.snapshot):
+            taken = snapshot.Snapshot(scanners.snapshot)
+            since = taken.time
+        elif scanners.started:
+            since = scanners.started
+        else:
+            sys.stderr.write('%s events were dropped, and without a snapshot or the time the install started '
+                             'the changes made meanwhile can not be found, the output may be missing some\n' % len(scanner.drops))
+            return
+        inside = target.rstrip('/') + '/'
+        directories = [d for d in scanner.drop_directories(target) if d == target or d.startswith(inside)]
+        if options.verbose:
+            print "events were dropped, looking again at %s directories" % len(directories)
+        changed, changed_dirs = snapshot.rescan(target, directories, since, taken)
+        recovered = 0
+        for path in changed:
+            if scanner.recover(path):
+                recovered += 1
+        if transcript_index is not None:
+            # what the transcripts say was in a directory that lost entries,
+            # and is not there now
+            for directory in changed_dirs:
+                for key in transcript_index.children(directory[len(target.rstrip('/')):] or '/'):
+                    path = target.rstrip('/') + key
+                    if not os.path.lexists(path) and scanner.recover_removed(path):
+                        recovered += 1
+        elif changed_dirs:
+            # only the transcripts say what a directory held before
+            sys.stderr.write('events were dropped in %s directories that had entries added or removed, removals are only '
+                             'recovered for radmind output\n' % len(changed_dirs))
+        if taken is None:
+            sys.stderr.write('events were dropped, files removed meanwhile can only be found with --snapshot\n')
+        stats.count('paths recovered', recovered)
 
-    def parselog():
+    def parselog(capture_session=None):
         """As efficiently as possible scan the log of FS changes to extract and 
-        report on those made by the installer or its descendants."""
+        report on those made by the installer or its descendants.
+
+        Events are handed to the scanner of the install that made them, and
+        each install then gets an output of its own. With a capture session
+        the log is read from the session, or just the installer's events if
+        an earlier scan saved them there."""
         global pids
 
-        unsorted = open(unsorted_file,'w')
-        fsdiff_command = ['fsdiff','-1']
-        twhich_command = ['twhich']
-        radmind_options = []
-        if options.case_insensitive:
-            radmind_options.append('-I')
-        if options.command_file:
-            radmind_options.extend(['-K',options.command_file])
-        if options.checksum:
-            radmind_options.extend(['-c',options.checksum])
+        exclude_patterns = get_excludes(options)
+        if options.verbose:
+            print "PIDs involved:"
+            print pids.pids()
+            print '%s patterns excluded' % len(exclude_patterns)
+        stats.start('scan')
+        matched = 0
+        log_path = logfile
+        record = None
+        if capture_session and not options.stream:
+            log_path = capture_session.filtered(pids)
+            if log_path:
+                if options.verbose:
+                    print "reading the installer's events saved in %s" % capture_session.path
+            else:
+                log_path = capture_session.log_path
+                record = capture_session.record_filtered()
+        if not options.stream and eventlog.is_binary(log_path):
+            # only events of the installer's processes are read in full
+            for event in eventlog.read_events(log_path, pids):
+                matched += 1
+                if record:
+                    record.write(*event)
+                scanners.feed(event[0], event[2], event[1])
+            scanners.finish()
+        elif not options.stream:
+            # the whole log is scanned now that the installer is done, split
+            # up among worker processes that drop other processes' events
+            progress = None
+            if options.verbose:
+                log_size = float(os.path.getsize(log_path)) or 1.0
+                print "scanning %s bytes of file system events for installer changes" % int (log_size)
+                def progress(bytes_read, last=[0]):
+                    percent = int(bytes_read / log_size * 10) * 10
+                    if percent > last[0]:
+                        print '%%%s complete' % percent
+                        last[0] = percent
+            for event in prefilter.filter_log(log_path, pids.pids(), options.jobs, progress):
+                # installer related FS change
+                matched += 1
+                if record:
+                    record.write(*event)
+                scanners.feed(event[0], event[2], event[1])
+            scanners.finish()
+        if record:
+            capture_session.save_filtered(record, pids)
+        stats.count('events matched', matched)
+        stats.stop('scan')
+
+        dropped = [scanner for scanner in scanners.scanners.values() if scanner.drops]
+        transcript_index = None
+        if options.format == 'radmind' and (dropped or [scanner for scanner in scanners.scanners.values() if scanner.paths.count(REMOVED)]):
+            # one pass over the command file and its transcripts instead of
+            # a twhich run for every removed path, shared by all the installs
+            transcript_index = warm(('transcripts', options.command_file, options.case_insensitive),
+                                    radmind.command_files(options.command_file, True),
+                                    lambda: radmind.TranscriptIndex(options.command_file, options.case_insensitive))
+        if dropped:
+            with stats.phase('recover'):
+                for scanner in dropped:
+                    recover_dropped(scanner, transcript_index)
+
+        def output(scanner, package):
+            """dispatches the adds and removes of one install, and writes its output"""
+            # each path is looked up once, by whichever handler or the
+            # package stage gets to it first
+            meta = metacache.MetadataCache()
+            previous = None
+            if options.baseline:
+                import baseline
+                previous_path = options.baseline
+                if os.path.isdir(previous_path):
+                    previous_path = os.path.join(previous_path, re.sub('(.pkg|.mpkg)','.T',os.path.basename(package or '')))
+                if os.path.isfile(previous_path):
+                    previous = baseline.Baseline(previous_path, options.case_insensitive, options.checksum)
+                else:
+                    sys.stderr.write('WARNING: no baseline %s, the transcript is made in full\n' % previous_path)
+            if options.format == 'package':
+                unsorted = open(unsorted_file,'w')
+            else:
+                # lines go straight to an in process sorter, which writes them
+                # out in order once they are all in
+                out = sys.stdout
+                if options.out_file:
+                    outfile = options.out_file
+                    if os.path.isdir(options.out_file) and package:
+                        # outfile_name = os.path.basename(options.installer_package).replace('.pkg','.T')
+                        suffix = options.format == 'radmind' and '.T' or '.txt'
+                        outfile_name = re.sub ('(.pkg|.mpkg)',suffix,os.path.basename(package))
+                        outfile = os.path.join(options.out_file,outfile_name)
+                    out = open_output(outfile)
+                if options.format == 'radmind':
+                    if options.delta and previous is not None:
+                        out = baseline.DeltaWriter(out, previous)
+                    unsorted = tsort.transcript_sorter(out, options.case_insensitive)
+                else:
+                    unsorted = tsort.Sorter(out)
+            fsdiff_command = ['fsdiff','-1']
+            twhich_command = ['twhich']
+            radmind_options = []
+            if options.case_insensitive:
+                radmind_options.append('-I')
+            if options.command_file:
+                radmind_options.extend(['-K',options.command_file])
+            if options.checksum:
+                radmind_options.extend(['-c',options.checksum])
         
-        os.chdir(options.installer_target)
-        # call('say in python loop',shell=True)
+            os.chdir(options.installer_target)
+            # call('say in python loop',shell=True)
         
-        def prep_path(path):
-            if options.installer_target != '/':
-                path = path.replace(options.installer_target, '')
-            if options.case_insensitive:
-                path = '.' + path
-            return path
+            def prep_path(path):
+                if options.installer_target != '/':
+                    path = path.replace(options.installer_target, '')
+                if options.case_insensitive:
+                    path = '.' + path
+                return path
         
-        def path_ok(path):
-            if options.english_only:
-                if re.search('.lproj',path):
-                    if not (re.search('English.lproj',path) or re.search('en.lproj',path)):
-                        return False
-            for pattern in exclude_patterns:
-                if pattern.search(path):
-                    return False
-            return True
+            def path_ok(path):
+                if exclude_patterns.path_ok(path):
+                    return True
+                stats.count('excluded')
+                return False
             
-        def twhich(path):
-            # items_already_output.append(path)
-            if path_ok(path):
-                path = prep_path(path)
-                twhich_result = Popen(twhich_command + radmind_options + [path],stdout=PIPE).communicate()[0]
-                # twhich_result = ''
-                # print twhich_result
+            def twhich(path):
+                if path_ok(path):
+                    path = prep_path(path)
+                    if transcript_index.is_special(path):
+                        twhich_tool(path)
+                        return
+                    line = transcript_index.lookup(path)
+                    if line:
+                        stats.count('removes')
+                        unsorted.write('- ' + line + '\n')
+
+            def twhich_tool(path):
+                """asks the radmind twhich tool, only used for special files"""
+                twhich_result = stats.output(twhich_command + radmind_options + [path])
                 twhich_lines = twhich_result.split('\n')
                 if len (twhich_lines) > 1:
                     if '# Exclude' in twhich_lines[0]:
                         return
                     elif twhich_lines[1][0] != '#' and twhich_lines[1][-1] != ':':
+                        stats.count('removes')
                         unsorted.write('- ' + twhich_lines[1] + '\n')
         
-        def fsdiff_b(path):
-            """a blank version of fsdiff for test optimizations"""
-            return
+            def fsdiff_b(path):
+                """a blank version of fsdiff for test optimizations"""
+                return
             
-        def fsdiff(path):
-            if os.path.exists(path):
-                if path_ok(path):
-                    path = prep_path(path)
-                    Popen(fsdiff_command + radmind_options + [path],stdout=unsorted).wait()
+            def fsdiff(path):
+                if meta.exists(path):
+                    if path_ok(path):
+                        stats.count('adds')
+                        line = previous is not None and previous.unchanged(prep_path(path), meta.lstat(path))
+                        if line:
+                            # the baseline line holds, fsdiff is not run
+                            unsorted.write(line + '\n')
+                        else:
+                            fsdiff_pool.add(prep_path(path))
 
             
-        def fsdiff_p(path):
-            """ 
-            a start at a pure python implementation of the fsdiff output
-            """
-            # todo relative paths for links
-            if os.path.exists(path):
-                if path_ok(path):
-                    info = os.lstat(path)
-                    # ls -lPTne xmas-photo.jpg 
-                    # ls_info = Popen(['ls','-lPTne',"'%s'" % path.replace ("'","\\'")])
-                    xatrib = xattr.xattr(path)
-                    orig_path = path
-                    path = prep_path(path)
-                    sel_info = [    path.replace(' ','\\b').replace('\t','\\t'),
-                                    oct(info.st_mode & 0777), 
-                                    info.st_uid,
-                                    info.st_gid,
-                                    info.st_mtime,
-                                    info.st_size,
-                                    '-'
-                                    ]
-                    sel_info = [str(x) for x in sel_info]
-                    if xatrib:
-                        l = "a " + ' '.join(sel_info)
-                    elif os.path.islink(path):
-                        l = "l " + path.replace(' ','\\b').replace('\t','\\t') + ' ' +\
-                            os.path.realpath(path).replace(' ','\\b').replace('\t','\\t')
-                    elif os.path.isfile(path):
-                        l = "f " + ' '.join(sel_info)
-                    elif os.path.isdir(path):
-                        l = "d " + ' '.join(sel_info[:3])
-                    # Not yet dug enough into how to get a radmind style cksum in python...
-                    # if xatrib or os.path.isfile(path):
-                    #     # write checksum
-                    #     if options.checksum:
-                    #         cksum = hashlib.sha1(open(orig_path,'rb').read()).hexdigest()
-                    #         l += cksum 
-                    unsorted.write(l + '\n')
+            def fsdiff_p(path):
+                """pure python fsdiff, see pyfsdiff.py"""
+                if meta.lexists(path):
+                    if path_ok(path):
+                        stats.count('adds')
+                        python_fsdiff.add(path, prep_path(path))
         
-        def standard_add(path):
-            if os.path.exists(path):
-                if path_ok(path):
-                    unsorted.write("+ %s\n" % path)
+            def standard_add(path):
+                if meta.exists(path):
+                    if path_ok(path):
+                        stats.count('adds')
+                        unsorted.write("+ %s\n" % path)
 
             
-        def standard_delete(path):
-            if path_ok(path):
-                unsorted.write("- %s\n" % path)
+            def tree_line_ok(line):
+                """path_ok for a line of a recursive fsdiff"""
+                path = radmind.decode_path(line.split(' ', 2)[1]).lstrip('.')
+                if options.installer_target != '/':
+                    path = options.installer_target.rstrip('/') + path
+                if path_ok(path):
+                    stats.count('adds')
+                    return True
+                return False
+
+            def add_tree(root):
+                """adds a directory the install made whole and everything in it,
+                a walk of the directory rather than a path at a time"""
+                stats.count('directories rolled up')
+                if add == fsdiff and previous is None:
+                    if meta.exists(root) and path_ok(root):
+                        fsdiff_pool.add_tree(prep_path(root), tree_line_ok)
+                    return
+                # with a baseline each file is looked at, its line may be there
+                add(root)
+                if not exclude_patterns.path_ok(root):
+                    return
+                # excluded directories are not gone into, as for fsdiff
+                for path in meta.walk(root, exclude_patterns.path_ok):
+                    add(path)
+
+            def standard_delete(path):
+                if path_ok(path):
+                    stats.count('removes')
+                    unsorted.write("- %s\n" % path)
 
         
         
-        installer_created = {}
-        items_already_output = {}
-        items_removed = {}
-        pids = list(pids)
-        last_path = ''
-        last_action = ''
-        # last_inode = 0
-        exclude_patterns = get_excludes(options)
-        if options.format == 'radmind':
-            if options.pythondiff:
-                add = fsdiff_p
+            if options.format == 'radmind':
+                if options.pythondiff:
+                    import pyfsdiff
+                    python_fsdiff = pyfsdiff.Fsdiff(unsorted, options.checksum, options.jobs, options.cksum_cache,
+                                                    meta, previous)
+                    add = fsdiff_p
+                else:
+                    fsdiff_pool = radmind.FsdiffPool(unsorted, fsdiff_command + radmind_options,
+                                                     options.jobs, options.batch_size)
+                    add = fsdiff
+                remove = twhich
             else:
-                add = fsdiff
-            remove = twhich
-        else:
-            add = standard_add
-            remove = standard_delete
+                add = standard_add
+                remove = standard_delete
             
-        PID = 0
-        PROCESS = 1
-        EVENT = 2
-        PATH = 3
-        INODE = 4
-        if options.verbose:
-            last_percent = 0
-            linect = float (Popen(['wc -l ' + logfile],stdout=PIPE,shell=True).\
-                communicate()[0].split()[0])
-            print "PIDs involved:"
-            print pids
-            print "scanning %s file system events for installer changes" % int (linect)
-            print '%s patterns excluded' % len(exclude_patterns)
-        f = open(logfile)
-        # pdb.set_trace()
-        for lineno,line in enumerate(f):
-            if options.verbose:
-                percent = int (round(float(lineno)/linect * 100))
-                if percent > 0 and percent % 10 == 0 and percent != last_percent:
-                    print '%%%s complete' % percent
-                    last_percent = percent
-                    # print len(items_already_output)/lineno * 100
-            if line in ('','\n'): continue # blank line at end
-            fields = line.split('\t')
-            logged_path = fields[PATH].strip()
-            # if len(fields) != 5:
-            #     # assuming missing the inode
-            #     if os.path.exists(logged_path):
-            #         inode = os.lstat(logged_path).st_ino
-            #         # print 'inod given for %s' % logged_path
-            #     else:
-            #         continue
-            # else:
-            #     inode = int (fields[INODE].strip())
-            if fields[PID] in pids and logged_path not in items_already_output:
-                # installer related FS change
-                # since the installer processes will often make several changes to a file
-                # we try to only take action once per file
-                if logged_path != last_path:
-                    # if last action was rename diff it if it wasn't created by the installer
-                    if last_action == 'FSE_RENAME':
-                        if last_path not in installer_created and last_path not in items_already_output:
-                            # the file being renamed was not created by the installer
-                            # print 'removing1 %s' % last_path
-                            # remove(last_path)
-                            items_removed[last_path] = 1
-                        if fields[EVENT] == 'FSE_RENAME':
-                            # the current file needs to be noted either way
-                            # print 'adding1   %s' % logged_path
-                            add(logged_path)
-                            items_already_output[logged_path] = 1
-                            if logged_path in items_removed:
-                                # delete from the list of things to remove
-                                del(items_removed[logged_path])
-                    elif last_action == 'FSE_DELETE':
-                        if last_path not in installer_created:
-                            # only probe deleted files if they were not 
-                            # temp files created by the installer
-                            # print 'removing2 %s' % last_path
-                            # remove(last_path)
-                            items_removed[last_path] = 1
-                    elif last_path not in items_already_output:
-                        # any other change to a file - we want to fsdiff it
-                        # print 'adding2   %s' % last_path
-                        add(last_path)
-                        items_already_output[last_path] = 1
-                        if last_path in items_removed:
-                            del(items_removed[last_path])
-                    # if this is the first time we see a file
-                    # note if it is being created by the installer
-                    if fields[EVENT] in ("FSE_CREATE_FILE","FSE_CREATE_DIR"):
-                        installer_created[logged_path] = 1
-                        # print 'appending %s' % logged_path
-                        # continue
-                last_path = logged_path
-                last_action = fields[EVENT]
-                # last_inode = inode
-
-
-        for p in items_removed:
-            # print 'removing %s' % p
-            remove(p)
-        f.close()
-        unsorted.close()
-        if options.format == 'radmind':
-            tmpfile = '/tmp/sorted.T'
-            lsort_command = ['lsort']
-            if options.case_insensitive:
-                 lsort_command.append('-I')
-            lsort_command.extend(['-o',tmpfile])
-            lsort_command.append(unsorted_file) # the unsorted input transcript
-            call(lsort_command)
-            if add == fsdiff_p and options.checksum:
-                # python version of fsdiff still can't do cksums right
-                # link the tmp file and install root to fool radmind into doing a lcksum
-                t_name = os.path.basename(tmpfile)
-                if not os.path.exists('/var/radmind/tmp/transcript'):
-                    os.makedirs('/var/radmind/tmp/transcript')
-                if not os.path.exists('var/radmind/tmp/file'):
-                    os.makedirs('var/radmind/tmp/file')
-                if os.path.exists('var/radmind/tmp/file/' + t_name):
-                    os.remove('var/radmind/tmp/file/' + t_name)
-                os.symlink(options.installer_target,'var/radmind/tmp/file/' + t_name)
-                if os.path.exists('/var/radmind/tmp/transcript/' + t_name):
-                    os.remove('/var/radmind/tmp/transcript/' + t_name)
-                # os.symlink(tmpfile,'/var/radmind/tmp/transcript/' + t_name)
-                os.rename(tmpfile,'/var/radmind/tmp/transcript/' + t_name)
-                lcksum = ['lcksum']
-                if options.case_insensitive:
-                    lcksum.append('-I')
-                if options.verbose:
+            stats.start('dispatch')
+            stats.count('temporary paths', scanner.transient)
+            roots, added = scanner.rollup(meta.isdir)
+            meta.prime(added)
+            for p in added:
+                add(p)
+            for root in roots:
+                add_tree(root)
+            for p in scanner.removed():
+                # print 'removing %s' % p
+                remove(p)
+            if add == fsdiff_p:
+                if options.verbose and options.checksum:
                     print "checksumming transcript..."
-                lcksum.extend(['-q','-c','sha1','/var/radmind/tmp/transcript/' + t_name])
-                call(lcksum)
-                os.rename('/var/radmind/tmp/transcript/' + t_name,tmpfile)
-
-            if options.out_file:
-                if os.path.isdir(options.out_file) and options.installer_package:
-                    # outfile_name = os.path.basename(options.installer_package).replace('.pkg','.T')
-                    outfile_name = re.sub ('(.pkg|.mpkg)','.T',os.path.basename(options.installer_package))
-                    outfile = os.path.join(options.out_file,outfile_name)
-                else:
-                    outfile = options.out_file
-                os.rename(tmpfile,outfile)
-
+                python_fsdiff.close()
+                stats.count('bytes hashed', python_fsdiff.bytes_hashed)
+            elif add == fsdiff:
+                fsdiff_pool.close()
+            if previous is not None:
+                stats.count('baseline lines reused', previous.reused)
+            stats.count('paths looked up', meta.lookups)
+            stats.count('directories listed', meta.listed)
+            if options.format == 'package':
+                unsorted.close()
+                stats.stop('dispatch')
+                # create a package from the temp transcript
+                # todo refactor this outfile naming bit with the sorted output above
+                if options.out_file:
+                    if os.path.isdir(options.out_file) and package:
+                        # outfile_name = os.path.basename(options.installer_package).replace('.pkg','-repack.pkg')
+                        outfile_name = re.sub ('(.pkg|.mpkg)','-repack.pkg',os.path.basename(package))
+                        outfile = os.path.join(options.out_file,outfile_name)
+                    else:
+                        outfile = options.out_file
+                stats.start('package')
+                import shutil
+                import staging
+                import objectstore
+                pkg_root = '/tmp/package_root'
+                pkg_maker_cmd = '/Developer/Applications/Utilities/PackageMaker.app/Contents/MacOS/PackageMaker'
+                if os.path.exists(pkg_root): 
+                    shutil.rmtree(pkg_root)
+                os.chdir('/')
+                store = None
+                if options.store and not options.stage_links:
+                    try:
+                        store = objectstore.ObjectStore(options.store, options.store_size * 1024 * 1024,
+                                                        options.cksum_cache)
+                    except objectstore.StoreError, e:
+                        # the install is done, the files are copied instead
+                        sys.stderr.write('%s, not using it\n' % e)
+                stager = staging.Stager(pkg_root, options.jobs, options.stage_links, meta, store)
+                for line in open(unsorted_file):
+                    if line.startswith('+ '):
+                        stager.add(line[2:].rstrip('\n'))
+                stager.close()
+                if store is not None:
+                    store.close()
+                    stats.count('objects stored', store.stored)
+                    stats.count('objects evicted', store.evicted)
+                    stats.count('bytes hashed', store.bytes_hashed)
+                pkg_id = os.path.basename(package or outfile)
+                stats.call([pkg_maker_cmd,'--root',pkg_root,'--id',pkg_id,'--title',pkg_id,'--target','10.4','--out',outfile])
+                if not debug: shutil.rmtree(pkg_root)
+                stats.stop('package')
             else:
-                call(['cat',tmpfile])
-        elif options.format == 'package':
-            # create a package from the temp transcript
-            # todo refactor this outfile rename bit with radmind format above
-            if options.out_file:
-                if os.path.isdir(options.out_file) and options.installer_package:
-                    # outfile_name = os.path.basename(options.installer_package).replace('.pkg','-repack.pkg')
-                    outfile_name = re.sub ('(.pkg|.mpkg)','-repack.pkg',os.path.basename(options.installer_package))
-                    outfile = os.path.join(options.out_file,outfile_name)
-                else:
-                    outfile = options.out_file
-            pkg_root = '/tmp/package_root'
-            pkg_maker_cmd = '/Developer/Applications/Utilities/PackageMaker.app/Contents/MacOS/PackageMaker'
-            if os.path.exists(pkg_root): 
-                shutil.rmtree(pkg_root)
-            os.makedirs(pkg_root)                
-            os.chdir('/')
-            for line in open(unsorted_file):
-                abs_path = os.path.abspath(line[2:].strip())
-                # print type(abs_path)
-                if os.path.isfile (abs_path):
-                    dest = os.path.join (pkg_root,os.path.dirname(abs_path)[1:] + '/')
-                    call(['ditto',abs_path,dest])
-            pkg_id = os.path.basename(options.installer_package)
-            call([pkg_maker_cmd,'--root',pkg_root,'--id',pkg_id,'--title',pkg_id,'--target','10.4','--out',outfile])
-            if not debug: shutil.rmtree(pkg_root)
-        else:
-            # 'standard' output
-            sortcmd = ['sort',unsorted_file]
-            if options.out_file:
-                sortcmd.extend(['-o',options.out_file])
-            call(sortcmd)
+                stats.stop('dispatch')
+                # radmind or 'standard' output, sorted and written out
+                with stats.phase('sort'):
+                    unsorted.close()
+                finish_output()
+                stats.count('output lines', unsorted.count)
+                if options.delta and previous is not None:
+                    stats.count('unchanged lines', unsorted.out.unchanged)
+                    stats.count('baseline paths dropped', unsorted.out.dropped)
 
-    
-    try:
-        if options.verbose:
-            print "Starting Install"
-        install()
+        for root, package in scanners.installs:
+            output(scanners.scanners[root], package)
+
+
+    def run():
+        if replay:
+            replay.load_tree(pids)
+            for root, package in replay.info['installs']:
+                scanners.add(root, package)
+            if os.path.exists(replay.file(session.SNAPSHOT)):
+                scanners.snapshot = replay.file(session.SNAPSHOT)
+            scanners.started = replay.info.get('started')
+            if options.verbose:
+                print "replaying %s, saved %s" % (replay.path, replay.info['created'])
+        elif options.parse_only:
+            pids.add_root(options.pid)
+            scanners.add(options.pid)
+            if os.path.exists(snapshotfile):
+                # left by the same run as the logs
+                scanners.snapshot = snapshotfile
+            if os.path.exists(pidlog):
+                with stats.phase('pid resolution'):
+                    parse_pidlog(options.pid)
+        else:
+            if options.verbose:
+                print "Starting Install"
+            install()
+        capture_session = replay
+        if options.session:
+            try:
+                capture_session = session.save(options.session, options, pids, scanners.installs, logfile, pidlog,
+                                               scanners.snapshot, scanners.started)
+            except session.SessionError, e:
+                sys.exit(str(e))
         
         ## Debugging
         # global pids
         # pids = ['60484']
         # pids = ['71687', '71684', '70596', '71680', '71666', '71688', '71705', '71699', '71691', '71692', '70584', '71703', '71696', '70564', '71674', '70560', '71670', '70532', '70556', '70516', '71707', '70480']
         
-        parselog()
+        parselog(capture_session)
+
+    try:
+        if options.profile:
+            stats.profile(options.profile, run)
+        else:
+            run()
+        if options.stats:
+            stats.current.write(options.stats)
         cleanup()
         sys.exit(0)
     except: